@@ -0,0 +1,387 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY, 'data_extraction'))
+
+from CodeRegistry import load_code_list
+from Constants import ICD_CODE_FILE, LOINC_CODE_FILE, ATC_CODE_FILE, ASTHMA_COPD_CODES_FILE, ICD_SYSTEM_NAME, \
+    LOINC_SYSTEM_NAME, ATC_SYSTEM_NAME
+from Telemetry import query_type_of
+
+"""
+Self-contained mock FHIR server for measuring the extraction without a production server. It serves a synthetic
+cohort: Patients with Asthma/COPD and secondary Conditions (codes of the input files), Encounters flagging the first
+Asthma/COPD Condition as chief complaint ("CC"), Observations, Medication* resources and the Medications they
+reference. Searches support the parameters used by data_extraction and are paged with "next" links; latency, error
+rate and page size are configurable. Responses carry an ETag for conditional requests, batch Bundles of searches
+and Bulk Data "$export" are served as well.
+The code lists are read from input_files of the repository.
+"""
+
+LAST_UPDATED = "2024-01-01T00:00:00Z"
+LAST_MODIFIED = "Mon, 01 Jan 2024 00:00:00 GMT"
+MEDICATION_RESOURCE_TYPES = ("MedicationAdministration", "MedicationRequest", "MedicationStatement")
+MEDICATION_POOL_SIZE = 50
+
+
+def _coding(system, code):
+    return {"coding": [{"system": system, "code": code}]}
+
+
+def _project(resource, elements):
+    """
+    Resource with only the requested elements (and the mandatory ones), tagged as SUBSETTED like a FHIR server does.
+    Elements of choice types are matched by their name without type, e.g. "medication" for "medicationReference".
+    """
+    projection = {name: value for name, value in resource.items()
+                  if name in ("resourceType", "id") or any(name == element or
+                                                           (name.startswith(element) and name[len(element)].isupper())
+                                                           for element in elements)}
+    projection["meta"] = dict(resource["meta"], tag=[{"system": "http://terminology.hl7.org/CodeSystem/v3-ObservationValue",
+                                                      "code": "SUBSETTED"}])
+    return projection
+
+
+class SyntheticDataset:
+    """
+    Deterministic synthetic resources of a cohort of the given size, indexed by type, id and patient.
+    """
+
+    def __init__(self, patients, observations_per_patient=20, medications_per_patient=3, seed=0):
+        rng = random.Random(seed)
+        asthma_copd_codes = list(load_code_list(os.path.join(REPOSITORY, ASTHMA_COPD_CODES_FILE)))
+        icd_codes = list(load_code_list(os.path.join(REPOSITORY, ICD_CODE_FILE)))
+        loinc_codes = list(load_code_list(os.path.join(REPOSITORY, LOINC_CODE_FILE)))
+        atc_codes = list(load_code_list(os.path.join(REPOSITORY, ATC_CODE_FILE)))
+
+        self.resources = {}  # resource type -> id -> resource
+        self.by_patient = {}  # (resource type, patient reference) -> resources
+
+        for index in range(MEDICATION_POOL_SIZE):
+            # Every fifth Medication has a code outside of the ATC code list
+            code = rng.choice(atc_codes) if index % 5 else "Z99ZZ99"
+            self._add({"resourceType": "Medication", "id": f"m{index}", "code": _coding(ATC_SYSTEM_NAME, code)})
+
+        for index in range(patients):
+            patient = f"Patient/p{index}"
+            self._add({"resourceType": "Patient", "id": f"p{index}"})
+
+            main_conditions = []
+            for number in range(rng.randint(1, 2)):
+                condition = self._add({"resourceType": "Condition", "id": f"c{index}-{number}",
+                                       "subject": {"reference": patient},
+                                       "code": _coding(ICD_SYSTEM_NAME, rng.choice(asthma_copd_codes))}, patient)
+                main_conditions.append(condition)
+            for number in range(2, 4):
+                self._add({"resourceType": "Condition", "id": f"c{index}-{number}", "subject": {"reference": patient},
+                           "code": _coding(ICD_SYSTEM_NAME, rng.choice(icd_codes))}, patient)
+            self._add({"resourceType": "Condition", "id": f"c{index}-4", "subject": {"reference": patient},
+                       "code": _coding(ICD_SYSTEM_NAME, "I10")}, patient)
+
+            for number, condition in enumerate(main_conditions):
+                self._add({"resourceType": "Encounter", "id": f"e{index}-{number}", "status": "finished",
+                           "class": {"system": "http://terminology.hl7.org/CodeSystem/v3-ActCode", "code": "IMP"},
+                           "subject": {"reference": patient},
+                           "diagnosis": [{"condition": {"reference": f"Condition/{condition['id']}"},
+                                          "use": _coding("http://terminology.hl7.org/CodeSystem/diagnosis-role",
+                                                         "CC" if number == 0 else "CM")}]}, patient)
+
+            for number in range(observations_per_patient):
+                code = rng.choice(loinc_codes) if number % 4 else "0000-0"
+                self._add({"resourceType": "Observation", "id": f"o{index}-{number}", "status": "final",
+                           "subject": {"reference": patient}, "code": _coding(LOINC_SYSTEM_NAME, code),
+                           "issued": "2023-06-01T08:00:00Z", "performer": [{"reference": "Organization/lab"}],
+                           "valueQuantity": {"value": round(rng.uniform(0, 100), 2), "unit": "mg/dL",
+                                             "system": "http://unitsofmeasure.org", "code": "mg/dL"},
+                           "interpretation": [_coding("http://terminology.hl7.org/CodeSystem/v3-ObservationInterpretation", "N")],
+                           "referenceRange": [{"low": {"value": 10, "unit": "mg/dL"}, "high": {"value": 90, "unit": "mg/dL"},
+                                               "text": "Reference range of the laboratory"}]}, patient)
+
+            for resource_type in MEDICATION_RESOURCE_TYPES:
+                for number in range(medications_per_patient):
+                    resource = {"resourceType": resource_type, "id": f"{resource_type[10:13].lower()}{index}-{number}",
+                                "status": "completed", "subject": {"reference": patient},
+                                "medicationReference": {"reference": f"Medication/m{rng.randrange(MEDICATION_POOL_SIZE)}"}}
+                    if resource_type == "MedicationAdministration":
+                        resource["effectiveDateTime"] = "2023-06-01"
+                    elif resource_type == "MedicationRequest":
+                        resource.update(status="active", intent="order")
+                    self._add(resource, patient)
+
+    def _add(self, resource, patient=None):
+        resource["meta"] = {"lastUpdated": LAST_UPDATED}
+        # Narrative as sent by most servers, not read by the extraction
+        resource["text"] = {"status": "generated", "div": f'<div xmlns="http://www.w3.org/1999/xhtml"><p>'
+                                                          f'{resource["resourceType"]} {resource["id"]}</p></div>'}
+        self.resources.setdefault(resource["resourceType"], {})[resource["id"]] = resource
+        if patient is not None:
+            self.by_patient.setdefault((resource["resourceType"], patient), []).append(resource)
+        return resource
+
+    def _codes_match(self, concept, values, below):
+        for coding in (concept or {}).get('coding', []):
+            for value in values:
+                system, _, code = value.rpartition('|')
+                if system and coding.get('system') != system:
+                    continue
+                if coding.get('code') == code or (below and coding.get('code', '').startswith(code)):
+                    return True
+        return False
+
+    def search(self, resource_type, params):
+        """
+        Resources of the type matching the search parameters, unknown parameters are ignored.
+        """
+        patient = params.get('subject') or params.get('patient')
+        if patient:
+            patient = patient if '/' in patient else f"Patient/{patient}"
+            candidates = self.by_patient.get((resource_type, patient), [])
+        else:
+            candidates = self.resources.get(resource_type, {}).values()
+
+        results = []
+        for resource in candidates:
+            if '_id' in params and resource['id'] not in params['_id'].split(','):
+                continue
+            if '_lastUpdated' in params and not resource['meta']['lastUpdated'] > params['_lastUpdated'][2:]:
+                continue
+            if 'diagnosis' in params and not any(diagnosis['condition']['reference'] in params['diagnosis'].split(',')
+                                                 for diagnosis in resource.get('diagnosis', [])):
+                continue
+            matches = True
+            for name, below in (('code', False), ('code:below', True)):
+                if name in params:
+                    matches &= self._codes_match(resource.get('code'), params[name].split(','), below)
+            for name, below in (('medication.code', False), ('medication.code:below', True)):
+                if name in params:
+                    reference = resource.get('medicationReference', {}).get('reference', '')
+                    medication = self.resources['Medication'].get(reference.partition('/')[2], {})
+                    matches &= self._codes_match(medication.get('code'), params[name].split(','), below)
+            if matches:
+                results.append(resource)
+        return results
+
+
+class MockFhirServer:
+    """
+    The mock server running on a background thread.
+    """
+
+    def __init__(self, dataset, latency_ms=0.0, error_rate=0.0, page_size=100, port=0, host="127.0.0.1",
+                 reject_elements=False):
+        """
+        :param reject_elements: Answer searches with "_elements" with 400, like servers not supporting it
+        """
+        self.dataset = dataset
+        self.reject_elements = reject_elements
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.exports = {}  # Export job id -> (polls left, resource types)
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/fhir"
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats = {"requests": 0, "errors_injected": 0, "bytes": 0, "by_type": {}}
+
+    def record(self, path, size, error=False):
+        with self._stats_lock:
+            self.stats["requests"] += 1
+            self.stats["bytes"] += size
+            self.stats["errors_injected"] += error
+            if "/_export/" in path:
+                query_type = "$export"
+            elif urlparse(path).path.rstrip('/') == '/fhir':
+                query_type = "batch"
+            else:
+                query_type = query_type_of(path)
+            self.stats["by_type"][query_type] = self.stats["by_type"].get(query_type, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def search_bundle(self, resource_type, path, params):
+        results = self.dataset.search(resource_type, params)
+        offset = int(params.get('_offset', 0))
+        count = min(int(params.get('_count', self.page_size)), self.page_size)
+        page = results[offset:offset + count]
+        if '_elements' in params:
+            page = [_project(resource, params['_elements'].split(',')) for resource in page]
+        query = {name: value for name, value in params.items() if name != '_offset'}
+        links = [{"relation": "self", "url": f"{self.base_url}/{path}?{urlencode(dict(query, _offset=offset))}"}]
+        if offset + count < len(results):
+            links.append({"relation": "next",
+                          "url": f"{self.base_url}/{path}?{urlencode(dict(query, _offset=offset + count))}"})
+        return {"resourceType": "Bundle", "type": "searchset", "total": len(results), "link": links,
+                "entry": [{"fullUrl": f"{self.base_url}/{resource['resourceType']}/{resource['id']}",
+                           "resource": resource, "search": {"mode": "match"}} for resource in page]}
+
+
+def _handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body=None, content_type="application/fhir+json", headers=None, error=False):
+            data = b"" if body is None else body if isinstance(body, bytes) else json.dumps(body).encode()
+            headers = dict(headers or {})
+            if status == 200 and self.command == 'GET':
+                # Validators for conditional requests, the data of the server never changes
+                headers.update(ETag=f'W/"{hashlib.sha1(data).hexdigest()[:16]}"', **{"Last-Modified": LAST_MODIFIED})
+                if self.headers.get('If-None-Match') == headers['ETag']:
+                    status, data = 304, b""
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+            server.record(self.path, len(data), error)
+
+        def _simulate(self):
+            """
+            Latency and injected errors, True if an error was sent.
+            """
+            if server.latency_ms:
+                time.sleep(server.latency_ms / 1000 * random.uniform(0.5, 1.5))
+            if server.error_rate and random.random() < server.error_rate:
+                self._send(503, {"resourceType": "OperationOutcome", "issue": [
+                    {"severity": "error", "code": "transient", "diagnostics": "Injected error"}]},
+                           headers={"Retry-After": "0"}, error=True)
+                return True
+            return False
+
+        def _parts(self):
+            url = urlparse(self.path)
+            params = {name: values[-1] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+            path = url.path.removeprefix('/fhir').strip('/')
+            return path, [part for part in path.split('/') if part], params
+
+        def do_DELETE(self):
+            path, parts, params = self._parts()
+            server.exports.pop(parts[-1], None)
+            self._send(202)
+
+        def do_POST(self):
+            path, parts, params = self._parts()
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if self._simulate():
+                return
+            if not parts and body.get('type') == 'batch':
+                return self._send(200, self._batch(body))
+            params.update({parameter['name']: parameter.get('valueString', '') for parameter in body.get('parameter', [])})
+            if parts and parts[-1] == '$export':
+                return self._kick_off(params)
+            self._send(404, {"resourceType": "OperationOutcome"})
+
+        def _batch(self, body):
+            """
+            batch-response of a batch Bundle of searches.
+            """
+            entries = []
+            for entry in body.get('entry', []):
+                url = urlparse(entry['request']['url'])
+                resource_type = url.path.strip('/')
+                params = {name: values[-1] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+                if entry['request']['method'] != 'GET' or '/' in resource_type:
+                    entries.append({"response": {"status": "400 Bad Request"}})
+                    continue
+                entries.append({"resource": server.search_bundle(resource_type, resource_type, params),
+                                "response": {"status": "200 OK"}})
+            return {"resourceType": "Bundle", "type": "batch-response", "entry": entries}
+
+        def do_GET(self):
+            if self._simulate():
+                return
+            path, parts, params = self._parts()
+            if parts and parts[-1] == '$export':
+                return self._kick_off(params)
+            if parts == ['metadata']:
+                return self._send(200, {"resourceType": "CapabilityStatement", "status": "active",
+                                        "kind": "instance", "fhirVersion": "4.0.1", "format": ["json"]})
+            if parts[:2] == ['_export', 'status']:
+                return self._export_status(parts[2])
+            if parts[:2] == ['_export', 'files']:
+                return self._export_file(parts[3].removesuffix('.ndjson'))
+            if len(parts) == 1:
+                if server.reject_elements and '_elements' in params:
+                    return self._send(400, {"resourceType": "OperationOutcome", "issue": [
+                        {"severity": "error", "code": "not-supported", "diagnostics": "_elements is not supported"}]})
+                return self._send(200, server.search_bundle(parts[0], path, params))
+            if len(parts) == 2:
+                resource = server.dataset.resources.get(parts[0], {}).get(parts[1])
+                if resource is not None:
+                    return self._send(200, resource)
+            self._send(404, {"resourceType": "OperationOutcome"})
+
+        def _kick_off(self, params):
+            job = uuid.uuid4().hex
+            server.exports[job] = [1, params.get('_type', '').split(',')]
+            self._send(202, headers={"Content-Location": f"{server.base_url}/_export/status/{job}"})
+
+        def _export_status(self, job):
+            if job not in server.exports:
+                return self._send(404, {"resourceType": "OperationOutcome"})
+            polls_left, types = server.exports[job]
+            if polls_left:
+                server.exports[job][0] -= 1
+                return self._send(202, headers={"Retry-After": "0", "X-Progress": "in progress"})
+            self._send(200, {"transactionTime": LAST_UPDATED, "request": self.path, "requiresAccessToken": False,
+                             "output": [{"type": resource_type,
+                                         "url": f"{server.base_url}/_export/files/{job}/{resource_type}.ndjson"}
+                                        for resource_type in types if resource_type], "error": []},
+                       content_type="application/json")
+
+        def _export_file(self, resource_type):
+            lines = (json.dumps(resource) for resource in server.dataset.resources.get(resource_type, {}).values())
+            self._send(200, ("\n".join(lines) + "\n").encode(), content_type="application/fhir+ndjson")
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves a synthetic cohort as a mock FHIR server.")
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Mean latency added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--page-size", type=int, default=100, help="Maximum entries per search page")
+    args = parser.parse_args()
+
+    server = MockFhirServer(SyntheticDataset(args.patients), args.latency_ms, args.error_rate, args.page_size,
+                            args.port)
+    print(f"Mock FHIR server with {args.patients} patients at {server.base_url}, set SERVER_NAME to it.")
+    server.start()._thread.join()
+
+
+if __name__ == "__main__":
+    main()
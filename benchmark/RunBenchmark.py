@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from MockFhirServer import MockFhirServer, SyntheticDataset, REPOSITORY
+
+"""
+End-to-end benchmark of the extraction against the mock FHIR server. For each cohort size, both scripts run in a
+fresh working directory, each as a separate process so its peak memory is measured and no state is shared.
+Reports wall time, requests to the server and peak memory per script and writes them to benchmark_results.json.
+Usage: python benchmark/RunBenchmark.py --sizes 100 1000
+"""
+
+SCRIPTS = ("CohortPatientsExecute", "ExtractResourcesForCohortExecute")
+
+
+def run_script(script, workdir, env):
+    """
+    Runs a script of data_extraction in the working directory, its output goes to <script>.log.
+    :return: Wall time in seconds, peak memory in MB, exit code
+    """
+    with open(os.path.join(workdir, f"{script}.log"), 'w') as log:
+        started = time.monotonic()
+        process = subprocess.Popen([sys.executable, os.path.join(REPOSITORY, "data_extraction", f"{script}.py")],
+                                   cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.monotonic() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return elapsed, usage.ru_maxrss / 1024, process.returncode  # ru_maxrss is in KB on Linux
+
+
+def run_size(size, args, extra_env):
+    server = MockFhirServer(SyntheticDataset(size, seed=args.seed), args.latency_ms, args.error_rate,
+                            args.page_size).start()
+    workdir = tempfile.mkdtemp(prefix=f"benchmark_{size}_")
+    os.symlink(os.path.join(REPOSITORY, "input_files"), os.path.join(workdir, "input_files"))
+    env = dict(os.environ, SERVER_NAME=server.base_url, USER_NAME="benchmark", USER_PASSWORD="benchmark",
+               **extra_env)
+
+    results = []
+    try:
+        for script in SCRIPTS:
+            server.reset_stats()
+            elapsed, peak_mb, code = run_script(script, workdir, env)
+            results.append({"patients": size, "script": script, "exit_code": code,
+                            "wall_seconds": round(elapsed, 2), "peak_memory_mb": round(peak_mb, 1),
+                            "requests": server.stats["requests"], "bytes": server.stats["bytes"],
+                            "errors_injected": server.stats["errors_injected"],
+                            "requests_by_type": server.stats["by_type"]})
+            if code != 0:
+                print(f"{script} failed with exit code {code}, see {workdir}/{script}.log\n")
+                break
+    finally:
+        server.stop()
+    print(f"Outputs of {size} patients are in {workdir}\n")
+    return results
+
+
+def print_table(results):
+    header = f"{'patients':>8} {'script':<34} {'wall s':>8} {'requests':>9} {'MB sent':>8} {'peak MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(f"{result['patients']:>8} {result['script']:<34} {result['wall_seconds']:>8} {result['requests']:>9} "
+              f"{result['bytes'] / 1e6:>8.1f} {result['peak_memory_mb']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the extraction against the mock FHIR server.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000], help="Cohort sizes to run")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="Mean latency added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--page-size", type=int, default=100, help="Maximum entries per search page")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Setting for the scripts, e.g. --env EXTRACTION_ENGINE=asyncio")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+    extra_env = dict(setting.split("=", 1) for setting in args.env)
+
+    results = []
+    for size in args.sizes:
+        results.extend(run_size(size, args, extra_env))
+
+    print_table(results)
+    with open(args.output, 'w') as file:
+        json.dump({"settings": dict(vars(args), env=extra_env), "results": results}, file, indent=4)
+    print(f"Benchmark results have been saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
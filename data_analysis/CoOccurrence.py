@@ -0,0 +1,268 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from contextlib import closing
+
+import numpy as np
+from scipy import sparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data_extraction'))
+
+from Constants import ICD_CODE_FILE, ICD_SYSTEM_NAME, LOINC_SYSTEM_NAME, ATC_SYSTEM_NAME, RESULT_STORE_FILE, \
+    MEDICATION_CACHE_FILE
+from Graphs import OBSERVATION_GROUPS, load_json
+
+"""
+Patient-level cross-tabulations of the extracted results, e.g. secondary ICD group x ATC medication or observation
+group x main diagnosis J44/J45. The codes of all patients are loaded once from the result store and the cohort file
+into sparse patient x code incidence matrices (number of resources per patient and code), the co-occurrences are
+matrix products of their group-level presence matrices. The matrices are cached in fhir_results/incidence_matrices.npz
+and only built again when the results change.
+The main diagnosis Conditions of the cohort are not counted as secondary conditions. Medications referenced by
+"medicationReference" are resolved to ATC codes with the Medication cache written by the extraction.
+Usage: python data_analysis/CoOccurrence.py
+"""
+
+COHORT_FILE = "patients_main_diagnosed_asthma_copd.json"
+MATRIX_CACHE_FILE = "fhir_results/incidence_matrices.npz"
+MATRIX_VERSION = 2  # Part of the signature of the cached matrices, raised when read_codes counts differently
+CO_OCCURRENCE_FILE = "fhir_results/co_occurrence.json"
+MEDICATION_RESOURCE_TYPES = ("MedicationAdministration", "MedicationRequest", "MedicationStatement")
+
+# Code dimensions of the incidence matrices
+CONDITIONS = "conditions"
+OBSERVATIONS = "observations"
+MEDICATIONS = "medications"
+MAIN_DIAGNOSES = "main_diagnoses"
+DIMENSIONS = (CONDITIONS, OBSERVATIONS, MEDICATIONS, MAIN_DIAGNOSES)
+
+
+def source_signature():
+    """
+    Modification time and size of the inputs, the cached matrices are only used if it is unchanged.
+    """
+    signature = {"version": MATRIX_VERSION}
+    for path in (RESULT_STORE_FILE, f"{RESULT_STORE_FILE}-wal", COHORT_FILE, MEDICATION_CACHE_FILE):
+        # Opening the result store touches its empty write-ahead log, which is not a change of the results
+        if os.path.exists(path) and (os.path.getsize(path) or path == COHORT_FILE):
+            stat = os.stat(path)
+            signature[path] = [stat.st_mtime_ns, stat.st_size]
+    return json.dumps(signature, sort_keys=True)
+
+
+def read_codes():
+    """
+    Reads the (patient, code) pairs of all resources, one pair per resource and code.
+    :return: Dictionary dimension -> list of (patient, code)
+    """
+    pairs = {dimension: [] for dimension in DIMENSIONS}
+    main_diagnoses_ids = set()
+    for patient, conditions in load_json(COHORT_FILE).items():
+        for condition in conditions:
+            main_diagnoses_ids.add(condition['id'])
+            pairs[MAIN_DIAGNOSES].extend((patient, coding['code']) for coding in condition.get('code', {}).get('coding', [])
+                                         if coding.get('system') == ICD_SYSTEM_NAME and 'code' in coding)
+
+    if not os.path.exists(RESULT_STORE_FILE):
+        print(f"{RESULT_STORE_FILE} does not exist, only the main diagnoses are analysed.\n")
+        return pairs
+
+    medication_placeholders = ', '.join('?' * len(MEDICATION_RESOURCE_TYPES))
+    with closing(sqlite3.connect(f"file:{RESULT_STORE_FILE}?mode=ro", uri=True)) as db:
+        # As in the secondary conditions of the metadata, the main diagnoses are not counted
+        pairs[CONDITIONS] = [(patient, code) for id_, patient, code in
+                             db.execute("SELECT id, patient, code FROM codes WHERE resource_type = 'Condition' "
+                                        "AND system = ?", (ICD_SYSTEM_NAME,))
+                             if id_ not in main_diagnoses_ids]
+        pairs[OBSERVATIONS] = db.execute("SELECT patient, code FROM codes WHERE resource_type = 'Observation' "
+                                         "AND system = ?", (LOINC_SYSTEM_NAME,)).fetchall()
+        pairs[MEDICATIONS] = db.execute(f"SELECT patient, code FROM codes WHERE resource_type IN "
+                                        f"({medication_placeholders}) AND system = ?",
+                                        (*MEDICATION_RESOURCE_TYPES, ATC_SYSTEM_NAME)).fetchall()
+        references = db.execute(f"SELECT patient, medication_reference FROM resources WHERE resource_type IN "
+                                f"({medication_placeholders}) AND medication_reference IS NOT NULL",
+                                MEDICATION_RESOURCE_TYPES).fetchall()
+
+    atc_codes_by_id = load_json(MEDICATION_CACHE_FILE)
+    if references and not atc_codes_by_id:
+        print(f"{len(references)} medication references cannot be resolved without {MEDICATION_CACHE_FILE}, "
+              f"run the extraction again to write it.\n")
+    for patient, reference in references:
+        pairs[MEDICATIONS].extend((patient, code) for code in atc_codes_by_id.get(reference.split('/')[-1], []))
+    return pairs
+
+
+class IncidenceMatrices:
+    """
+    Sparse patient x code matrices of all dimensions, sharing the patient rows.
+    """
+
+    def __init__(self, patients, codes, matrices):
+        """
+        :param patients: Patient references of the rows
+        :param codes: Dictionary dimension -> codes of the columns
+        :param matrices: Dictionary dimension -> CSR matrix of the number of resources per patient and code
+        """
+        self.patients = patients
+        self.codes = codes
+        self.matrices = matrices
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        patients = sorted({patient for dimension_pairs in pairs.values() for patient, _ in dimension_pairs})
+        patient_index = {patient: row for row, patient in enumerate(patients)}
+        codes, matrices = {}, {}
+        for dimension, dimension_pairs in pairs.items():
+            codes[dimension] = sorted({code for _, code in dimension_pairs})
+            code_index = {code: column for column, code in enumerate(codes[dimension])}
+            rows = np.fromiter((patient_index[patient] for patient, _ in dimension_pairs), dtype=np.int64,
+                               count=len(dimension_pairs))
+            columns = np.fromiter((code_index[code] for _, code in dimension_pairs), dtype=np.int64,
+                                  count=len(dimension_pairs))
+            # Duplicate (patient, code) pairs are summed up by the conversion to CSR
+            matrices[dimension] = sparse.coo_matrix((np.ones(len(dimension_pairs), dtype=np.int32), (rows, columns)),
+                                                    shape=(len(patients), len(codes[dimension]))).tocsr()
+        return cls(patients, codes, matrices)
+
+    def save(self, path, signature):
+        arrays = {"signature": np.array(signature), "patients": np.array(self.patients, dtype=str)}
+        for dimension, matrix in self.matrices.items():
+            arrays[f"{dimension}_codes"] = np.array(self.codes[dimension], dtype=str)
+            arrays[f"{dimension}_data"] = matrix.data
+            arrays[f"{dimension}_indices"] = matrix.indices
+            arrays[f"{dimension}_indptr"] = matrix.indptr
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path, signature):
+        """
+        :return: The cached matrices, None if there are none for the signature
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as arrays:
+            if str(arrays["signature"]) != signature:
+                return None
+            patients = arrays["patients"].tolist()
+            codes, matrices = {}, {}
+            for dimension in DIMENSIONS:
+                codes[dimension] = arrays[f"{dimension}_codes"].tolist()
+                matrices[dimension] = sparse.csr_matrix(
+                    (arrays[f"{dimension}_data"], arrays[f"{dimension}_indices"], arrays[f"{dimension}_indptr"]),
+                    shape=(len(patients), len(codes[dimension])))
+        return cls(patients, codes, matrices)
+
+    def group_matrix(self, dimension, groups):
+        """
+        Sparse code x group membership matrix of a dimension.
+        :param groups: Dictionary group name -> codes, None to keep each code as its own group
+        :return: Matrix, group names of the columns
+        """
+        codes = self.codes[dimension]
+        if groups is None:
+            return sparse.identity(len(codes), dtype=np.int32, format='csr'), list(codes)
+        code_index = {code: row for row, code in enumerate(codes)}
+        names = list(groups)
+        # Sets, as a code listed twice in a group must not be counted twice
+        members = [(code_index[code], column) for column, name in enumerate(names)
+                   for code in set(groups[name]) if code in code_index]
+        rows = np.array([row for row, _ in members], dtype=np.int64)
+        columns = np.array([column for _, column in members], dtype=np.int64)
+        return sparse.csr_matrix((np.ones(len(members), dtype=np.int32), (rows, columns)),
+                                 shape=(len(codes), len(names))), names
+
+    def patient_groups(self, dimension, groups=None):
+        """
+        :return: Sparse patient x group matrix of the number of resources per patient and group, group names
+        """
+        membership, names = self.group_matrix(dimension, groups)
+        return self.matrices[dimension] @ membership, names
+
+    def group_counts(self, dimension, groups=None):
+        """
+        :return: Dictionary group -> [number of resources, number of patients]
+        """
+        counts, names = self.patient_groups(dimension, groups)
+        resources = np.asarray(counts.sum(axis=0)).ravel()
+        patients = counts.getnnz(axis=0)
+        return {name: [int(resources[column]), int(patients[column])] for column, name in enumerate(names)}
+
+    def co_occurrence(self, first, first_groups, second, second_groups):
+        """
+        Number of patients with at least one resource of each pair of groups of two dimensions.
+        :return: Dense matrix (groups of first x groups of second), group names of the rows and of the columns
+        """
+        first_counts, first_names = self.patient_groups(first, first_groups)
+        second_counts, second_names = self.patient_groups(second, second_groups)
+        first_presence = (first_counts > 0).astype(np.int32)
+        second_presence = (second_counts > 0).astype(np.int32)
+        return (first_presence.T @ second_presence).toarray(), first_names, second_names
+
+
+def incidence_matrices(rebuild=False):
+    """
+    The incidence matrices of the current results, from MATRIX_CACHE_FILE if the results are unchanged.
+    """
+    signature = source_signature()
+    if not rebuild:
+        cached = IncidenceMatrices.load(MATRIX_CACHE_FILE, signature)
+        if cached is not None:
+            print(f"Incidence matrices loaded from {MATRIX_CACHE_FILE}.\n")
+            return cached
+    matrices = IncidenceMatrices.from_pairs(read_codes())
+    os.makedirs(os.path.dirname(MATRIX_CACHE_FILE), exist_ok=True)
+    matrices.save(MATRIX_CACHE_FILE, signature)
+    print(f"Incidence matrices of {len(matrices.patients)} patients have been saved to {MATRIX_CACHE_FILE}.\n")
+    return matrices
+
+
+def icd_groups():
+    return {group["description"]: group["code"] for group in load_json(ICD_CODE_FILE).get("codes", [])}
+
+
+def main_diagnosis_groups(matrices):
+    """
+    J44.* (COPD) and J45.* (Asthma) groups of the main diagnosis codes.
+    """
+    return {f"{prefix}.*": [code for code in matrices.codes[MAIN_DIAGNOSES] if code.startswith(prefix)]
+            for prefix in ("J44", "J45")}
+
+
+def cross_table(counts, row_names, column_names):
+    """
+    :return: Nested dictionary row -> column -> number of patients, without empty cells
+    """
+    rows, columns = np.nonzero(counts)
+    table = {}
+    for row, column in zip(rows, columns):
+        table.setdefault(row_names[row], {})[column_names[column]] = int(counts[row, column])
+    return table
+
+
+def main(rebuild=False):
+    matrices = incidence_matrices(rebuild)
+    diagnosis_groups = main_diagnosis_groups(matrices)
+    results = {
+        "patient_count": len(matrices.patients),
+        "secondary_condition_groups_x_medications": cross_table(
+            *matrices.co_occurrence(CONDITIONS, icd_groups(), MEDICATIONS, None)),
+        "observation_groups_x_main_diagnosis_groups": cross_table(
+            *matrices.co_occurrence(OBSERVATIONS, OBSERVATION_GROUPS, MAIN_DIAGNOSES, diagnosis_groups)),
+        "secondary_condition_groups_x_main_diagnosis_groups": cross_table(
+            *matrices.co_occurrence(CONDITIONS, icd_groups(), MAIN_DIAGNOSES, diagnosis_groups)),
+        # [number of resources, number of patients] per group
+        "secondary_condition_group_counts": matrices.group_counts(CONDITIONS, icd_groups()),
+        "observation_group_counts": matrices.group_counts(OBSERVATIONS, OBSERVATION_GROUPS),
+        "main_diagnosis_group_counts": matrices.group_counts(MAIN_DIAGNOSES, diagnosis_groups),
+    }
+    with open(CO_OCCURRENCE_FILE, 'w') as file:
+        json.dump(results, file, indent=4)
+    print(f"Co-occurrences have been saved to {CO_OCCURRENCE_FILE}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-tabulates the extracted results of the cohort patients.")
+    parser.add_argument("--rebuild", action="store_true", help="Build the incidence matrices even if cached")
+    main(parser.parse_args().rebuild)
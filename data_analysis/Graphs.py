@@ -1,64 +1,35 @@
+import argparse
+import hashlib
 import json
 import os
 from collections import defaultdict
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 
-def load_json(filepath):
-    """Loads json file"""
-    if os.path.exists(filepath):
-        with open(filepath, 'r') as file:
-            return json.load(file)
-    return {}
+import matplotlib
 
-def create_bar_graph(bar_type, keys, values, title, xlabel, ylabel, add_exact_count_labels, filename):
-    """Create a bar (or horizontal) graph."""
-    plt.figure(figsize=(12, 8))
-    if bar_type == 'horizontal':
-        bars = plt.barh(keys, values, color='skyblue')
-        plt.grid(axis='x', linestyle='--', alpha=0.7)
+matplotlib.use("Agg")  # Headless, the charts are only written to files
+from matplotlib.figure import Figure
 
-    else:
-        bars = plt.bar(keys, values, color='skyblue')
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-        plt.xticks(rotation=45, ha='right')
+"""
+Bar charts of the metadata of an extraction run (fhir_results/metadata.json). The data of every chart is computed
+first, then the charts are rendered in parallel in a process pool with the object-oriented matplotlib API, without
+any global pyplot state. The hash of the data of each chart is kept in graphs/.render_hashes.json, a chart is only
+rendered again if its data changed or its file is missing.
+Usage: python data_analysis/Graphs.py [--force]
+"""
 
-    # Graph titles and labels
-    plt.title(title, fontsize=14)
-    plt.xlabel(xlabel, fontsize=12)
-    plt.ylabel(ylabel, fontsize=12)
+GRAPHS_FOLDER = "graphs"
+RENDER_HASHES_FILE = ".render_hashes.json"
+RENDER_VERSION = 1  # Part of the hashes, to be increased when the rendering itself changes
 
-    # Adds exact count of each bar to view
-    if add_exact_count_labels:
-        for bar in bars:
-            plt.text(bar.get_x() + bar.get_width() / 2, bar.get_height() + 0.05 * bar.get_height(), f'{bar.get_height():,}',  ha='center', va='bottom')
-
-    plt.tight_layout()
-    os.makedirs('graphs', exist_ok=True)
-    save_path = os.path.join('graphs', filename)
-    plt.savefig(save_path, format='png')
-
-meta_data = load_json("fhir_results/metadata.json")
-
-#Add other type of medication resources if you have other sources...
-data_overview = {
-    "Asthma & COPD Patient Count": meta_data['asthma_and_copd_patient_count'],
-    "Patients with Chief Complaint": meta_data['asthma_and_copd_patients_with_chief_complaint'],
-    "Patients with Secondary Conditions": meta_data['patient_count_with_secondary_conditions'],
-    "Patients with Observations": meta_data['patient_count_with_observations'],
-    "Patients with MedicationAdministrations": meta_data['patient_count_with_medicationAdministrations']
-}
-main_diagnosis_counts = meta_data['main_diagnosis_counts']
-secondary_conditions_counts = meta_data['secondary_conditions_counts']
-observations_counts = meta_data['observations_counts']
-
-#Only creating medication administration graph, you can add other type of medication as well!
-medications_exist = False
-if meta_data.get('medicationAdministrations_counts', {}).get('MedicationAdministration', {}).get('counting', {}).get('details_count', []):
-    medications_exist = True
-    medications_counts = {list(item.keys())[0]: list(item.values())[0] for item in meta_data['medicationAdministrations_counts']['MedicationAdministration']['counting']['details_count']}
-
-print(medications_counts)
-group_observation = {"Allergiediagnostik":[
+# Metadata names of the medication resource types, the MedicationAdministration chart was the only one before
+MEDICATION_CHARTS = [
+    ("MedicationAdministration", "medicationAdministrations"),
+    ("MedicationRequest", "medicationRequests"),
+    ("MedicationStatement", "medicationStatements"),
+]
+
+OBSERVATION_GROUPS = {"Allergiediagnostik":[
     "23800-6",
     "15234-8",
     "31004-5",
@@ -115,35 +86,174 @@ group_observation = {"Allergiediagnostik":[
     "Autoimmundiagnostik":["5128-4", "29953-7","53027-9"]}
 
 
-# Calculate group total counts for secondary conditions
-icd_codes = load_json("input_files/icd_codes.json")
-secondary_conditions_groups_sums = defaultdict(int)
-for group in icd_codes["codes"]:
-    group_sum = sum(secondary_conditions_counts.get(code, 0) for code in group["code"])
-    secondary_conditions_groups_sums[group["description"]] = group_sum
-
-#Calculate group and individual total counts of Main Diagnoses COPD vs Asthma
-main_diagnosis_group_sums = defaultdict(int)
-main_diagnosis_individual_sums = defaultdict(int)
-for code, count in main_diagnosis_counts.items():
-    main_diagnosis_individual_sums[code] = count
-    if code.startswith("J44"):
-        main_diagnosis_group_sums["J44.*"] += count
-    elif code.startswith("J45"):
-        main_diagnosis_group_sums["J45.*"] += count
-
-#Calculate group total for observation counts
-observations_groups_sums = defaultdict(int)
-for group, codes in group_observation.items():
-    observations_groups_sums[group] = sum(observations_counts.get(code, 0) for code in codes)
-
-# Plot the graphs
-create_bar_graph('vertical', data_overview.keys(), data_overview.values(), 'Data Overview', '', '', True, "dataOverview.png")
-create_bar_graph('horizontal', secondary_conditions_groups_sums.keys(), secondary_conditions_groups_sums.values(), 'Secondary Condition Groups Counts', 'Total Count', 'Condition Groups', False, "secondaryConditions.png")
-create_bar_graph('vertical', main_diagnosis_group_sums.keys(), main_diagnosis_group_sums.values(), 'Count of Main Diagnoses COPD vs Asthma', 'Main Diagnosis Groups', 'Total Count', False, "mainDiagnosisGroups.png")
-create_bar_graph('vertical', main_diagnosis_individual_sums.keys(), main_diagnosis_individual_sums.values(), 'Main Diagnosis', 'Main Diagnosis', 'Total Count', False, "mainDiagnosis.png")
-create_bar_graph('vertical', observations_groups_sums.keys(), observations_groups_sums.values(), 'Observation Group Counts', 'Observation Groups', 'Total Count', False, "observationGroups.png")
-if medications_exist:
-    create_bar_graph('vertical', medications_counts.keys(), medications_counts.values(), 'MedicationAdministrations', 'Medications', 'Total Count', False, "medicationAdministrations.png")
+def load_json(filepath):
+    """Loads json file"""
+    if os.path.exists(filepath):
+        with open(filepath, 'r') as file:
+            return json.load(file)
+    return {}
+
+
+def create_bar_graph(bar_type, keys, values, title, xlabel, ylabel, add_exact_count_labels, save_path):
+    """Create a bar (or horizontal) graph and save it as png."""
+    figure = Figure(figsize=(12, 8))
+    axes = figure.subplots()
+    if bar_type == 'horizontal':
+        bars = axes.barh(keys, values, color='skyblue')
+        axes.grid(axis='x', linestyle='--', alpha=0.7)
+
+    else:
+        bars = axes.bar(keys, values, color='skyblue')
+        axes.grid(axis='y', linestyle='--', alpha=0.7)
+        axes.tick_params(axis='x', labelrotation=45)
+        for label in axes.get_xticklabels():
+            label.set_horizontalalignment('right')
+
+    # Graph titles and labels
+    axes.set_title(title, fontsize=14)
+    axes.set_xlabel(xlabel, fontsize=12)
+    axes.set_ylabel(ylabel, fontsize=12)
+
+    # Adds exact count of each bar to view
+    if add_exact_count_labels:
+        for bar in bars:
+            axes.text(bar.get_x() + bar.get_width() / 2, bar.get_height() + 0.05 * bar.get_height(), f'{bar.get_height():,}',  ha='center', va='bottom')
+
+    figure.tight_layout()
+    figure.savefig(save_path, format='png')
+
+
+def medication_counts(meta_data, resource_type, metadata_name):
+    """
+    :return: Dictionary ATC code -> count of the medication resources of the type, empty if there are none
+    """
+    details = meta_data.get(f'{metadata_name}_counts', {}).get(resource_type, {}).get('counting', {}).get('details_count', [])
+    return {code: count for item in details for code, count in item.items()}
+
+
+def chart_specs(meta_data, icd_codes):
+    """
+    Computes the data of all charts.
+    :param meta_data: Content of metadata.json
+    :param icd_codes: Content of icd_codes.json, for the groups of the secondary conditions
+    :return: List of dictionaries with the arguments of create_bar_graph, by file name
+    """
+    #Add other type of medication resources if you have other sources...
+    data_overview = {
+        "Asthma & COPD Patient Count": meta_data.get('asthma_and_copd_patient_count', 0),
+        "Patients with Chief Complaint": meta_data.get('asthma_and_copd_patients_with_chief_complaint', 0),
+        "Patients with Secondary Conditions": meta_data.get('patient_count_with_secondary_conditions', 0),
+        "Patients with Observations": meta_data.get('patient_count_with_observations', 0),
+    }
+    for resource_type, metadata_name in MEDICATION_CHARTS:
+        data_overview[f"Patients with {resource_type}s"] = meta_data.get(f'patient_count_with_{metadata_name}', 0)
+    main_diagnosis_counts = meta_data.get('main_diagnosis_counts', {})
+    secondary_conditions_counts = meta_data.get('secondary_conditions_counts', {})
+    observations_counts = meta_data.get('observations_counts', {})
+
+    # Calculate group total counts for secondary conditions
+    secondary_conditions_groups_sums = defaultdict(int)
+    for group in icd_codes.get("codes", []):
+        group_sum = sum(secondary_conditions_counts.get(code, 0) for code in group["code"])
+        secondary_conditions_groups_sums[group["description"]] = group_sum
+
+    #Calculate group and individual total counts of Main Diagnoses COPD vs Asthma
+    main_diagnosis_group_sums = defaultdict(int)
+    main_diagnosis_individual_sums = defaultdict(int)
+    for code, count in main_diagnosis_counts.items():
+        main_diagnosis_individual_sums[code] = count
+        if code.startswith("J44"):
+            main_diagnosis_group_sums["J44.*"] += count
+        elif code.startswith("J45"):
+            main_diagnosis_group_sums["J45.*"] += count
+
+    #Calculate group total for observation counts
+    observations_groups_sums = defaultdict(int)
+    for group, codes in OBSERVATION_GROUPS.items():
+        observations_groups_sums[group] = sum(observations_counts.get(code, 0) for code in codes)
+
+    def spec(bar_type, counts, title, xlabel, ylabel, add_exact_count_labels, filename):
+        return {"bar_type": bar_type, "keys": list(counts.keys()), "values": list(counts.values()), "title": title,
+                "xlabel": xlabel, "ylabel": ylabel, "add_exact_count_labels": add_exact_count_labels,
+                "filename": filename}
+
+    specs = [
+        spec('vertical', data_overview, 'Data Overview', '', '', True, "dataOverview.png"),
+        spec('horizontal', secondary_conditions_groups_sums, 'Secondary Condition Groups Counts', 'Total Count', 'Condition Groups', False, "secondaryConditions.png"),
+        spec('vertical', main_diagnosis_group_sums, 'Count of Main Diagnoses COPD vs Asthma', 'Main Diagnosis Groups', 'Total Count', False, "mainDiagnosisGroups.png"),
+        spec('vertical', main_diagnosis_individual_sums, 'Main Diagnosis', 'Main Diagnosis', 'Total Count', False, "mainDiagnosis.png"),
+        spec('vertical', observations_groups_sums, 'Observation Group Counts', 'Observation Groups', 'Total Count', False, "observationGroups.png"),
+    ]
+    # A medication chart is only drawn if the run found medications of the type
+    for resource_type, metadata_name in MEDICATION_CHARTS:
+        counts = medication_counts(meta_data, resource_type, metadata_name)
+        if counts:
+            specs.append(spec('vertical', counts, f'{resource_type}s', 'Medications', 'Total Count', False, f"{metadata_name}.png"))
+    return specs
+
+
+def spec_hash(spec):
+    """
+    Hash of the data and the labels of a chart.
+    """
+    content = json.dumps({"version": RENDER_VERSION, "spec": spec}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def render_chart(spec, output_folder):
+    """
+    Renders one chart, runs in a worker process.
+    :return: File name of the chart
+    """
+    arguments = {name: value for name, value in spec.items() if name != "filename"}
+    create_bar_graph(save_path=os.path.join(output_folder, spec["filename"]), **arguments)
+    return spec["filename"]
+
+
+def render_charts(specs, output_folder=GRAPHS_FOLDER, max_workers=None, force=False):
+    """
+    Renders the charts whose data changed since their last rendering, in parallel.
+    :param specs: Charts of chart_specs
+    :param max_workers: Number of worker processes, number of CPUs if not given
+    :param force: Renders all charts, regardless of their hashes
+    :return: File names of the rendered charts
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    hashes_path = os.path.join(output_folder, RENDER_HASHES_FILE)
+    hashes = {} if force else load_json(hashes_path)
+
+    pending = [spec for spec in specs
+               if hashes.get(spec["filename"]) != spec_hash(spec)
+               or not os.path.exists(os.path.join(output_folder, spec["filename"]))]
+    print(f"Rendering {len(pending)} of {len(specs)} charts, the others are unchanged.\n")
+
+    rendered = []
+    if len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=min(max_workers or os.cpu_count(), len(pending))) as executor:
+            rendered = list(executor.map(render_chart, pending, [output_folder] * len(pending)))
+    elif pending:
+        rendered = [render_chart(pending[0], output_folder)]
+
+    # Not reached if a chart failed, all pending charts are rendered again the next time
+    for spec in pending:
+        hashes[spec["filename"]] = spec_hash(spec)
+    with open(hashes_path, 'w') as file:
+        json.dump(hashes, file, indent=4)
+    return rendered
+
+
+def main(metadata_file="fhir_results/metadata.json", icd_code_file="input_files/icd_codes.json",
+         output_folder=GRAPHS_FOLDER, max_workers=None, force=False):
+    specs = chart_specs(load_json(metadata_file), load_json(icd_code_file))
+    rendered = render_charts(specs, output_folder, max_workers, force)
+    print(f"Charts have been saved to {output_folder}: {', '.join(rendered) or 'none changed'}")
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Renders the charts of the metadata of an extraction run.")
+    parser.add_argument("--metadata", default="fhir_results/metadata.json")
+    parser.add_argument("--output", default=GRAPHS_FOLDER)
+    parser.add_argument("--workers", type=int, default=None, help="Number of rendering processes")
+    parser.add_argument("--force", action="store_true", help="Render all charts, even unchanged ones")
+    args = parser.parse_args()
+    main(args.metadata, output_folder=args.output, max_workers=args.workers, force=args.force)
@@ -0,0 +1,109 @@
+import json
+from functools import lru_cache
+
+from Constants import ICD_SYSTEM_NAME, LOINC_SYSTEM_NAME, ATC_SYSTEM_NAME
+
+"""
+Code lists of the input files, loaded once per process. Every list keeps the file order for building queries,
+a frozen set for membership checks and a prefix trie for hierarchy queries: ICD-10-GM (J44 -> J44.0 -> J44.00)
+and ATC (R03 -> R03B -> R03BA -> R03BA01) codes are below their parents by prefix.
+"""
+
+_END = None  # Trie key marking a listed code
+
+
+class CodeList:
+    """
+    Immutable, indexed code list of one code system.
+    """
+
+    def __init__(self, system, codes):
+        self.system = system
+        self.codes = tuple(dict.fromkeys(codes))
+        self.code_set = frozenset(self.codes)
+        self._trie = {}
+        for code in self.codes:
+            node = self._trie
+            for char in code:
+                node = node.setdefault(char, {})
+            node[_END] = code
+
+    def __contains__(self, code):
+        return code in self.code_set
+
+    def __iter__(self):
+        return iter(self.codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def below(self, prefix):
+        """
+        Listed codes in the hierarchy below the prefix, the prefix itself included. E.g. "J44" -> J44, J44.0, ...
+        """
+        node = self._trie
+        for char in prefix:
+            if char not in node:
+                return []
+            node = node[char]
+        codes, stack = [], [node]
+        while stack:
+            node = stack.pop()
+            for key, child in node.items():
+                if key is _END:
+                    codes.append(child)
+                else:
+                    stack.append(child)
+        return sorted(codes)
+
+    def ancestor(self, code):
+        """
+        Most general listed code the code is below (the code itself if nothing above it is listed), or None.
+        E.g. "R03BA01" -> "R03" if R03 is listed.
+        """
+        node = self._trie
+        for char in code:
+            if char not in node:
+                return None
+            node = node[char]
+            if _END in node:
+                return node[_END]
+        return None
+
+    def covers(self, code):
+        """
+        True if the code or one of its parents is listed.
+        """
+        return self.ancestor(code) is not None
+
+    def below_search_groups(self):
+        """
+        Splits the list for ":below" searches. Listed codes with listed children become ":below" roots,
+        covering their whole subtree, the remaining codes are searched exactly.
+        :return: (codes for ":below" search, codes for exact search)
+        """
+        roots = [code for code in self.codes if self.ancestor(code) == code and len(self.below(code)) > 1]
+        root_set = set(roots)
+        exact = [code for code in self.codes if self.ancestor(code) not in root_set]
+        return roots, exact
+
+
+@lru_cache(maxsize=None)
+def load_code_list(filename):
+    """
+    Reads the code file once per process.
+    :param filename: input file of code list
+    :return: CodeList of the file
+    """
+    with open(filename, "r") as fp:
+        lines = json.load(fp)
+
+    if 'loinc_codes' in filename:
+        return CodeList(LOINC_SYSTEM_NAME, [item['code'] for item in lines['codes']])
+    elif 'asthma_copd_codes' in filename:
+        return CodeList(ICD_SYSTEM_NAME, [item['code'] for item in lines['codes']])
+    elif 'icd_codes' in filename:
+        return CodeList(ICD_SYSTEM_NAME, [code for item in lines['codes'] for code in item['code']])
+    elif 'atc_codes' in filename:
+        return CodeList(ATC_SYSTEM_NAME, [code['code'] for code in lines])
+    raise ValueError(f"Unknown code file {filename}")
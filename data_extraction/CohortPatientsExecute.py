@@ -3,6 +3,9 @@ import logging
 from Constants import USER_NAME, USER_PASSWORD
 from FhirHelpersUtils import connect_to_server
 from FhirHelpersCohortExtraction import patients_with_asthma_copd, filter_main_diagnosis
+from Metadata import gather_metadata
+from Sharding import SHARD_METADATA_NAME, format_shard, shard_argument_parser
+from Telemetry import telemetry
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
 
@@ -13,17 +16,26 @@ HauptDiagnoses are flagged as "CC" (Chief Complaints") in Encounter.Diagnosis.
 Results are saved in "patient_results.txt"
 """
 
-def main():
+def main(shard=None):
+    """
+    :param shard: (i, N) to process only shard i of N of the cohort, see Sharding
+    """
     smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
+    if shard is not None:
+        gather_metadata(SHARD_METADATA_NAME, format_shard(shard))
 
     #Get the patients with "ANY TYPE OF DIAGNOSED" Asthma or COPD.
-    patients_with_asthma_copd(smart)
+    patients_with_asthma_copd(smart, shard)
 
     #Filter the patients for only "MAIN DIAGNOSED" Asthma or COPD.
     filter_main_diagnosis(smart)
 
 if __name__ == "__main__":
-    main()
+    args = shard_argument_parser("Creates the list of cohort patients.").parse_args()
+    try:
+        main(args.shard)
+    finally:
+        telemetry.write_profile("CohortPatientsExecute")
 
 
 
@@ -0,0 +1,122 @@
+import threading
+import time
+
+from Constants import ADAPTIVE_CONCURRENCY, CONCURRENCY_INITIAL, CONCURRENCY_MIN, CONCURRENCY_MAX, \
+    CONCURRENCY_LATENCY_TOLERANCE, CONCURRENCY_DECREASE_FACTOR, MAX_REQUESTS_PER_SECOND
+from Telemetry import telemetry
+
+"""
+Limits of the requests to the FHIR server, applied by call_with_retry to every request of all workers.
+With ADAPTIVE_CONCURRENCY, the number of requests in flight is adapted to what the server sustains (AIMD): the limit
+grows by one per limit successful requests while their latency stays within CONCURRENCY_LATENCY_TOLERANCE times the
+lowest latency seen, and is multiplied by CONCURRENCY_DECREASE_FACTOR on timeouts, connection errors, 429 and 5xx.
+MAX_REQUESTS_PER_SECOND caps the request rate with a token bucket, for servers shared with clinical systems.
+"""
+
+DECREASE_INTERVAL = 1.0  # Minimum seconds between two decreases of the limit
+
+
+class AdaptiveLimiter:
+    """
+    Semaphore with an additive increase/multiplicative decrease limit of requests in flight.
+    """
+
+    def __init__(self, initial, minimum, maximum, latency_tolerance, decrease_factor):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self._latency = None  # Exponentially smoothed latency of successful requests
+        self._baseline = None  # Lowest smoothed latency, the latency of the unloaded server
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, seconds, overloaded=False):
+        """
+        :param seconds: Latency of the request
+        :param overloaded: The request failed with a sign of an overloaded server
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if overloaded:
+                self._decrease()
+            elif seconds is not None:
+                self._increase(seconds)
+            self._condition.notify_all()
+
+    def _increase(self, seconds):
+        self._latency = seconds if self._latency is None else 0.9 * self._latency + 0.1 * seconds
+        self._baseline = self._latency if self._baseline is None else min(self._baseline, self._latency)
+        if self._latency <= self.latency_tolerance * self._baseline and self.limit < self.maximum:
+            previous = int(self.limit)
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if int(self.limit) != previous:
+                telemetry.record_concurrency_limit(int(self.limit))
+
+    def _decrease(self):
+        # The requests in flight when the server got overloaded fail together, they count as one decrease
+        now = time.monotonic()
+        if now - self._last_decrease < max(DECREASE_INTERVAL, self._latency or 0.0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * self.decrease_factor)
+        telemetry.record_concurrency_limit(int(self.limit), decreased=True)
+        print(f"Server overloaded, reducing the concurrent requests to {int(self.limit)}.\n")
+
+
+class TokenBucket:
+    """
+    Thread-safe requests per second cap allowing bursts of up to one second of requests.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token, tokens not yet available are taken in advance.
+        :return: Seconds to wait before sending the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+
+adaptive_limiter = AdaptiveLimiter(CONCURRENCY_INITIAL, CONCURRENCY_MIN, CONCURRENCY_MAX,
+                                   CONCURRENCY_LATENCY_TOLERANCE, CONCURRENCY_DECREASE_FACTOR) \
+    if ADAPTIVE_CONCURRENCY else None
+rate_limiter = TokenBucket(MAX_REQUESTS_PER_SECOND) if MAX_REQUESTS_PER_SECOND > 0 else None
+
+
+def acquire_request_slot():
+    """
+    Waits until the request may be sent under the rate cap and the concurrency limit.
+    """
+    if rate_limiter is not None:
+        time.sleep(rate_limiter.reserve())
+    if adaptive_limiter is not None:
+        adaptive_limiter.acquire()
+
+
+def release_request_slot(seconds, overloaded=False):
+    """
+    :param seconds: Latency of the request, None if it failed
+    :param overloaded: The request failed with a sign of an overloaded server
+    """
+    if adaptive_limiter is not None:
+        adaptive_limiter.release(seconds, overloaded)
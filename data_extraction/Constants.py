@@ -10,4 +10,49 @@ ASTHMA_COPD_CODES_FILE = "input_files/asthma_copd_codes.json"
 ICD_SYSTEM_NAME = 'http://fhir.de/CodeSystem/bfarm/icd-10-gm'
 LOINC_SYSTEM_NAME = 'http://loinc.org'
 ATC_SYSTEM_NAME = "http://fhir.de/CodeSystem/bfarm/atc"
-MAX_WORKERS = min(32, (os.cpu_count() or 1) * 5)
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() == "true"  # Adapt the concurrent requests to the latency and errors of the server instead of the CPU count
+CONCURRENCY_INITIAL = int(os.getenv("CONCURRENCY_INITIAL", 8))  # Concurrent requests at the start with ADAPTIVE_CONCURRENCY
+CONCURRENCY_MIN = int(os.getenv("CONCURRENCY_MIN", 1))
+CONCURRENCY_MAX = int(os.getenv("CONCURRENCY_MAX", 64))  # Also the size of the worker pools with ADAPTIVE_CONCURRENCY
+CONCURRENCY_LATENCY_TOLERANCE = float(os.getenv("CONCURRENCY_LATENCY_TOLERANCE", 2.0))  # The limit only grows while the latency is below this multiple of the lowest latency
+CONCURRENCY_DECREASE_FACTOR = float(os.getenv("CONCURRENCY_DECREASE_FACTOR", 0.5))  # The limit is multiplied by it on timeouts, 429 and 5xx
+MAX_REQUESTS_PER_SECOND = float(os.getenv("MAX_REQUESTS_PER_SECOND", 0))  # Cap of the request rate of the process, 0 for none
+MAX_WORKERS = CONCURRENCY_MAX if ADAPTIVE_CONCURRENCY else min(32, (os.cpu_count() or 1) * 5)
+MAIN_DIAGNOSIS_RESOLUTION = os.getenv("MAIN_DIAGNOSIS_RESOLUTION", "bulk")  # "bulk" or "single" (one Encounter search per Condition)
+ENCOUNTER_DIAGNOSIS_CHUNK_SIZE = int(os.getenv("ENCOUNTER_DIAGNOSIS_CHUNK_SIZE", 50))  # Maximum Conditions per Encounter search
+MAX_URL_LENGTH = int(os.getenv("MAX_URL_LENGTH", 2048))  # URL length limit of the FHIR server, used for sizing code chunks
+DISCOVERY_MAX_PARALLEL = int(os.getenv("DISCOVERY_MAX_PARALLEL", 8))
+EXTRACTION_ENGINE = os.getenv("EXTRACTION_ENGINE", "threads")  # "threads" (ThreadPoolExecutor) or "asyncio"
+ASYNC_MAX_CONCURRENCY = int(os.getenv("ASYNC_MAX_CONCURRENCY", 200))  # Requests in flight for the asyncio engine
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 8))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 1.0))  # Seconds, doubled per attempt
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 60.0))
+CIRCUIT_BREAKER_WINDOW = int(os.getenv("CIRCUIT_BREAKER_WINDOW", 50))  # Number of last requests the error rate is taken from
+CIRCUIT_BREAKER_ERROR_RATE = float(os.getenv("CIRCUIT_BREAKER_ERROR_RATE", 0.5))
+CIRCUIT_BREAKER_PAUSE = float(os.getenv("CIRCUIT_BREAKER_PAUSE", 30.0))  # Seconds all workers pause when the breaker opens
+FAILED_QUERIES_FILE = "fhir_results/failed_queries.ndjson"
+USE_BELOW_SEARCH = os.getenv("USE_BELOW_SEARCH", "false").lower() == "true"  # Collapse ICD/ATC hierarchies into ":below" searches, if the server supports it
+MEDICATION_CACHE_FILE = os.getenv("MEDICATION_CACHE_FILE", "fhir_results/medication_atc_cache.json")
+PERSIST_MEDICATION_CACHE = os.getenv("PERSIST_MEDICATION_CACHE", "false").lower() == "true"  # Keep resolved Medication ATC codes across runs
+RESULT_FORMAT = os.getenv("RESULT_FORMAT", "json")  # Per-patient result files: "json", "ndjson" or "ndjson.gz"
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "search")  # "search" (per-patient searches), "batch" (FHIR batch Bundles per patient group) or "bulk_export" (FHIR Bulk Data $export)
+BULK_EXPORT_GROUP_ID = os.getenv("BULK_EXPORT_GROUP_ID")  # Group/[id]/$export of the cohort group, Patient/$export if not set
+BULK_EXPORT_POLL_INTERVAL = float(os.getenv("BULK_EXPORT_POLL_INTERVAL", 10.0))  # Seconds between status requests without Retry-After
+BULK_EXPORT_FOLDER = "fhir_results/bulk_export"
+BULK_EXPORT_SPOOL_BUFFER = int(os.getenv("BULK_EXPORT_SPOOL_BUFFER", 50000))  # Resources buffered before they are inserted into the result store
+INCREMENTAL_REFRESH = os.getenv("INCREMENTAL_REFRESH", "false").lower() == "true"  # Only fetch resources updated since the last completed run
+CHECKPOINTING = os.getenv("CHECKPOINTING", str(INCREMENTAL_REFRESH)).lower() == "true"  # Record finished work in RUN_STATE_FILE, so an interrupted run resumes, by default only with INCREMENTAL_REFRESH
+RUN_STATE_FILE = "fhir_results/run_state.sqlite"
+RESULT_STORE_FILE = "fhir_results/results.sqlite"
+KEEP_RESULT_FILES = os.getenv("KEEP_RESULT_FILES", "true").lower() == "true"  # Also write the per-patient result files, false keeps the results only in RESULT_STORE_FILE
+RECOMPUTE_FREQUENCIES = os.getenv("RECOMPUTE_FREQUENCIES", "false").lower() == "true"  # Compute the frequencies from the result store after the run instead of while fetching
+RUN_PROFILE_FILE = "fhir_results/run_profile.json"
+SHOW_PROGRESS = os.getenv("SHOW_PROGRESS", "false").lower() == "true"  # Print a progress line with ETA while fetching
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", 10.0))  # Seconds between progress lines
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "off")  # "off", "revalidate" (conditional requests for cached responses) or "offline" (only replay cached responses)
+RESPONSE_CACHE_FILE = os.getenv("RESPONSE_CACHE_FILE", "fhir_results/response_cache.sqlite")
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", 2048))  # Least recently used responses are evicted beyond this size
+BATCH_PATIENTS = int(os.getenv("BATCH_PATIENTS", 10))  # Patients per batch group with EXTRACTION_MODE=batch
+BATCH_MAX_ENTRIES = int(os.getenv("BATCH_MAX_ENTRIES", 100))  # Searches per batch Bundle, larger groups are sent as several Bundles
+FULL_RESOURCES = os.getenv("FULL_RESOURCES", "false").lower() == "true"  # Fetch complete resources instead of only the elements the analysis reads (_elements)
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 1000))  # Items waiting between two stages of PipelineExecute before the earlier stage blocks
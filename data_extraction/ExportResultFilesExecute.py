@@ -0,0 +1,28 @@
+import logging
+
+from fhirclient.models.condition import Condition
+from fhirclient.models.medicationadministration import MedicationAdministration
+from fhirclient.models.medicationrequest import MedicationRequest
+from fhirclient.models.medicationstatement import MedicationStatement
+from fhirclient.models.observation import Observation
+
+from ResultStore import export_result_files
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+"""
+This script writes the resources of the result store back into the per-patient result files under fhir_results
+(LOINC, ICD, ATC/*), in the layout of earlier versions and in RESULT_FORMAT.
+"""
+
+
+def main():
+    logging.info("Start...")
+    sources = {source.resource_type: source for source in
+               [Observation, Condition, MedicationAdministration, MedicationRequest, MedicationStatement]}
+    count = export_result_files(sources)
+    logging.info(f"{count} result files written.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import json
 import logging
+from functools import partial
 
 from fhirclient.models.condition import Condition
 from fhirclient.models.medicationadministration import MedicationAdministration
@@ -7,11 +8,15 @@ from fhirclient.models.medicationrequest import MedicationRequest
 from fhirclient.models.medicationstatement import MedicationStatement
 from fhirclient.models.observation import Observation
 
-from Constants import ICD_CODE_FILE, LOINC_CODE_FILE, ATC_CODE_FILE
-from FhirHelpersResourceExtraction import (execute_thread_for_fetching, observations, conditions, medications,
-                                           observation_frequencies, secondary_conditions_frequencies,
-                                           medication_frequencies)
-from Metadata import gather_metadata
+from Constants import ICD_CODE_FILE, LOINC_CODE_FILE, ATC_CODE_FILE, EXTRACTION_ENGINE, EXTRACTION_MODE, \
+    RECOMPUTE_FREQUENCIES
+from FhirHelpersResourceExtraction import (execute_thread_for_fetching, iter_observations, iter_conditions,
+                                           iter_medications, observation_frequencies, secondary_conditions_frequencies,
+                                           medication_frequencies, frequency_aggregator, aggregated_metadata,
+                                           begin_extraction_run, finish_extraction_run)
+from Metadata import gather_metadata, update_metadata
+from Sharding import SHARD_METADATA_NAME, format_shard, in_shard, shard_argument_parser
+from Telemetry import telemetry
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
 
@@ -21,18 +26,68 @@ based on LOINC, ICD, ATC Codes respectively for each Cohort patient. It shows th
 i.e., counting them. It also fetches the resources and save them in output files for each patient separately.
 """
 
+# Extracted resource types: code file, Fhir resource model, code type
+EXTRACTION_PLAN = [
+    (LOINC_CODE_FILE, Observation, "LOINC"),
+    (ICD_CODE_FILE, Condition, "ICD"),
+    (ATC_CODE_FILE, MedicationAdministration, "ATC"),
+    (ATC_CODE_FILE, MedicationRequest, "ATC"),
+    (ATC_CODE_FILE, MedicationStatement, "ATC"),
+]
 
-def main():
+
+def main(shard=None):
+    """
+    :param shard: (i, N) to process only shard i of N of the cohort, see Sharding
+    """
     logging.info("Start...")
     #Input is the patient list in a text file from Cohort Data Extraction part
     with open("patients_main_diagnosed_asthma_copd.json", "r") as file:
         input_file = json.load(file)
-        patients = [patient for patient in input_file.keys()]
+        patients = [patient for patient in input_file.keys() if in_shard(patient, shard)]
+    if shard is not None:
+        gather_metadata(SHARD_METADATA_NAME, format_shard(shard))
+        print(f"Shard {format_shard(shard)} with {len(patients)} patients.\n")
+
+    if EXTRACTION_MODE == "bulk_export":
+        bulk_export_main(patients)
+        return
+
+    if EXTRACTION_MODE == "batch":
+        from FhirHelpersBatchExtraction import execute_batch_for_fetching
+
+        # All resource types of a group of patients are fetched with one batch request
+        aggregators = [(code_file, source, code_type, frequency_aggregator(code_file, source, code_type))
+                       for code_file, source, code_type in EXTRACTION_PLAN]
+        execute_batch_for_fetching(patients, aggregators)
+        post_process(aggregators)
+        return
+
+    extraction_run = None
+    if EXTRACTION_ENGINE == "asyncio":
+        from FhirHelpersAsyncExtraction import (execute_async_for_fetching, observations_async, conditions_async,
+                                                medications_async)
+        execute, fetch_observations, fetch_conditions, fetch_medications = (
+            execute_async_for_fetching, observations_async, conditions_async, medications_async)
+    else:
+        # One checkpointed run over all resource types, a restart skips the types completed before
+        extraction_run = begin_extraction_run(EXTRACTION_PLAN)
+        execute, fetch_observations, fetch_conditions, fetch_medications = (
+            partial(execute_thread_for_fetching, extraction_run=extraction_run), iter_observations, iter_conditions,
+            iter_medications)
+
+    # The frequencies are counted while the resources are fetched
+    aggregators = []
+
+    def run(code_file, source, code_type, function_to_run):
+        aggregator = frequency_aggregator(code_file, source, code_type)
+        execute(code_file, source, patients, code_type, function_to_run, aggregator)
+        aggregators.append((code_file, source, code_type, aggregator))
 
     ####Observations####
-    execute_thread_for_fetching(LOINC_CODE_FILE, Observation, patients, "LOINC", observations)
+    run(LOINC_CODE_FILE, Observation, "LOINC", fetch_observations)
     ####Conditions#####
-    execute_thread_for_fetching(ICD_CODE_FILE, Condition, patients, "ICD", conditions)
+    run(ICD_CODE_FILE, Condition, "ICD", fetch_conditions)
     ##Medications####
     medication_profiles = {
         'MedicationAdministration': MedicationAdministration,
@@ -41,7 +96,41 @@ def main():
     }
 
     for profile in medication_profiles.values():
-        execute_thread_for_fetching(ATC_CODE_FILE, profile, patients, "ATC", medications)
+        run(ATC_CODE_FILE, profile, "ATC", fetch_medications)
+
+    finish_extraction_run(extraction_run)
+    post_process(aggregators)
+
+def post_process(aggregators):
+    """ Post processing: Analysis
+    The frequencies of resource types without FrequencyAggregator (None) are computed from the result store.
+    """
+
+    # Only needed if the counts of the run do not cover all stored results, e.g. after a resume
+    recompute = RECOMPUTE_FREQUENCIES or not all(aggregator.complete for *_, aggregator in aggregators
+                                                 if aggregator is not None)
+    metadata = {}
+    for code_file, source, code_type, aggregator in aggregators:
+        if aggregator is not None:
+            metadata.update(aggregated_metadata(code_file, source, code_type, aggregator, frequencies=not recompute))
+    update_metadata(metadata)
+
+    recomputed = {code_type for _, _, code_type, aggregator in aggregators if recompute or aggregator is None}
+    if "ICD" in recomputed:
+        secondary_conditions_frequencies(ICD_CODE_FILE)
+    if "LOINC" in recomputed:
+        observation_frequencies(LOINC_CODE_FILE)
+    if "ATC" in recomputed:
+        medication_frequencies(ATC_CODE_FILE)
+
+def bulk_export_main(patients, base_url=None):
+    """
+    Alternative to the per-patient searches of main: one FHIR Bulk Data export for all resource types.
+    :param base_url: Base URL of the FHIR server, e.g. of a local stub server, SERVER_NAME if not given
+    """
+    from FhirHelpersBulkExport import execute_bulk_export
+
+    execute_bulk_export(patients, EXTRACTION_PLAN, base_url=base_url)
 
     """ Post processing: Analysis """
 
@@ -50,4 +139,8 @@ def main():
     medication_frequencies(ATC_CODE_FILE)
 
 if __name__ == "__main__":
-    main()
+    args = shard_argument_parser("Extracts the resources of the cohort patients.").parse_args()
+    try:
+        main(args.shard)
+    finally:
+        telemetry.write_profile("ExtractResourcesForCohortExecute")
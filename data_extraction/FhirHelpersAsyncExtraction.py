@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+import aiohttp
+
+from Constants import USER_NAME, USER_PASSWORD, ASYNC_MAX_CONCURRENCY
+from FhirHelpersRetry import async_call_with_retry
+from FhirHelpersResourceExtraction import (create_result_folders, observation_searches, filter_observations,
+                                           condition_searches, filter_conditions, medication_searches,
+                                           filter_medications, write_results, gather_fetch_metadata)
+from FhirHelpersUtils import search_url, unique_entries
+from ResultStore import result_store
+from Telemetry import telemetry, query_type_of
+
+"""
+Asyncio alternative to the ThreadPoolExecutor path of FhirHelpersResourceExtraction. Queries and filters are the same,
+but every request is a coroutine, so hundreds of requests can be in flight limited only by ASYNC_MAX_CONCURRENCY.
+"""
+
+
+async def fetch_bundle_for_url(session, semaphore, url):
+    """
+    Async counterpart of FhirHelpersUtils.search: requests the search URL and follows all "next" pages.
+    :param session: aiohttp session of the run
+    :param semaphore: Limits the requests in flight
+    :param url: Search URL
+    :return: All results in Bundle
+    """
+    async def request_page():
+        async with semaphore:
+            async with session.get(url, headers={'Accept': 'application/fhir+json'}) as response:
+                response.raise_for_status()
+                body = await response.read()
+                telemetry.record_bytes(query_type, response.content_length or len(body))
+                return json.loads(body)
+
+    result_bundle = []
+    pages = 0
+    query_type = query_type_of(url)
+    while url:
+        bundle = await async_call_with_retry(request_page, url, query_type)
+        pages += 1
+        if 'entry' in bundle:
+            result_bundle.extend(bundle['entry'])
+        url = next((link['url'] for link in bundle.get('link', []) if link['relation'] == 'next'), None)
+
+    telemetry.record_search(query_type, pages)
+    print(f"Current query return {len(result_bundle)} result!\n")
+    return result_bundle
+
+
+async def observations_async(patient, code_file, source, session, semaphore):
+    print(f"Creating queries for patient {patient} for observation resources...\n")
+    observations_bundles = []
+    for struct in observation_searches(patient, code_file):
+        observations_bundles.extend(await fetch_bundle_for_url(session, semaphore, search_url(source.resource_type, struct)))
+
+    filtered_results = list(filter_observations(unique_entries(observations_bundles), code_file))
+    print(f"Patient {patient} has {len(filtered_results)} observations.")
+    return filtered_results
+
+
+async def conditions_async(patient, code_file, source, session, semaphore):
+    print(f"Creating queries for patient {patient} for conditions...\n")
+    conditions = []
+    for struct in condition_searches(patient, code_file):
+        conditions.extend(await fetch_bundle_for_url(session, semaphore, search_url(source.resource_type, struct)))
+    return list(filter_conditions(unique_entries(conditions), code_file))
+
+
+async def medications_async(patient, code_file, source, session, semaphore):
+    print(f"Creating queries for patient {patient}...\n")
+    medications_bundles = []
+    for struct in medication_searches(patient, code_file, source):
+        medications_bundles.extend(await fetch_bundle_for_url(session, semaphore, search_url(source.resource_type, struct)))
+    medications_bundles = unique_entries(medications_bundles)
+    if source.resource_type == 'Medication':
+        return list(medications_bundles)
+    # The referenced Medications are resolved with the blocking requests of the thread engine
+    return await asyncio.to_thread(lambda: list(filter_medications(medications_bundles, code_file)))
+
+
+async def _fetch_patient(function_to_run, patient, code_file, source, session, semaphore):
+    try:
+        return patient, await function_to_run(patient, code_file, source, session, semaphore), None
+    except Exception as exc:
+        return patient, None, exc
+
+
+async def _fetch_all(code_file, source, patient_list, code_type, function_to_run, aggregator):
+    semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit=ASYNC_MAX_CONCURRENCY)
+    with telemetry.phase(source.resource_type, None, len(patient_list)) as phase:
+        async with aiohttp.ClientSession(connector=connector,
+                                         auth=aiohttp.BasicAuth(USER_NAME, USER_PASSWORD)) as session:
+            tasks = [asyncio.create_task(_fetch_patient(function_to_run, patient, code_file, source, session, semaphore))
+                     for patient in patient_list]
+            counter = 0
+            for task in asyncio.as_completed(tasks):
+                patient, entries, exc = await task
+                phase.task_done()
+                if exc is not None:
+                    print(f"Patient {patient} generated an exception: {exc}.\n")
+                    continue
+                if entries:
+                    counter += 1
+                    await asyncio.to_thread(write_results, entries, code_type, source, patient)
+                if aggregator is not None:
+                    for entry in entries:
+                        aggregator.count(patient, entry)
+                    aggregator.finish_patient(patient)
+                print(f"Processed patient {patient} with {len(entries)} entries.\n")
+    return counter
+
+
+def execute_async_for_fetching(code_file, source, patient_list, code_type, function_to_run, aggregator=None):
+    """
+    Runs the fetch coroutines of all patients on one event loop, writing the results as they finish.
+    Same arguments and outputs as execute_thread_for_fetching, but function_to_run is one of the *_async coroutines.
+    """
+    create_result_folders(code_file)
+    result_store().clear(source.resource_type)
+    asyncio.run(_fetch_all(code_file, source, patient_list, code_type, function_to_run, aggregator))
+    if aggregator is not None:
+        aggregator.patient_count = result_store().patient_count(source.resource_type)
+    else:
+        gather_fetch_metadata(code_type, source, result_store().patient_count(source.resource_type))
+    print("---------------End of Code------------------------")
@@ -0,0 +1,177 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from Constants import USER_NAME, USER_PASSWORD, MAX_WORKERS, BATCH_PATIENTS, BATCH_MAX_ENTRIES
+from FhirHelpersResourceExtraction import create_result_folders, observation_searches, condition_searches, \
+    medication_searches, filter_observations, filter_conditions, filter_medications, write_results, \
+    gather_fetch_metadata
+from FhirHelpersRetry import call_with_retry
+from FhirHelpersUtils import connect_to_server, get_session, server_base_url, search_url, iter_bundle_pages, \
+    unique_entries
+from ResultStore import result_store
+from Telemetry import telemetry
+
+"""
+Patient-centric extraction with FHIR "batch" Bundles instead of one pass over the cohort per resource type. The
+searches of all resource types (Observations, Conditions and the Medication* profiles) of a group of patients are
+POSTed as one batch, the search results of the batch response are split back per resource type and patient, and
+only the searches with a "next" link are paged with regular requests. The results and the metadata are the same
+as of the per-type passes.
+"""
+
+
+def _checked(response):
+    response.raise_for_status()
+    return response
+
+
+def type_searches(patient, code_file, source):
+    """
+    Search parameters of the queries of one resource type for the patient, as sent by the per-type passes.
+    """
+    if source.resource_type == 'Observation':
+        return observation_searches(patient, code_file)
+    if source.resource_type == 'Condition':
+        return condition_searches(patient, code_file)
+    return medication_searches(patient, code_file, source)
+
+
+def filter_entries(entries, code_file, source):
+    if source.resource_type == 'Observation':
+        return filter_observations(entries, code_file)
+    if source.resource_type == 'Condition':
+        return filter_conditions(entries, code_file)
+    if source.resource_type != 'Medication':
+        return filter_medications(entries, code_file)
+    return entries
+
+
+def post_batch(session, base_url, urls):
+    """
+    Sends the searches as one batch Bundle.
+    :param urls: Search URLs relative to the base URL, e.g. "Observation?subject=..."
+    :return: Entries of the batch-response, in the order of the searches
+    """
+    body = {"resourceType": "Bundle", "type": "batch",
+            "entry": [{"request": {"method": "GET", "url": url}} for url in urls]}
+    headers = {'Accept': 'application/fhir+json', 'Content-Type': 'application/fhir+json'}
+    response = call_with_retry(lambda: _checked(session.post(base_url, json=body, headers=headers)),
+                               f"{base_url} (batch of {len(urls)} searches)", "batch")
+    return response.json().get('entry', [])
+
+
+def fetch_patient_group(smart, session, patients, plan):
+    """
+    Fetches the resources of all types of the patients with batch requests of at most BATCH_MAX_ENTRIES searches.
+    :param plan: List of (code file, Fhir resource model, code type) of the extracted resource types
+    :return: Dictionary (plan index, patient) -> entries
+    """
+    base_url = server_base_url()
+    searches = [(index, patient, search_url(source.resource_type, struct)[len(base_url) + 1:])
+                for patient in patients
+                for index, (code_file, source, code_type) in enumerate(plan)
+                for struct in type_searches(patient, code_file, source)]
+
+    results = defaultdict(list)
+    for start in range(0, len(searches), BATCH_MAX_ENTRIES):
+        batch = searches[start:start + BATCH_MAX_ENTRIES]
+        response_entries = post_batch(session, base_url, [url for _, _, url in batch])
+        for (index, patient, url), response_entry in zip(batch, response_entries):
+            status = response_entry.get('response', {}).get('status', '')
+            if not status.startswith('2'):
+                # The search failed within the batch, it is sent again on its own
+                print(f"Batch search {url} failed with status {status}, searching it separately.\n")
+                for entries, next_url in iter_bundle_pages(smart, url=f"{base_url}/{url}"):
+                    results[index, patient].extend(entries)
+                continue
+
+            bundle = response_entry.get('resource', {})
+            results[index, patient].extend(bundle.get('entry', []))
+            next_url = next((link["url"] for link in bundle.get("link", []) if "next" in link["relation"]), None)
+            if next_url:
+                for entries, _ in iter_bundle_pages(smart, url=next_url):
+                    results[index, patient].extend(entries)
+    return results
+
+
+def store_patient_group(patients, plan, aggregators, results):
+    """
+    Writes the results of each resource type and patient of a group, as the per-type passes do.
+    :return: Number of entries written
+    """
+    count = 0
+    for patient in patients:
+        for index, (code_file, source, code_type) in enumerate(plan):
+            entries = list(filter_entries(unique_entries(results.get((index, patient), [])), code_file, source))
+            if entries:
+                write_results(entries, code_type, source, patient)
+            aggregator = aggregators[index]
+            if aggregator is not None:
+                for entry in entries:
+                    aggregator.count(patient, entry)
+                aggregator.finish_patient(patient)
+            count += len(entries)
+    return count
+
+
+def begin_patient_extraction(extraction_plan):
+    """
+    Prepares the result folders and the result store for a patient-centric run over all resource types.
+    :param extraction_plan: List of (code file, Fhir resource model, code type, FrequencyAggregator or None)
+    :return: Plan of (code file, Fhir resource model, code type), list of the aggregators
+    """
+    plan = [(code_file, source, code_type) for code_file, source, code_type, _ in extraction_plan]
+    aggregators = [aggregator for *_, aggregator in extraction_plan]
+    for code_file, source, code_type in plan:
+        create_result_folders(code_file)
+        result_store().clear(source.resource_type)
+    return plan, aggregators
+
+
+def discard_patients(aggregators, patients):
+    for aggregator in aggregators:
+        if aggregator is not None:
+            for patient in patients:
+                aggregator.discard_patient(patient)
+
+
+def finish_patient_extraction(plan, aggregators):
+    """
+    Sets the patient counts of the resource types from the result store.
+    """
+    for (code_file, source, code_type), aggregator in zip(plan, aggregators):
+        if aggregator is not None:
+            aggregator.patient_count = result_store().patient_count(source.resource_type)
+        else:
+            gather_fetch_metadata(code_type, source, result_store().patient_count(source.resource_type))
+
+
+def execute_batch_for_fetching(patient_list, extraction_plan):
+    """
+    Counterpart of execute_thread_for_fetching for all resource types at once: one batch request per group of
+    BATCH_PATIENTS patients, the groups are fetched in parallel.
+    :param extraction_plan: List of (code file, Fhir resource model, code type, FrequencyAggregator or None)
+    """
+    plan, aggregators = begin_patient_extraction(extraction_plan)
+
+    smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
+    session = get_session()
+    groups = [patient_list[i:i + BATCH_PATIENTS] for i in range(0, len(patient_list), BATCH_PATIENTS)]
+    print(f"Fetching {len(patient_list)} patients in {len(groups)} batch groups.\n")
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+            telemetry.phase("Batch", MAX_WORKERS, len(groups)) as phase:
+        future_to_group = {executor.submit(phase.track(fetch_patient_group), smart, session, group, plan): group
+                           for group in groups}
+        for future in as_completed(future_to_group):
+            group = future_to_group[future]
+            phase.task_done()
+            try:
+                count = store_patient_group(group, plan, aggregators, future.result())
+                print(f"Processed {len(group)} patients with {count} entries.\n")
+            except Exception as exc:
+                discard_patients(aggregators, group)
+                print(f"Patients {', '.join(group)} generated an exception: {exc}.\n")
+
+    finish_patient_extraction(plan, aggregators)
+    print("---------------End of Code------------------------")
@@ -0,0 +1,232 @@
+import json
+import os
+import shutil
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import requests
+
+from Constants import USER_NAME, USER_PASSWORD, MAX_WORKERS, MAX_URL_LENGTH, BULK_EXPORT_GROUP_ID, BULK_EXPORT_POLL_INTERVAL, \
+    BULK_EXPORT_FOLDER, BULK_EXPORT_SPOOL_BUFFER, KEEP_RESULT_FILES
+from FhirHelpersMedicationResolution import resolve_medications, atc_code_for_reference
+from FhirHelpersResourceExtraction import read_input_code_file, create_result_folders, filter_observations, \
+    gather_fetch_metadata
+from FhirHelpersRetry import call_with_retry, retry_after_seconds, response_status
+from FhirHelpersUtils import connect_to_server, get_session, server_base_url, code_search_value
+from ResultStore import result_store, write_result_file
+from Telemetry import telemetry
+
+"""
+Extraction of the cohort resources with the FHIR Bulk Data "$export" operation instead of per-patient searches.
+The export is kicked off once for all resource types (Group/[id]/$export or Patient/$export), its status endpoint
+is polled until the NDJSON files are ready, and the files are downloaded in parallel. The resources are filtered by
+the code lists and split per cohort patient into the same result layout and metadata as the search path.
+"""
+
+
+def _checked(response):
+    response.raise_for_status()
+    return response
+
+
+def kick_off_retryable(exc):
+    """
+    The kick-off is only sent again if the server refused it with 429/503 and "Retry-After", or if the connection
+    could not be established. After a timeout or a dropped connection the server may have accepted it already,
+    sending it again would start a second export job.
+    """
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    status, headers = response_status(exc)
+    return status in (429, 503) and retry_after_seconds(headers) is not None
+
+
+def kick_off_export(session, base_url, types, type_filters, group_id=None):
+    """
+    Starts the asynchronous export. Falls back from GET to POST with a Parameters resource if the
+    "_typeFilter"s do not fit into the URL length limit.
+    :return: URL of the status endpoint
+    """
+    url = f"{base_url}/Group/{group_id}/$export" if group_id else f"{base_url}/Patient/$export"
+    params = [('_type', ','.join(types)), ('_outputFormat', 'application/fhir+ndjson')]
+    params += [('_typeFilter', type_filter) for type_filter in type_filters]
+    headers = {'Accept': 'application/fhir+json', 'Prefer': 'respond-async'}
+
+    if len(url + '?' + urlencode(params)) <= MAX_URL_LENGTH:
+        response = call_with_retry(lambda: _checked(session.get(url, params=params, headers=headers)), url,
+                                   retryable=kick_off_retryable)
+    else:
+        body = {"resourceType": "Parameters",
+                "parameter": [{"name": name, "valueString": value} for name, value in params]}
+        headers['Content-Type'] = 'application/fhir+json'
+        response = call_with_retry(lambda: _checked(session.post(url, json=body, headers=headers)), url,
+                                   retryable=kick_off_retryable)
+
+    print(f"Export started, status endpoint: {response.headers['Content-Location']}\n")
+    return response.headers['Content-Location']
+
+
+def poll_export(session, status_url):
+    """
+    Polls the status endpoint until the export is complete, honoring "Retry-After".
+    :return: Export manifest
+    """
+    while True:
+        response = call_with_retry(lambda: _checked(session.get(status_url, headers={'Accept': 'application/json'})),
+                                   status_url)
+        if response.status_code != 202:
+            return response.json()
+
+        print(f"Export in progress {response.headers.get('X-Progress', '')}...\n")
+        retry_after = retry_after_seconds(response.headers)
+        time.sleep(BULK_EXPORT_POLL_INTERVAL if retry_after is None else retry_after)
+
+
+def download_outputs(session, manifest, folder):
+    """
+    Downloads all NDJSON files of the manifest in parallel.
+    :return: Resource type -> downloaded file paths
+    """
+    os.makedirs(folder, exist_ok=True)
+    headers = {'Accept': 'application/fhir+ndjson'}
+
+    def download(indexed_output):
+        index, output = indexed_output
+        path = os.path.join(folder, f"{index}_{output['type']}.ndjson")
+
+        def request():
+            with session.get(output['url'], headers=headers, stream=True) as response:
+                response.raise_for_status()
+                with open(path, 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        file.write(chunk)
+
+        call_with_retry(request, output['url'], "$export download")
+        return output['type'], path
+
+    files_by_type = defaultdict(list)
+    outputs = manifest.get('output', [])
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+            telemetry.phase("Export download", MAX_WORKERS, len(outputs)) as phase:
+        for resource_type, path in executor.map(phase.track(download), enumerate(outputs)):
+            phase.task_done()
+            files_by_type[resource_type].append(path)
+    print(f"Downloaded {sum(len(paths) for paths in files_by_type.values())} export files.\n")
+    return files_by_type
+
+
+def iter_export_entries(paths, base_url):
+    """
+    Yields the resources of NDJSON export files as search entries, like the entries of a searchset Bundle.
+    """
+    for path in paths:
+        with open(path, 'r') as file:
+            for line in file:
+                if line.strip():
+                    resource = json.loads(line)
+                    yield {"fullUrl": f"{base_url}/{resource['resourceType']}/{resource['id']}",
+                           "resource": resource, "search": {"mode": "match"}}
+
+
+def entry_patient(entry):
+    """
+    Patient reference of a search entry, None if it has none.
+    """
+    resource = entry['resource']
+    return (resource.get('subject') or resource.get('patient') or {}).get('reference')
+
+
+def _has_code(entry, system, code_list):
+    return any(coding.get('system') == system and coding.get('code') in code_list
+               for coding in entry['resource'].get('code', {}).get('coding', []))
+
+
+def write_per_patient(entries, patients, code_type, source):
+    """
+    Splits the entries per cohort patient and stores them in the result store as the search path does.
+    Entries are inserted in batches of BULK_EXPORT_SPOOL_BUFFER, the per-patient result files are only written
+    with KEEP_RESULT_FILES.
+    :return: Number of patients with results
+    """
+    cohort = set(patients)
+    buffers, buffered = defaultdict(list), 0
+    with_results = set()
+
+    def flush():
+        for patient, patient_entries in buffers.items():
+            result_store().add_patient(code_type, source.resource_type, patient, patient_entries, update=True)
+        buffers.clear()
+
+    for entry in entries:
+        patient = entry_patient(entry)
+        if patient in cohort:
+            buffers[patient].append(entry)
+            with_results.add(patient)
+            buffered += 1
+            if buffered >= BULK_EXPORT_SPOOL_BUFFER:
+                flush()
+                buffered = 0
+    flush()
+
+    if KEEP_RESULT_FILES:
+        for patient in dict.fromkeys(patients):
+            if patient in with_results:
+                write_result_file(code_type, source, patient)
+    return len(with_results)
+
+
+def execute_bulk_export(patients, extraction_plan, base_url=None, group_id=BULK_EXPORT_GROUP_ID):
+    """
+    Runs one export for all resource types of the extraction plan and writes the results per patient.
+    :param patients: Cohort patient references
+    :param extraction_plan: List of (code_file, source, code_type), as passed to execute_thread_for_fetching
+    :param base_url: Base URL of the FHIR server (e.g. of a local stub server), SERVER_NAME if not given
+    :param group_id: Id of the cohort Group, Patient/$export if not given
+    """
+    base_url = base_url or server_base_url()
+    session = get_session()
+
+    types, type_filters = [], []
+    for code_file, source, code_type in extraction_plan:
+        types.append(source.resource_type)
+        if code_type in ("LOINC", "ICD"):
+            code_list, system = read_input_code_file(code_file)
+            type_filters.append(f"{source.resource_type}?"
+                                + urlencode({'code': code_search_value(system, code_list)}, safe=',|'))
+
+    status_url = kick_off_export(session, base_url, list(dict.fromkeys(types)), type_filters, group_id)
+    manifest = poll_export(session, status_url)
+    files_by_type = download_outputs(session, manifest, BULK_EXPORT_FOLDER)
+
+    for code_file, source, code_type in extraction_plan:
+        create_result_folders(code_file)
+        code_list, system = read_input_code_file(code_file)
+        entries = iter_export_entries(files_by_type.get(source.resource_type, []), base_url)
+
+        # The server may ignore "_typeFilter", so the code lists are always checked here as well.
+        if code_type == "LOINC":
+            entries = filter_observations(entries, code_file)
+        elif code_type == "ICD":
+            entries = (entry for entry in entries if _has_code(entry, system, code_list))
+        elif code_type == "ATC":
+            references = {entry['resource']['medicationReference']['reference']
+                          for entry in iter_export_entries(files_by_type.get(source.resource_type, []), base_url)
+                          if 'reference' in entry['resource'].get('medicationReference', {})}
+            resolve_medications(connect_to_server(user=USER_NAME, pw=USER_PASSWORD), references)
+            entries = (entry for entry in entries
+                       if atc_code_for_reference(entry['resource'].get('medicationReference', {}).get('reference', ''),
+                                                 code_list))
+
+        result_store().clear(source.resource_type)
+        counter = write_per_patient(entries, patients, code_type, source)
+        print(f"{counter} patients with {source.resource_type} resources.\n")
+        gather_fetch_metadata(code_type, source, result_store().patient_count(source.resource_type))
+
+    try:
+        session.delete(status_url)  # Lets the server clean up the export files
+    except Exception as exc:
+        print(f"Could not delete export {status_url}: {exc}\n")
+    shutil.rmtree(BULK_EXPORT_FOLDER, ignore_errors=True)
+    print("---------------End of Code------------------------")
@@ -1,88 +1,222 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import json
-import time
 
-from fhirclient.models.condition import Condition
-from fhirclient.models.encounter import Encounter
-
-from Constants import USER_NAME, USER_PASSWORD, ICD_SYSTEM_NAME, ASTHMA_COPD_CODES_FILE
-from FhirHelpersUtils import fetch_bundle_for_code, connect_to_server
+from CodeRegistry import load_code_list
+from Constants import ICD_SYSTEM_NAME, ASTHMA_COPD_CODES_FILE, MAIN_DIAGNOSIS_RESOLUTION, \
+    ENCOUNTER_DIAGNOSIS_CHUNK_SIZE, DISCOVERY_MAX_PARALLEL
+from FhirHelpersRetry import RetryExhaustedError
+from FhirHelpersUtils import search, plan_code_chunks, plan_value_chunks, code_search_value
 from Metadata import gather_metadata
+from Sharding import in_shard
+from Telemetry import telemetry
 
 
 
-def patients_with_asthma_copd(smart):
+def conditions_for_codes(smart, code_value):
     """
-    It reads the ASTHMA or COPD diseases related codes from "ASTHMA_COPD_CODES_FILE" and
-    find the patients that have such diagnoses.
+    Fetches all Conditions matching one comma-joined "system|code" search value.
     :param smart: Fhir Server Connector
+    :param code_value: Comma-joined "system|code" search value
+    :return: Condition entries of all pages
     """
-    with open(ASTHMA_COPD_CODES_FILE, 'r') as file:
-        main_diagnoses_file = json.load(file)
-        main_diagnoses_codes = [item['code'] for item in main_diagnoses_file['codes']]
-    print(main_diagnoses_codes)
+    return search(smart, 'Condition', {'_count': b'1000', 'code': code_value})
 
-    patients_conditions_map = defaultdict(list)
-    for code in main_diagnoses_codes:
-        while True:
-            try:
-                bundle = Condition.where(struct={'_count': b'1000', 'code': ICD_SYSTEM_NAME + '|' + code}).perform(smart.server)
-                break
-            except Exception as exc:
-                print(f"Generated an exception: {exc} but continue to trying.\n")
-                smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
-                time.sleep(3)
-
-        conditions = fetch_bundle_for_code(smart, bundle)
-        if conditions:
-            for entry in conditions:
-                condition = entry['resource']
-                if condition['subject']['reference']:
-                    patient_reference = condition['subject']['reference']
-                    patients_conditions_map[patient_reference].append({"id": condition['id'], "code": condition['code']})
 
+def discovery_code_chunks():
+    """
+    Groups of the ASTHMA or COPD codes of "ASTHMA_COPD_CODES_FILE", one Condition search each, sized by the URL
+    length limit.
+    """
+    main_diagnoses_codes = load_code_list(ASTHMA_COPD_CODES_FILE)
+    print(list(main_diagnoses_codes))
+    return plan_code_chunks('Condition', {'_count': b'1000'}, ICD_SYSTEM_NAME, main_diagnoses_codes)
+
+
+def cohort_conditions(entries, seen_condition_ids, shard=None):
+    """
+    Yields (patient reference, condition) of the Condition entries of a search, each Condition once.
+    :param seen_condition_ids: Ids of the Conditions yielded before, updated
+    :param shard: (i, N) to keep only the patients of shard i of N, see Sharding
+    """
+    for entry in entries:
+        condition = entry['resource']
+        if condition['id'] in seen_condition_ids:
+            continue
+        seen_condition_ids.add(condition['id'])
+        if condition['subject']['reference'] and in_shard(condition['subject']['reference'], shard):
+            yield condition['subject']['reference'], {"id": condition['id'], "code": condition['code']}
+
+
+def write_cohort(patients_conditions_map):
     print(len(patients_conditions_map))
     gather_metadata("asthma_and_copd_patient_count", len(patients_conditions_map))
     with open('patients_diagnosed_asthma_copd.json', 'w') as file: #Intermediate results, can be deleted later.
         json.dump(patients_conditions_map, file, indent=4)
 
 
-def filter_main_diagnosis(smart):
+def patients_with_asthma_copd(smart, shard=None):
     """
-    From the patients diagnosed ASTHMA or COPD, it filters only for HauptDiagnosis(Main) from their Encounter references.
-    Put the results into JSON file format.
+    It reads the ASTHMA or COPD diseases related codes from "ASTHMA_COPD_CODES_FILE" and
+    find the patients that have such diagnoses.
+    Codes are grouped into comma-joined "code" parameters sized by the URL length limit, and the groups are
+    searched concurrently with at most DISCOVERY_MAX_PARALLEL queries in flight.
     :param smart: Fhir Server Connector
+    :param shard: (i, N) to keep only the patients of shard i of N, see Sharding
     """
-    count_main_diagnose_type = defaultdict(int)
+    code_chunks = discovery_code_chunks()
+    patients_conditions_map = defaultdict(list)
+    seen_condition_ids = set()
+    with ThreadPoolExecutor(max_workers=DISCOVERY_MAX_PARALLEL) as executor, \
+            telemetry.phase("Condition discovery", DISCOVERY_MAX_PARALLEL, len(code_chunks)) as phase:
+        futures = [executor.submit(phase.track(conditions_for_codes), smart, code_search_value(ICD_SYSTEM_NAME, chunk))
+                   for chunk in code_chunks]
+        # Merged in submission order, so the result does not depend on which group finishes first.
+        for future in futures:
+            try:
+                entries = future.result()
+            except RetryExhaustedError as exc:
+                print(f"Skipping code group, query failed permanently: {exc}\n")
+                continue
+            finally:
+                phase.task_done()
+            for patient_reference, condition in cohort_conditions(entries, seen_condition_ids, shard):
+                patients_conditions_map[patient_reference].append(condition)
+
+    write_cohort(patients_conditions_map)
+
+
+def encounter_diagnosis_chunks(condition_references):
+    """
+    Groups the Condition references into comma-joined "diagnosis" search values of at most
+    ENCOUNTER_DIAGNOSIS_CHUNK_SIZE references, fewer where the search URL would exceed MAX_URL_LENGTH.
+    :param condition_references: Ordered list of "Condition/<id>" references
+    :return: List of reference lists
+    """
+    return plan_value_chunks('Encounter', {'_count': b'1000'}, condition_references, 'diagnosis',
+                             max_values=ENCOUNTER_DIAGNOSIS_CHUNK_SIZE)
+
+
+def encounters_for_references(smart, chunk):
+    """
+    Fetches the Encounters referencing any of the Conditions of the chunk as diagnosis.
+    """
+    try:
+        return search(smart, 'Encounter', {'_count': b'1000', 'diagnosis': ','.join(chunk)})
+    except RetryExhaustedError as exc:
+        print(f"Skipping {len(chunk)} conditions, query failed permanently: {exc}\n")
+        return []
 
+
+def encounters_by_diagnosis(smart, condition_references):
+    """
+    Resolves the Encounters of many Conditions at once. Condition references are sent as comma-joined
+    "diagnosis" search values (see encounter_diagnosis_chunks) instead of one search per Condition, the chunks are
+    searched concurrently with at most DISCOVERY_MAX_PARALLEL queries in flight.
+    :param smart: Fhir Server Connector
+    :param condition_references: List of "Condition/<id>" references
+    :return: In-memory index of Condition reference -> Encounter resources referencing it as diagnosis
+    """
+    chunks = encounter_diagnosis_chunks(list(dict.fromkeys(condition_references)))
+    if len(chunks) == 1:
+        # A single search, e.g. a check of the pipeline, which runs in a pool of its own
+        results = [encounters_for_references(smart, chunks[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=DISCOVERY_MAX_PARALLEL) as executor, \
+                telemetry.phase("Encounter resolution", DISCOVERY_MAX_PARALLEL, len(chunks)) as phase:
+            futures = [executor.submit(phase.track(encounters_for_references), smart, chunk) for chunk in chunks]
+            results = []
+            for future in futures:
+                results.append(future.result())
+                phase.task_done()
+
+    # Indexed in the order of the chunks, so the index does not depend on which search finishes first.
+    encounter_index = defaultdict(list)
+    for chunk, encounters in zip(chunks, results):
+        chunk_set = set(chunk)
+        for enc in encounters:
+            diagnoses = enc['resource'].get('diagnosis', [])
+            referenced = {c['condition']['reference'] for c in diagnoses if 'reference' in c.get('condition', {})}
+            for reference in referenced & chunk_set:
+                encounter_index[reference].append(enc['resource'])
+
+    return encounter_index
+
+
+def encounters_for_condition(smart, patient, condition_reference):
+    """
+    Resolves the Encounters of a single Condition of the patient, one search per Condition.
+    :param smart: Fhir Server Connector
+    :param patient: Patient reference
+    :param condition_reference: "Condition/<id>" reference
+    :return: Encounter resources referencing the Condition as diagnosis
+    """
+    try:
+        #Check the patient with the spesific condition ID has Encounter reference.
+        encounters = search(smart, 'Encounter', {'_count': b'10', 'subject': patient, 'diagnosis': condition_reference})
+        return [enc['resource'] for enc in encounters]
+    except RetryExhaustedError as exc:
+        print(f"Skipping {condition_reference}, query failed permanently: {exc}\n")
+        return []
+
+
+def chief_complaint_matches(encounter, condition_reference):
+    """
+    Counts how often the Encounter flags the Condition as "CC" (Chief Complaint) in Encounter.Diagnosis.
+    :param encounter: Encounter resource
+    :param condition_reference: "Condition/<id>" reference
+    """
+    matches = 0
+    if 'diagnosis' in encounter:
+        for c in encounter['diagnosis']:
+            if c['use']['coding']:
+                for code in c['use']['coding']:
+                    if code['code'] == "CC" and (condition_reference == c['condition']['reference']):  # chief complaint
+                        matches += 1
+    return matches
+
+
+def chief_complaint_counts(smart, patient_conditions):
+    """
+    Resolves the Encounters of the Conditions and counts how often each Condition is flagged as "CC".
+    With MAIN_DIAGNOSIS_RESOLUTION "bulk" the Encounters of all Conditions are resolved in chunks first and
+    checked against the in-memory index, "single" sends one Encounter search per Condition. As the single search
+    is constrained by "subject", only Encounters of the Condition's patient are counted from the index.
+    :param smart: Fhir Server Connector
+    :param patient_conditions: List of (patient reference, condition) of the discovered Conditions
+    :return: Dictionary "Condition/<id>" -> number of chief complaint flags
+    """
+    encounter_index = None
+    if MAIN_DIAGNOSIS_RESOLUTION == "bulk":
+        encounter_index = encounters_by_diagnosis(
+            smart, ['Condition/' + condition['id'] for _, condition in patient_conditions])
+
+    counts = {}
+    for patient, condition in patient_conditions:
+        condition_reference = 'Condition/' + condition['id']
+        if encounter_index is not None:
+            encounters = [enc for enc in encounter_index.get(condition_reference, [])
+                          if enc.get('subject', {}).get('reference') == patient]
+        else:
+            encounters = encounters_for_condition(smart, patient, condition_reference)
+        counts[condition_reference] = sum(chief_complaint_matches(enc, condition_reference) for enc in encounters)
+    return counts
+
+
+def write_main_diagnoses(patients, counts):
+    """
+    Keeps the Conditions flagged as chief complaint, once per flag, and writes them with their counts.
+    :param patients: Dictionary patient reference -> conditions, as in "patients_diagnosed_asthma_copd.json"
+    :param counts: Chief complaint flags of the Conditions, see chief_complaint_counts
+    """
+    count_main_diagnose_type = defaultdict(int)
     patients_with_chief_complaint = defaultdict(list)
-    with open("patients_diagnosed_asthma_copd.json", "r") as file:
-        patients = json.load(file)
-        for patient in patients.keys():
-            print(f"Processing patient with ID: {patient[8:]}...")
-            conditions_ids = patients[patient]
-            for condition in conditions_ids:
-                while True: #Connection might get lost sometime, try reconnect...
-                    try:
-                        #Check the patient with the spesific condition ID has Encounter reference.
-                        bundle = Encounter.where(struct={'_count': b'10', 'subject': patient, 'diagnosis': 'Condition/' + condition['id']}).perform(smart.server)
-                        break
-                    except Exception as exc:
-                        print(f"Generated an exception: {exc} but continue to trying. \n")
-                        smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
-                        time.sleep(3)
-
-                encounter = fetch_bundle_for_code(smart, bundle)
-                #If the encounter exist, check the diagnosis from this encounter is "MainDiagnose" or not. If so, put it into result.
-                if encounter:
-                    for enc in encounter:
-                        if 'diagnosis' in enc['resource']:
-                            for c in enc['resource']['diagnosis']:
-                                if c['use']['coding']:
-                                    for code in c['use']['coding']:
-                                        if code['code'] == "CC" and ('Condition/' + condition['id'] == c['condition']['reference']):  # chief complaint
-                                            patients_with_chief_complaint[patient].append(condition)
-                                            count_main_diagnose_type[condition['code']['coding'][0]['code']] += 1
+    for patient, conditions in patients.items():
+        for condition in conditions:
+            #If the encounter exist, check the diagnosis from this encounter is "MainDiagnose" or not. If so, put it into result.
+            for _ in range(counts.get('Condition/' + condition['id'], 0)):
+                patients_with_chief_complaint[patient].append(condition)
+                count_main_diagnose_type[condition['code']['coding'][0]['code']] += 1
 
     gather_metadata("asthma_and_copd_patients_with_chief_complaint", len(patients_with_chief_complaint))
     gather_metadata("main_diagnosis_counts", count_main_diagnose_type)
@@ -92,3 +226,15 @@ def filter_main_diagnosis(smart):
         json.dump(patients_with_chief_complaint, out, indent=4)
 
 
+def filter_main_diagnosis(smart):
+    """
+    From the patients diagnosed ASTHMA or COPD, it filters only for HauptDiagnosis(Main) from their Encounter references.
+    Put the results into JSON file format.
+    :param smart: Fhir Server Connector
+    """
+    with open("patients_diagnosed_asthma_copd.json", "r") as file:
+        patients = json.load(file)
+
+    counts = chief_complaint_counts(
+        smart, [(patient, condition) for patient, conditions in patients.items() for condition in conditions])
+    write_main_diagnoses(patients, counts)
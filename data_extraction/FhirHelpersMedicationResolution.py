@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from Constants import ATC_SYSTEM_NAME, MAX_WORKERS, MEDICATION_CACHE_FILE, PERSIST_MEDICATION_CACHE
+from FhirHelpersRetry import RetryExhaustedError
+from FhirHelpersUtils import search, plan_value_chunks
+from Telemetry import telemetry
+
+"""
+Resolves "medicationReference"s of MedicationAdministration/Request/Statement resources to ATC codes.
+Distinct references are fetched in batches with "Medication?_id=a,b,c" and kept in an id -> ATC codes cache,
+which is written to MEDICATION_CACHE_FILE for the analyses of the results and only reused by the next run if
+PERSIST_MEDICATION_CACHE is set.
+The cache keeps all ATC codes of a Medication, so it stays valid when the ATC code list changes.
+"""
+
+_cache_lock = threading.Lock()
+_atc_codes_by_id = None
+
+
+def medication_id(resource_ref):
+    """
+    Id of a "Medication/<id>" reference, None for other references.
+    """
+    parts = resource_ref.split('/')
+    if len(parts) == 2 and parts[0] and parts[1]:
+        return parts[1]
+    return None
+
+
+def _cache():
+    global _atc_codes_by_id
+    with _cache_lock:
+        if _atc_codes_by_id is None:
+            _atc_codes_by_id = {}
+            if PERSIST_MEDICATION_CACHE and os.path.exists(MEDICATION_CACHE_FILE):
+                with open(MEDICATION_CACHE_FILE, 'r') as file:
+                    _atc_codes_by_id = json.load(file)
+        return _atc_codes_by_id
+
+
+def save_medication_cache():
+    """
+    Writes the cache to MEDICATION_CACHE_FILE, where the analyses of the results (CoOccurrence,
+    ReanalyzeResultsExecute) resolve the references. Medications of earlier runs in the file are kept, as the result
+    store may still reference them (INCREMENTAL_REFRESH), but without PERSIST_MEDICATION_CACHE they are not used by
+    the extraction.
+    """
+    cache = _cache()
+    with _cache_lock:
+        atc_codes_by_id = {}
+        if not PERSIST_MEDICATION_CACHE and os.path.exists(MEDICATION_CACHE_FILE):
+            with open(MEDICATION_CACHE_FILE, 'r') as file:
+                atc_codes_by_id = json.load(file)
+        atc_codes_by_id.update(cache)
+        with open(MEDICATION_CACHE_FILE, 'w') as file:
+            json.dump(atc_codes_by_id, file)
+
+
+def _fetch_medications(smart, ids):
+    struct = {'_count': b'1000', '_id': ','.join(ids)}
+    try:
+        medications = search(smart, 'Medication', struct)
+    except RetryExhaustedError as exc:
+        print(f"Could not resolve {len(ids)} Medications: {exc}\n")
+        return {}
+
+    atc_codes_by_id = {id_: [] for id_ in ids}
+    for entry in medications:
+        medication = entry['resource']
+        atc_codes_by_id[medication['id']] = [coding['code'] for coding in medication.get('code', {}).get('coding', [])
+                                             if coding.get('system') == ATC_SYSTEM_NAME and 'code' in coding]
+    return atc_codes_by_id
+
+
+def resolve_medications(smart, resource_refs, skip_cached=True):
+    """
+    Fetches the Medications of all references missing in the cache, in batches and in parallel. The cache is
+    written by save_medication_cache.
+    :param smart: Fhir Server Connector
+    :param resource_refs: Iterable of "Medication/<id>" references, duplicates are fetched only once
+    :param skip_cached: False to fetch the references in the cache as well, so the queries do not depend on what
+    other threads resolved before
+    """
+    cache = _cache()
+    # Sorted, so the same Medications give the same queries in every run (see ResponseCache)
+    ids = sorted({id_ for id_ in (medication_id(ref) for ref in resource_refs if ref)
+                  if id_ is not None and not (skip_cached and id_ in cache)})
+    if not ids:
+        return
+
+    chunks = plan_value_chunks('Medication', {'_count': b'1000'}, ids, '_id')
+    if len(chunks) == 1:
+        # The Medications of a page of a search, which runs in a pool of its own
+        atc_codes_by_id = _fetch_medications(smart, chunks[0])
+        with _cache_lock:
+            cache.update(atc_codes_by_id)
+        return
+
+    print(f"Resolving {len(ids)} Medications with {len(chunks)} queries...\n")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+            telemetry.phase("Medication resolution", MAX_WORKERS, len(chunks)) as phase:
+        for atc_codes_by_id in executor.map(phase.track(lambda chunk: _fetch_medications(smart, chunk)), chunks):
+            phase.task_done()
+            with _cache_lock:
+                cache.update(atc_codes_by_id)
+
+
+def atc_code_for_reference(resource_ref, code_list, atc_codes_by_id=None):
+    """
+    First ATC code of the referenced Medication which is in the code list, None if there is none or the
+    Medication could not be resolved. Call resolve_medications first.
+    :param atc_codes_by_id: Medication id -> ATC codes to look the Medication up in instead of the cache
+    """
+    if atc_codes_by_id is None:
+        atc_codes_by_id = _cache()
+    for code in atc_codes_by_id.get(medication_id(resource_ref) or '', []):
+        if code in code_list:
+            return code
+    return None
@@ -0,0 +1,180 @@
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from queue import Queue
+
+from Constants import ICD_SYSTEM_NAME, MAX_WORKERS, DISCOVERY_MAX_PARALLEL, PIPELINE_QUEUE_SIZE
+from FhirHelpersBatchExtraction import type_searches, store_patient_group, begin_patient_extraction, \
+    finish_patient_extraction, discard_patients
+from FhirHelpersCohortExtraction import conditions_for_codes, discovery_code_chunks, cohort_conditions, \
+    encounter_diagnosis_chunks, chief_complaint_counts, write_cohort, write_main_diagnoses
+from FhirHelpersResourceExtraction import iter_search_entries
+from FhirHelpersRetry import RetryExhaustedError
+from FhirHelpersUtils import code_search_value
+from Telemetry import telemetry
+
+"""
+Pipelined run of the cohort discovery, the main diagnosis filter and the resource extraction. The stages run at the
+same time and hand over through bounded queues instead of files: the Conditions of each discovery search go to the
+chief complaint check right away, and a patient goes to the extraction as soon as one of its Conditions is
+confirmed as main diagnosis. A full queue holds the stage before it back. The intermediate files and the metadata
+are the same as of CohortPatientsExecute and ExtractResourcesForCohortExecute, they are written at the end.
+"""
+
+DONE = None  # Last item of a queue, the stage before it has finished
+
+
+def fetch_patient(smart, patient, plan):
+    """
+    Fetches the resources of all types of the patient with regular searches.
+    :return: Dictionary (plan index, patient) -> entries, as fetch_patient_group of the batch mode
+    """
+    return {(index, patient): list(iter_search_entries(smart, source, type_searches(patient, code_file, source)))
+            for index, (code_file, source, code_type) in enumerate(plan)}
+
+
+class CohortPipeline:
+    """
+    The three stages of a pipelined run: discover and confirm run in threads, extract in the calling thread.
+    """
+
+    def __init__(self, smart, plan, aggregators, shard=None):
+        """
+        :param plan: List of (code file, Fhir resource model, code type) of the extracted resource types
+        :param aggregators: FrequencyAggregator or None of each resource type of the plan
+        :param shard: (i, N) to process only shard i of N of the cohort, see Sharding
+        """
+        self.smart = smart
+        self.plan = plan
+        self.aggregators = aggregators
+        self.shard = shard
+        self.condition_queue = Queue(maxsize=PIPELINE_QUEUE_SIZE)  # Lists of (patient, condition) of a search
+        self.patient_queue = Queue(maxsize=PIPELINE_QUEUE_SIZE)  # Confirmed patients
+        self.chunk_entries = []  # Condition entries of each discovery search, in the order of the code chunks
+        self.chief_complaints = {}  # "Condition/<id>" -> number of chief complaint flags
+        self.confirmed = set()
+        self._lock = threading.Lock()
+
+    def discover(self):
+        """
+        Searches the Conditions of the ASTHMA or COPD codes and queues them by search.
+        """
+        try:
+            code_chunks = discovery_code_chunks()
+            self.chunk_entries = [[] for _ in code_chunks]
+            seen_condition_ids = set()
+            with ThreadPoolExecutor(max_workers=DISCOVERY_MAX_PARALLEL) as executor, \
+                    telemetry.phase("Condition discovery", DISCOVERY_MAX_PARALLEL, len(code_chunks)) as phase:
+                future_to_index = {executor.submit(phase.track(conditions_for_codes), self.smart,
+                                                   code_search_value(ICD_SYSTEM_NAME, chunk)): index
+                                   for index, chunk in enumerate(code_chunks)}
+                for future in as_completed(future_to_index):
+                    phase.task_done()
+                    try:
+                        entries = future.result()
+                    except RetryExhaustedError as exc:
+                        print(f"Skipping code group, query failed permanently: {exc}\n")
+                        continue
+                    self.chunk_entries[future_to_index[future]] = entries
+                    patient_conditions = list(cohort_conditions(entries, seen_condition_ids, self.shard))
+                    if patient_conditions:
+                        self.condition_queue.put(patient_conditions)
+        finally:
+            self.condition_queue.put(DONE)
+
+    def confirm(self):
+        """
+        Checks the queued Conditions for the chief complaint flag, one Encounter search per chunk (see
+        encounter_diagnosis_chunks), and queues the patients once their first Condition is confirmed.
+        """
+        try:
+            with ThreadPoolExecutor(max_workers=DISCOVERY_MAX_PARALLEL) as executor, \
+                    telemetry.phase("Main diagnosis check", DISCOVERY_MAX_PARALLEL, 0) as phase:
+                futures = []
+                for patient_conditions in iter(self.condition_queue.get, DONE):
+                    start = 0
+                    for chunk in encounter_diagnosis_chunks(['Condition/' + condition['id']
+                                                             for _, condition in patient_conditions]):
+                        phase.total += 1
+                        futures.append(executor.submit(phase.track(self.check_conditions),
+                                                       patient_conditions[start:start + len(chunk)]))
+                        start += len(chunk)
+                for future in as_completed(futures):
+                    phase.task_done()
+                    try:
+                        future.result()
+                    except Exception as exc:
+                        print(f"Main diagnosis check generated an exception: {exc}.\n")
+        finally:
+            self.patient_queue.put(DONE)
+
+    def check_conditions(self, patient_conditions):
+        counts = chief_complaint_counts(self.smart, patient_conditions)
+        confirmed = []
+        with self._lock:
+            self.chief_complaints.update(counts)
+            for patient, condition in patient_conditions:
+                if counts['Condition/' + condition['id']] and patient not in self.confirmed:
+                    self.confirmed.add(patient)
+                    confirmed.append(patient)
+        # Put outside of the lock, a full queue blocks this worker until the extraction catches up
+        for patient in confirmed:
+            self.patient_queue.put(patient)
+
+    def extract(self):
+        """
+        Fetches the resources of the confirmed patients, at most MAX_WORKERS patients at a time.
+        """
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+                telemetry.phase("Pipeline extraction", MAX_WORKERS, 0) as phase:
+            pending = {}
+            for patient in iter(self.patient_queue.get, DONE):
+                while len(pending) >= MAX_WORKERS:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        self.store(future, pending.pop(future), phase)
+                phase.total += 1
+                pending[executor.submit(phase.track(fetch_patient), self.smart, patient, self.plan)] = patient
+            for future in as_completed(pending):
+                self.store(future, pending[future], phase)
+
+    def store(self, future, patient, phase):
+        phase.task_done()
+        try:
+            count = store_patient_group([patient], self.plan, self.aggregators, future.result())
+            print(f"Processed patient {patient} with {count} entries.\n")
+        except Exception as exc:
+            discard_patients(self.aggregators, [patient])
+            print(f"Patient {patient} generated an exception: {exc}.\n")
+
+    def write_cohort_files(self):
+        """
+        Writes the intermediate files and the cohort metadata, in the order of a run of CohortPatientsExecute.
+        """
+        patients_conditions_map = defaultdict(list)
+        seen_condition_ids = set()
+        for entries in self.chunk_entries:
+            for patient, condition in cohort_conditions(entries, seen_condition_ids, self.shard):
+                patients_conditions_map[patient].append(condition)
+        write_cohort(patients_conditions_map)
+        write_main_diagnoses(patients_conditions_map, self.chief_complaints)
+
+
+def execute_pipeline(smart, extraction_plan, shard=None):
+    """
+    Runs the cohort discovery, the main diagnosis filter and the resource extraction as a pipeline.
+    :param extraction_plan: List of (code file, Fhir resource model, code type, FrequencyAggregator or None)
+    :param shard: (i, N) to process only shard i of N of the cohort, see Sharding
+    """
+    plan, aggregators = begin_patient_extraction(extraction_plan)
+    pipeline = CohortPipeline(smart, plan, aggregators, shard)
+    with ThreadPoolExecutor(max_workers=2) as stages:
+        discovery, confirmation = stages.submit(pipeline.discover), stages.submit(pipeline.confirm)
+        pipeline.extract()
+        discovery.result()
+        confirmation.result()
+
+    pipeline.write_cohort_files()
+    finish_patient_extraction(plan, aggregators)
+    print(f"{len(pipeline.confirmed)} patients confirmed and extracted.\n")
+    print("---------------End of Code------------------------")
@@ -1,159 +1,417 @@
+import inspect
 import os
 from collections import defaultdict
+from functools import partial
 import json
-import time
 
 from fhirclient.models.medication import Medication
 from fhirclient.models.medicationadministration import MedicationAdministration
 from fhirclient.models.medicationrequest import MedicationRequest
 from fhirclient.models.medicationstatement import MedicationStatement
 
-from Constants import USER_NAME, USER_PASSWORD, ICD_SYSTEM_NAME, LOINC_SYSTEM_NAME, MAX_WORKERS, ATC_SYSTEM_NAME, \
-    ASTHMA_COPD_CODES_FILE
+from CodeRegistry import load_code_list
+from Constants import USER_NAME, USER_PASSWORD, ICD_SYSTEM_NAME, LOINC_SYSTEM_NAME, MAX_WORKERS, USE_BELOW_SEARCH, \
+    CHECKPOINTING, INCREMENTAL_REFRESH, KEEP_RESULT_FILES, RESPONSE_CACHE
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from FhirHelpersUtils import connect_to_server, fetch_bundle_for_code
+from FrequencyAggregation import FrequencyAggregator
+from FhirHelpersMedicationResolution import resolve_medications, atc_code_for_reference, save_medication_cache
+from FhirHelpersUtils import connect_to_server, iter_bundle_pages, iter_search_pages, plan_code_chunks, \
+    code_search_value, unique_entries
 from Metadata import gather_metadata
+from ResultFiles import ResultWriter, result_path, patient_file_name
+from ResultStore import result_store, PatientResults, write_result_file
+from RunState import RunState
+from Telemetry import telemetry
+
+MEDICATION_METADATA_NAMES = {
+    "MedicationAdministration": "medicationAdministrations_counts",
+    "MedicationRequest": "medicationRequests_counts",
+    "MedicationStatement": "medicationStatements_counts",
+}
 
 def read_input_code_file(filename):
     """
     :param filename:  input file of code list
-    :return:
+    :return: Indexed code list (CodeList, loaded once per process) and its code system
     """
-    with open(filename, "r") as fp:
-        lines = json.load(fp)
-
-        if 'loinc_codes' in filename:
-            system = LOINC_SYSTEM_NAME
-            if not os.path.exists(f"fhir_results/LOINC/"):
-                os.makedirs(f"fhir_results/LOINC/")
-            code_list = [item['code'] for item in lines['codes']]
-
-        elif 'icd_codes' in filename:
-            system = ICD_SYSTEM_NAME
-            if not os.path.exists(f"fhir_results/ICD/"):
-                os.makedirs(f"fhir_results/ICD/")
-            code_list = [code for item in lines['codes'] for code in item['code']]
-
-        elif 'atc_codes' in filename:
-            system = ATC_SYSTEM_NAME
-            if not os.path.exists(f"fhir_results/ATC/"):
-                os.makedirs(f"fhir_results/ATC/")
-                os.makedirs(f"fhir_results/ATC/Administrations/")
-                os.makedirs(f"fhir_results/ATC/Requests/")
-                os.makedirs(f"fhir_results/ATC/Statements/")
-            code_list = [code['code'] for code in lines]
+    code_list = load_code_list(filename)
+    return code_list, code_list.system
 
-    return code_list, system
-
-def write_results(entries, patient_counter, code_type, source):
+def create_result_folders(filename):
     """
-    It reads all Resources in the bundle and write to output files per patient.
+    Creates the output folders for the resources of the code file.
+    :param filename:  input file of code list
     """
-    if code_type == "LOINC":
-        whole_path = "fhir_results/LOINC/" + patient_counter + "_patient_observations.json"
-    elif code_type == "ICD":
-        whole_path = "fhir_results/ICD/" + patient_counter + "_patient_conditions.json"
-    elif code_type == "ATC":
-        if source is MedicationAdministration:
-            whole_path = "fhir_results/ATC/Administrations/" + patient_counter + "_patient_medicationAdministrations.json"
-        elif source is MedicationRequest:
-            whole_path = "fhir_results/ATC/Requests/" + patient_counter + "_patient_medicationRequests.json"
-        elif source is MedicationStatement:
-            whole_path = "fhir_results/ATC/Statements/" + patient_counter + "_patient_medicationStatements.json"
-
-    with open(whole_path, 'w') as file:
-        json.dump(entries, file, indent=4)
+    if 'loinc_codes' in filename:
+        os.makedirs("fhir_results/LOINC/", exist_ok=True)
+    elif 'icd_codes' in filename:
+        os.makedirs("fhir_results/ICD/", exist_ok=True)
+    elif 'atc_codes' in filename:
+        for folder in ["Administrations", "Requests", "Statements"]:
+            os.makedirs(f"fhir_results/ATC/{folder}/", exist_ok=True)
+
+def code_searches(struct, resource_type, code_list, system, code_param='code', below=False):
+    """
+    Adds the code filter to the search parameters, one search per chunk of codes. ":below" also matches children
+    which are not listed, so it is only used for resource types whose results are checked against the code list.
+    :param below: Search listed codes whose children are listed as well with ":below" instead of code by code
+    """
+    if below:
+        below_codes, exact_codes = code_list.below_search_groups()
+        groups = [(code_param + ':below', below_codes), (code_param, exact_codes)]
+    else:
+        groups = [(code_param, code_list)]
+    return [dict(struct, **{param: code_search_value(system, chunk)})
+            for param, codes in groups
+            for chunk in plan_code_chunks(resource_type, struct, system, codes, param)]
 
+def write_results(entries, code_type, source, patient):
+    """
+    Stores the entries of a patient in the result store, replacing its earlier resources. The per-patient result
+    file is only written with KEEP_RESULT_FILES.
+    """
+    result_store().add_patient(code_type, source.resource_type, patient, entries)
+    if KEEP_RESULT_FILES:
+        with ResultWriter(result_path(code_type, source, patient_file_name(patient))) as writer:
+            for entry in entries:
+                writer.write(entry)
+
+def stream_results(function_to_run, patient, code_file, source, smart, code_type, run_state=None, since=None,
+                   aggregator=None):
+    """
+    Stores the entries yielded by function_to_run in the result store while they are fetched, so memory is
+    bounded by the page size instead of the patient's history.
+    With a run state, the entries of each page are stored before the page is recorded, a restarted run continues
+    at the last recorded page. Without, the stored entries of the patient are dropped on errors.
+    :param run_state: RunState for checkpointing, None to fetch without
+    :param since: Only fetch resources updated after this time ("_lastUpdated")
+    :param aggregator: FrequencyAggregator counting the entries while they are stored
+    :return: Number of entries stored
+    """
+    if run_state is not None:
+        return stream_checkpointed_results(function_to_run, patient, code_file, source, smart, code_type,
+                                           run_state, since, aggregator)
 
+    try:
+        with PatientResults(code_type, source.resource_type, patient) as writer:
+            for entry in function_to_run(patient, code_file, source, smart):
+                writer.write(entry)
+                if aggregator is not None:
+                    aggregator.count(patient, entry)
+    except Exception:
+        result_store().remove_patient(source.resource_type, patient)
+        raise
+    return writer.count
+
+def stream_checkpointed_results(function_to_run, patient, code_file, source, smart, code_type, run_state, since,
+                                aggregator=None):
+    checkpoint = run_state.checkpoint(source.resource_type, patient, since)
+    writer = PatientResults(code_type, source.resource_type, patient)
+    stored_count = run_state.stored_count(source.resource_type, patient)
+    if since is None:
+        # All stored resources of the patient were fetched by this run, also those of a page stored but not recorded
+        checkpoint.seen = result_store().patient_ids(source.resource_type, patient)
+        writer.count = len(checkpoint.seen)
+        if aggregator is not None:
+            for entry in result_store().iter_entries(source.resource_type, patient):
+                aggregator.count(patient, entry)
+    elif stored_count is not None:
+        writer.count = stored_count
+    if stored_count is not None:
+        print(f"Resuming patient {patient} after {writer.count} entries.\n")
+
+    checkpoint.writer = writer
+    with writer:
+        for entry in function_to_run(patient, code_file, source, smart, checkpoint):
+            writer.write(entry)
+            if aggregator is not None:
+                aggregator.count(patient, entry)
+    return writer.count
+
+def iter_search_entries(smart, source, searches, checkpoint=None, page_filter=None):
+    """
+    Yields the entries of the searches page by page, each resource once.
+    With a checkpoint, searches finished before are skipped, an interrupted search continues at its last page
+    and every page is recorded once its entries were consumed.
+    :param page_filter: Function filtering the entries of a page, e.g. filter_medications
+    """
+    page_filter = page_filter or (lambda entries: entries)
+    if checkpoint is None:
+        for struct in searches:
+            for entries, next_url in iter_search_pages(smart, source.resource_type, struct):
+                yield from page_filter(entries)
+        return
+
+    for struct in searches:
+        if checkpoint.since:
+            struct = dict(struct, _lastUpdated='gt' + checkpoint.since)
+        chunk_key = checkpoint.chunk_key(struct)
+        if checkpoint.chunk_done(chunk_key):
+            continue
+        cursor = checkpoint.cursor(chunk_key)
+        pages = iter_bundle_pages(smart, cursor) if cursor else iter_search_pages(smart, source.resource_type, struct)
+        for entries, next_url in pages:
+            yield from page_filter(unique_entries(entries, checkpoint.seen))
+            checkpoint.page_done(chunk_key, next_url)
+
+def observation_searches(patient, code_file):
+    """
+    Search parameters of the Observation queries for the patient. The LOINC filter is sent to the server
+    in chunks of codes sized by the URL length limit.
+    """
+    code_list, system = read_input_code_file(code_file)
+    return code_searches({'_count': b'1000', 'subject': patient}, 'Observation', code_list, system,
+                         below=USE_BELOW_SEARCH)
 
-def observations(patient, code_file, source, smart):
-    print(f"Creating queries for patient {patient} for observation resources...\n")
-    while True:
-        try:
-            bundle = source.where(struct={'_count': b'1000', 'subject': patient}).perform(smart.server)
-            break
-        except Exception as exc:
-            print(f"Generated an exception: {exc} but continue to trying... \n")
-            time.sleep(3)
-            smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
-
-    observations_bundles = fetch_bundle_for_code(smart, bundle)
+def filter_observations(observations_bundles, code_file):
+    """
+    Keeps only the Observations coded with one of the LOINC codes of the code file.
+    """
     code_list, system = read_input_code_file(code_file)
-    filtered_results = []
     for observation in observations_bundles:
         if 'code' in observation['resource'] and 'coding' in observation['resource']['code']:
             for coding in observation['resource']['code']['coding']:
                 if LOINC_SYSTEM_NAME == coding['system'] and coding['code'] in code_list:
-                    filtered_results.append(observation)
-    print(f"Patient {patient} has {len(filtered_results)} observations.")
-    return filtered_results
+                    yield observation
 
-def conditions(patient, code_file, source, smart,):
+def condition_searches(patient, code_file):
+    """
+    Search parameters of the Condition queries for the patient, one per chunk of the ICD code list.
+    """
+    code_list, system = read_input_code_file(code_file)
+    return code_searches({'_count': b'1000', 'subject': patient}, 'Condition', code_list, system,
+                         below=USE_BELOW_SEARCH)
+
+def filter_conditions(conditions_bundles, code_file):
+    """
+    ":below" searches also return codes which are not listed, keeps only the Conditions with a listed ICD code.
+    """
+    if not USE_BELOW_SEARCH:
+        yield from conditions_bundles
+        return
+    code_list, system = read_input_code_file(code_file)
+    for condition in conditions_bundles:
+        if any(system == coding.get('system') and coding.get('code') in code_list
+               for coding in condition['resource'].get('code', {}).get('coding', [])):
+            yield condition
+
+def medication_searches(patient, code_file, source):
+    """
+    Search parameters of the Medication* queries for the patient. MedicationAdministration/Request/Statement are
+    searched by patient only, one query instead of one per chunk of the ATC code list, and filtered by
+    filter_medications, as their ATC code has to be resolved through the Medication anyway.
+    """
+    if source == Medication:
+        code_list, system = read_input_code_file(code_file)
+        return code_searches({'_count': b'1000', 'subject': patient}, source.resource_type, code_list, system)
+    return [{'_count': b'1000', 'patient': patient}]
+
+def filter_medications(medication_entries, code_file, smart=None):
+    """
+    Keeps only the Medication* resources with one of the ATC codes of the code file, in their
+    medicationCodeableConcept or in the referenced Medication. Medications not resolved before are fetched in
+    batches first, see resolve_medications. With the response cache, all Medications of the page are fetched, so
+    the page gives the same queries in every run and can be replayed offline.
+    """
     code_list, system = read_input_code_file(code_file)
-    sub_code_lists = [code_list[i:i + 30] for i in range(0, len(code_list), 30)]  # Smaller chunks of code list
-    conditions = []
+    medication_entries = list(medication_entries)
+    references = [entry['resource'].get('medicationReference', {}).get('reference')
+                  for entry in medication_entries]
+    if any(references):
+        resolve_medications(smart or connect_to_server(user=USER_NAME, pw=USER_PASSWORD),
+                            [reference for reference in references if reference],
+                            skip_cached=RESPONSE_CACHE == "off")
+    for entry, reference in zip(medication_entries, references):
+        concept = entry['resource'].get('medicationCodeableConcept', {})
+        if any(system == coding.get('system') and coding.get('code') in code_list
+               for coding in concept.get('coding', [])) \
+                or (reference and atc_code_for_reference(reference, code_list) is not None):
+            yield entry
+
+def iter_observations(patient, code_file, source, smart, checkpoint=None):
+    """
+    Yields the Observations of the patient with one of the LOINC codes, page by page.
+    """
+    print(f"Creating queries for patient {patient} for observation resources...\n")
+    observations_bundles = iter_search_entries(smart, source, observation_searches(patient, code_file), checkpoint)
+    yield from filter_observations(unique_entries(observations_bundles), code_file)
+
+def iter_conditions(patient, code_file, source, smart, checkpoint=None):
+    """
+    Yields the Conditions of the patient with one of the ICD codes, page by page.
+    """
     print(f"Creating queries for patient {patient} for conditions...\n")
-    for sub_code_list in sub_code_lists:
-        sub_code_list_str = ','.join([system + '|' + code for code in sub_code_list])
-        while True:
-            try:
-                bundle = source.where(struct={'_count': b'1000', 'subject': patient, 'code': sub_code_list_str}).perform(smart.server)
-                break
-            except Exception as exc:
-                print(f"Generated an exception: {exc} but continue to trying... \n")
-                time.sleep(3)
-                smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
+    conditions = iter_search_entries(smart, source, condition_searches(patient, code_file), checkpoint)
+    yield from filter_conditions(unique_entries(conditions), code_file)
 
-        batch_result = fetch_bundle_for_code(smart, bundle)
+def iter_medications(patient, code_file, source, smart, checkpoint=None):
+    """
+    Yields the Medication* resources of the patient with one of the ATC codes, page by page.
+    """
+    print(f"Creating queries for patient {patient}...\n")
+    page_filter = None if source == Medication else partial(filter_medications, code_file=code_file, smart=smart)
+    medications_bundles = iter_search_entries(smart, source, medication_searches(patient, code_file, source),
+                                              checkpoint, page_filter)
+    yield from unique_entries(medications_bundles)
 
-        if len(batch_result) > 0:
-            conditions.extend(batch_result)
+def observations(patient, code_file, source, smart):
+    filtered_results = list(iter_observations(patient, code_file, source, smart))
+    print(f"Patient {patient} has {len(filtered_results)} observations.")
+    return filtered_results
 
-    return conditions
+def conditions(patient, code_file, source, smart,):
+    return list(iter_conditions(patient, code_file, source, smart))
 
 def medications(patient, code_file, source, smart):
-    code_list, system = read_input_code_file(code_file)
-    code_list_str = ','.join([system + '|' + code for code in code_list])
+    return list(iter_medications(patient, code_file, source, smart))
 
-    print(f"Creating queries for patient {patient}...\n")
-    while True:
-        try:
-            if source == Medication:
-                bundle = (source.where(struct={'_count': b'1000', 'subject': patient, 'code': code_list_str})
-                          .perform(smart.server))
-            else:
-                bundle = source.where(
-                    struct={'_count': b'1000', 'patient': patient, 'medication.code': code_list_str}).perform(
-                    smart.server)
-            break
-        except Exception as exc:
-            print(f"Generated an exception: {exc} but continue to trying... \n")
-            smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
-            time.sleep(3)
-    medications_bundles = fetch_bundle_for_code(smart, bundle)
-    return medications_bundles
-
-def execute_thread_for_fetching(code_file, source, patient_list, code_type, function_to_run):
+def begin_extraction_run(extraction_plan):
+    """
+    Starts or resumes the checkpointed extraction run of all resource types of the plan, see RunState.
+    :param extraction_plan: List of (code file, Fhir resource model, code type)
+    :return: Id of the extraction run for execute_thread_for_fetching, None without CHECKPOINTING
+    """
+    if not CHECKPOINTING:
+        return None
+    return RunState().begin_extraction([source.resource_type for _, source, _ in extraction_plan])
+
+def finish_extraction_run(extraction_run):
+    """
+    Completes the extraction run once all its resource types were fetched, a restart starts a new run then.
+    """
+    if extraction_run is not None and not RunState().finish_extraction(extraction_run):
+        print("Extraction run incomplete, restart to fetch the remaining resources.\n")
+
+def execute_thread_for_fetching(code_file, source, patient_list, code_type, function_to_run, aggregator=None,
+                                extraction_run=None):
     """
     Threads for running fetch queries parallel.
+    function_to_run either returns the entries of a patient (observations, conditions, medications) or yields
+    them (iter_observations, iter_conditions, iter_medications). Yielded entries are stored in the result
+    store while they are fetched, with CHECKPOINTING the progress is recorded so an interrupted run resumes.
+    :param aggregator: FrequencyAggregator counting the fetched entries, which also takes the patient count
+    instead of metadata.json
+    :param extraction_run: Extraction run of all resource types, see begin_extraction_run. The resource type is
+    skipped if it was fetched completely within the run. Without, the resource type is a run of its own.
     """
+    create_result_folders(code_file)
     smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_code = {executor.submit(function_to_run, patient, code_file, source, smart): patient for patient in patient_list}
-        counter = 0
+    streaming = inspect.isgeneratorfunction(function_to_run)
+    run_state = RunState() if streaming and CHECKPOINTING else None
+    counter = 0
+    failed = False
+    completed_before = False
+    since, known = None, set()
+    if run_state is not None:
+        own_run = extraction_run is None
+        if own_run:
+            extraction_run = run_state.begin_extraction([source.resource_type])
+        completed_before = run_state.run_completed(source.resource_type, extraction_run)
+    if completed_before:
+        print(f"Skipping {source.resource_type}, fetched completely before the extraction run was interrupted.\n")
+        patient_list = []
+        if aggregator is not None:
+            aggregator.mark_incomplete("fetched before the restart")
+    elif run_state is not None:
+        resuming = run_state.run_unfinished(source.resource_type)
+        since = run_state.begin_run(source.resource_type, INCREMENTAL_REFRESH, extraction_run)
+        finished = run_state.finished_patients(source.resource_type)
+        known = run_state.known_patients(source.resource_type)
+        counter = run_state.max_counter(source.resource_type)
+        print(f"Skipping {len(finished)} patients finished before.\n")
+        patient_list = [patient for patient in patient_list if patient not in finished]
+        if aggregator is not None and finished:
+            aggregator.mark_incomplete("patients finished by an earlier run are skipped")
+        if aggregator is not None and since is not None:
+            aggregator.mark_incomplete("incremental refresh")
+        if not resuming and since is None:
+            result_store().clear(source.resource_type)
+    else:
+        result_store().clear(source.resource_type)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+            telemetry.phase(source.resource_type, MAX_WORKERS, len(patient_list)) as phase:
+        if run_state is not None:
+            future_to_code = {executor.submit(phase.track(stream_results), function_to_run, patient, code_file, source, smart,
+                                              code_type, run_state, since if patient in known else None, aggregator): patient
+                              for patient in patient_list}
+        elif streaming:
+            future_to_code = {executor.submit(phase.track(stream_results), function_to_run, patient, code_file, source, smart,
+                                              code_type, aggregator=aggregator): patient
+                              for patient in patient_list}
+        else:
+            future_to_code = {executor.submit(phase.track(function_to_run), patient, code_file, source, smart): patient
+                              for patient in patient_list}
         for future in as_completed(future_to_code):
             patient = future_to_code[future]
+            phase.task_done()
             try:
-                entries = future.result()
-                if entries:
-                    counter += 1
-                    write_results(entries, str(counter), code_type, source)
-                print(f"Processed patient {patient} with {len(entries)} entries.\n")
+                if run_state is not None:
+                    entry_count = future.result()
+                    counter = finish_checkpointed_patient(run_state, patient, entry_count, counter, code_type, source,
+                                                          since is not None and patient in known)
+                elif streaming:
+                    entry_count = future.result()
+                    if entry_count:
+                        counter += 1
+                        if KEEP_RESULT_FILES:
+                            write_result_file(code_type, source, patient)
+                else:
+                    entries = future.result()
+                    entry_count = len(entries)
+                    if entries:
+                        counter += 1
+                        write_results(entries, code_type, source, patient)
+                    if aggregator is not None:
+                        for entry in entries:
+                            aggregator.count(patient, entry)
+                if aggregator is not None:
+                    aggregator.finish_patient(patient)
+                print(f"Processed patient {patient} with {entry_count} entries.\n")
             except Exception as exc:
+                failed = True
+                if aggregator is not None:
+                    aggregator.discard_patient(patient)
                 print(f"Patient {patient} generated an exception: {exc}.\n")
 
+    if run_state is not None and not completed_before:
+        if not failed:
+            run_state.complete_run(source.resource_type)
+        else:
+            print(f"Run incomplete, restart to fetch the failed patients.\n")
+    if run_state is not None and own_run:
+        run_state.finish_extraction(extraction_run)
+    if aggregator is not None:
+        aggregator.patient_count = result_store().patient_count(source.resource_type)
+    else:
+        gather_fetch_metadata(code_type, source, result_store().patient_count(source.resource_type))
+    print("---------------End of Code------------------------")
+
+def finish_checkpointed_patient(run_state, patient, entry_count, counter, code_type, source, update):
+    """
+    Records a finished patient, whose resources are in the result store already, and writes its result file
+    with KEEP_RESULT_FILES.
+    :param update: Incremental refresh of a patient fetched before, a result file written before is rewritten
+    with the updated resources
+    :return: Counter of the last result file
+    """
+    if update:
+        result_file = run_state.result_file(source.resource_type, patient)
+        if entry_count and result_file is not None and os.path.exists(result_file):
+            write_result_file(code_type, source, patient, result_file)
+    elif entry_count:
+        counter += 1
+        result_file = write_result_file(code_type, source, patient) if KEEP_RESULT_FILES else None
+        run_state.set_result_file(source.resource_type, patient, result_file, counter)
+    else:
+        run_state.set_result_file(source.resource_type, patient, None, None)
+    run_state.finish_patient(source.resource_type, patient, entry_count)
+    return counter
 
+def gather_fetch_metadata(code_type, source, counter):
+    """
+    Stores the number of patients with results of a fetch run.
+    """
     ###META DATA COLLECTION###
     '''
     patient_count_with_secondary_conditions: Number of cohort patients that has secondary conditions (non main diagnosis ASTHMA OR COPD) 
@@ -164,134 +422,138 @@ def execute_thread_for_fetching(code_file, source, patient_list, code_type, func
     medication_counts: Frequency of each ATC code 
     '''
 
+    name = patient_count_metadata_name(code_type, source)
+    if name is not None:
+        gather_metadata(name, counter)
+
+def patient_count_metadata_name(code_type, source):
     if code_type == "LOINC":
-        gather_metadata("patient_count_with_observations", counter)
+        return "patient_count_with_observations"
     elif code_type == "ATC":
         if source is MedicationAdministration:
-            gather_metadata("patient_count_with_medicationAdministrations", counter)
+            return "patient_count_with_medicationAdministrations"
         elif source is MedicationRequest:
-            gather_metadata("patient_count_with_medicationRequests", counter)
+            return "patient_count_with_medicationRequests"
         elif source is MedicationStatement:
-            gather_metadata("patient_count_with_medicationStatements", counter)
-    else:
-        pass
-    print("---------------End of Code------------------------")
+            return "patient_count_with_medicationStatements"
+    return None
 
-def observation_frequencies(code_file):
-    folder_path = "fhir_results/LOINC"
-    observations_counts = defaultdict(int)
+def frequency_aggregator(code_file, source, code_type):
+    """
+    FrequencyAggregator for the metadata frequencies of a fetch run, see aggregated_metadata.
+    """
     code_list, system = read_input_code_file(code_file)
+    if code_type == "LOINC":
+        return FrequencyAggregator(source.resource_type, LOINC_SYSTEM_NAME, code_list)
+    elif code_type == "ICD":
+        return FrequencyAggregator(source.resource_type, ICD_SYSTEM_NAME, code_list, main_diagnoses_ids())
+    return FrequencyAggregator(source.resource_type)
+
+def aggregated_metadata(code_file, source, code_type, aggregator, frequencies=True):
+    """
+    Metadata of a fetch run counted by its FrequencyAggregator, for a single update of metadata.json.
+    :param frequencies: Include the frequencies, False if they are computed from the result store instead
+    :return: Dictionary metadata name -> value
+    """
+    metadata = {}
+    name = patient_count_metadata_name(code_type, source)
+    if name is not None:
+        metadata[name] = aggregator.patient_count
+    if not frequencies:
+        return metadata
+
+    if code_type == "LOINC":
+        metadata["observations_counts"] = aggregator.counts
+    elif code_type == "ICD":
+        metadata["secondary_conditions_counts"] = aggregator.counts
+        metadata["patient_count_with_secondary_conditions"] = len(aggregator.patients)
+    elif code_type == "ATC":
+        code_list, system = read_input_code_file(code_file)
+        smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
+        metadata[MEDICATION_METADATA_NAMES[source.resource_type]] = medication_counts(
+            smart, source.resource_type, aggregator.counts, code_list)
+    return metadata
 
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".json"):
-            file_path = os.path.join(folder_path, filename)
-            with open(file_path, 'r') as json_file:
-                data = json.load(json_file)
-                for observation in data:
-                    if 'code' in observation['resource'] and 'coding' in observation['resource']['code']:
-                        for coding in observation['resource']['code']['coding']:
-                            if LOINC_SYSTEM_NAME == coding['system'] and coding['code'] in code_list:
-                                observations_counts[coding['code']] += 1
+def observation_frequencies(code_file):
+    code_list, system = read_input_code_file(code_file)
+    observations_counts, patient_count = result_store().code_counts('Observation', LOINC_SYSTEM_NAME, code_list)
 
     for code, frequency in observations_counts.items():
         print(f"{code}: {frequency}")
     gather_metadata("observations_counts", observations_counts)
 
-def secondary_conditions_frequencies(code_file):
-    folder_path = "fhir_results/ICD"
-    code_list, system = read_input_code_file(code_file)
-    conditions_counts = defaultdict(int)
-
-    pats = set()
+def main_diagnoses_ids():
+    """
+    Ids of the main diagnosis Conditions of the cohort, which are not counted as secondary conditions.
+    """
     main_diagnoses_ids = set()
-
     with open("patients_main_diagnosed_asthma_copd.json", "r") as file:
         patients = json.load(file)
         for conditions in patients.values():
             main_diagnoses_ids.update(condition['id'] for condition in conditions)
+    return main_diagnoses_ids
 
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".json"):
-            file_path = os.path.join(folder_path, filename)
-            with open(file_path, 'r') as json_file:
-                data = json.load(json_file)
-                for condition in data:
-                    if 'code' in condition['resource'] and 'coding' in condition['resource']['code']:
-                        for coding in condition['resource']['code']['coding']:
-                            if ICD_SYSTEM_NAME == coding['system'] and coding['code'] in code_list:
-                                if condition['resource']['id'] not in main_diagnoses_ids:
-                                    pats.add(condition['resource']['subject']['reference'])
-                                    conditions_counts[coding['code']] += 1
-
+def secondary_conditions_frequencies(code_file):
+    code_list, system = read_input_code_file(code_file)
+    conditions_counts, patient_count = result_store().code_counts('Condition', ICD_SYSTEM_NAME, code_list,
+                                                                  main_diagnoses_ids())
     gather_metadata("secondary_conditions_counts", conditions_counts)
-    gather_metadata("patient_count_with_secondary_conditions", len(pats))
+    gather_metadata("patient_count_with_secondary_conditions", patient_count)
 
 
 def fetch_atc_codes(resource_ref, system, code_list):
     smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
 
     try:
-        source, medication_reference_id = resource_ref.split('/')
-        if source:
-            medication = Medication.read(medication_reference_id, smart.server)
-            if medication.code.coding:
-                for coding in medication.code.coding:
-                    if system == coding.system and coding.code in code_list:
-                        return coding.code
+        resolve_medications(smart, [resource_ref])
+        return atc_code_for_reference(resource_ref, code_list)
 
     except Exception as error:
         print(f"Generated an exception:{error} for {resource_ref}")
 
 
-def medication_frequencies(code_file):
-    folder_paths =  ["fhir_results/ATC/Administrations", "fhir_results/ATC/Requests", "fhir_results/ATC/Statements"]
-    code_list, system = read_input_code_file(code_file)
+def medication_counts(smart, resource_type, references, code_list):
+    """
+    Counts of the ATC codes of the referenced Medications.
+    :param references: Dictionary Medication reference -> number of resources referencing it
+    :return: Counting structure of the metadata
+    """
+    # Fetching the referenced "Medication"s in batches, each distinct reference only once.
+    resolve_medications(smart, list(references))
+    save_medication_cache()
+    return medication_code_counts(resource_type, references, code_list)
 
-    for folder_path in folder_paths:
-        medication_type_and_med_reference = {}
-        resource_structure = defaultdict(lambda: {
-            "counting": {
-                "total_count": 0,
-                "details_count": [],
-            }})
-
-        # Gathering, counting and fetching ID-references for "Medication".
-        for filename in os.listdir(folder_path):
-            if filename.endswith(".json"):
-                file_path = os.path.join(folder_path, filename)
-                with (open(file_path, 'r') as json_file):
-                    data = json.load(json_file)
-                    print(f"\nReading {filename}")
-
-                    for medicationReference in data:
-                        if 'resource' in medicationReference:
-                            resource_type = medicationReference['resource']['resourceType']
-                            resource_ref = medicationReference['resource']['medicationReference']['reference']
-
-                            code_name = fetch_atc_codes(resource_ref, system, code_list)
-                            print("Fetched code name:", code_name)
-
-                            if resource_type not in medication_type_and_med_reference:
-                                medication_type_and_med_reference[resource_type] = {}
-                            medication_type_and_med_reference[resource_type][code_name] = (
-                                    medication_type_and_med_reference[resource_type].get(code_name, 0) + 1)
-                        else:
-                            print(f"{filename}  has no 'resource' statement within this file.")
-
-        # Estimates TOTAL counts per medication resource and structures data as outcomes
-        for resource_type, num_references in medication_type_and_med_reference.items():
-            total_count = sum(num_references.values())
-            details_count = [{ref: count} for ref, count in num_references.items()]
-
-            resource_structure[resource_type]["counting"]["total_count"] = total_count
-            resource_structure[resource_type]["counting"]["details_count"] = details_count
-
-        print("final resource outcome", resource_structure)
-        if "Administrations" in folder_path:
-            gather_metadata("medicationAdministrations_counts", resource_structure)
-        elif "Requests" in folder_path:
-            gather_metadata("medicationRequests_counts", resource_structure)
-        elif "Statements" in folder_path:
-            gather_metadata("medicationStatements_counts", resource_structure)
+def medication_code_counts(resource_type, references, code_list, atc_codes_by_id=None):
+    """
+    Counting structure of the metadata from already resolved Medications.
+    :param references: Dictionary Medication reference -> number of resources referencing it
+    :param atc_codes_by_id: Medication id -> ATC codes, the Medication cache if not given
+    """
+    resource_structure = defaultdict(lambda: {
+        "counting": {
+            "total_count": 0,
+            "details_count": [],
+        }})
+
+    num_references = {}
+    for resource_ref, count in references.items():
+        code_name = atc_code_for_reference(resource_ref, code_list, atc_codes_by_id)
+        num_references[code_name] = num_references.get(code_name, 0) + count
+
+    # Estimates TOTAL counts per medication resource and structures data as outcomes
+    if num_references:
+        resource_structure[resource_type]["counting"]["total_count"] = sum(num_references.values())
+        resource_structure[resource_type]["counting"]["details_count"] = [
+            {ref: count} for ref, count in num_references.items()]
+
+    print("final resource outcome", resource_structure)
+    return resource_structure
 
+def medication_frequencies(code_file):
+    code_list, system = read_input_code_file(code_file)
+    smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
 
+    for resource_type, metadata_name in MEDICATION_METADATA_NAMES.items():
+        # ID-references for "Medication" and their counts, in order of their first occurrence.
+        references = result_store().medication_reference_counts(resource_type)
+        gather_metadata(metadata_name, medication_counts(smart, resource_type, references, code_list))
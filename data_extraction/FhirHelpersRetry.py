@@ -0,0 +1,203 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from Constants import RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, CIRCUIT_BREAKER_WINDOW, \
+    CIRCUIT_BREAKER_ERROR_RATE, CIRCUIT_BREAKER_PAUSE, FAILED_QUERIES_FILE
+from ConcurrencyControl import acquire_request_slot, release_request_slot, rate_limiter
+from ResponseCache import OfflineCacheMissError
+from Telemetry import telemetry, query_type_of
+
+"""
+Central retry policy for all requests to the FHIR server: bounded attempts with exponential backoff and jitter,
+"Retry-After" of 429/503 responses is honored, and a circuit breaker shared by all workers pauses every request
+when the error rate spikes. Queries failing permanently are recorded in FAILED_QUERIES_FILE for a later rerun.
+The requests in flight and the request rate are limited by ConcurrencyControl.
+"""
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class RetryExhaustedError(Exception):
+    """Query failed permanently, it was recorded in FAILED_QUERIES_FILE."""
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome of the last requests of all workers. If the error rate of a full window reaches
+    the threshold, the breaker opens and every worker waits for the pause before sending its next request.
+    """
+
+    def __init__(self, window, error_rate, pause):
+        self.error_rate = error_rate
+        self.pause = pause
+        self._outcomes = deque(maxlen=window)
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def remaining_pause(self):
+        with self._lock:
+            return max(0.0, self._open_until - time.monotonic())
+
+    def wait(self):
+        remaining = self.remaining_pause()
+        if remaining:
+            time.sleep(remaining)
+
+    def record(self, success):
+        with self._lock:
+            self._outcomes.append(success)
+            if len(self._outcomes) < self._outcomes.maxlen or time.monotonic() < self._open_until:
+                return
+            failures = self._outcomes.count(False)
+            if failures / len(self._outcomes) >= self.error_rate:
+                self._open_until = time.monotonic() + self.pause
+                self._outcomes.clear()
+                print(f"Circuit breaker open: {failures} of the last requests failed, pausing all workers for {self.pause}s.\n")
+
+
+circuit_breaker = CircuitBreaker(CIRCUIT_BREAKER_WINDOW, CIRCUIT_BREAKER_ERROR_RATE, CIRCUIT_BREAKER_PAUSE)
+_failed_queries_lock = threading.Lock()
+
+
+def response_status(exc):
+    """
+    HTTP status code and headers of the failed response, (None, {}) for connection errors and timeouts.
+    Works for requests/fhirclient exceptions (exc.response) and aiohttp ClientResponseError (exc.status).
+    """
+    response = getattr(exc, 'response', None)
+    if response is not None and hasattr(response, 'status_code'):
+        return response.status_code, response.headers
+    if isinstance(getattr(exc, 'status', None), int):
+        return exc.status, getattr(exc, 'headers', None) or {}
+    return None, {}
+
+
+def is_retryable(exc):
+    if isinstance(exc, OfflineCacheMissError):
+        return False
+    status, headers = response_status(exc)
+    return status is None or status in RETRYABLE_STATUS_CODES
+
+
+def is_overload(exc):
+    """
+    The request failed because the server is overloaded: timeout, connection error, 429 or 5xx.
+    """
+    if isinstance(exc, OfflineCacheMissError):
+        return False
+    status, _ = response_status(exc)
+    return status is None or status == 429 or status >= 500
+
+
+def retry_after_seconds(headers):
+    """
+    Seconds given by a "Retry-After" header (delay in seconds or HTTP date), None if there is none.
+    """
+    retry_after = headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+def retry_delay(attempt, exc):
+    """
+    Seconds to wait before the next attempt: "Retry-After" of 429/503 responses if given,
+    otherwise exponential backoff with jitter.
+    """
+    status, headers = response_status(exc)
+    retry_after = retry_after_seconds(headers) if status in (429, 503) else None
+    if retry_after is not None:
+        return retry_after
+    backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+def record_failed_query(query, exc):
+    """
+    Appends the permanently failed query to FAILED_QUERIES_FILE, one JSON object per line.
+    """
+    with _failed_queries_lock:
+        os.makedirs(os.path.dirname(FAILED_QUERIES_FILE), exist_ok=True)
+        with open(FAILED_QUERIES_FILE, 'a') as file:
+            file.write(json.dumps({"time": datetime.now().isoformat(timespec='seconds'), "query": query,
+                                   "error": str(exc)}) + "\n")
+
+
+def call_with_retry(operation, query, query_type=None, retryable=is_retryable):
+    """
+    Runs the request with the retry policy, every attempt is recorded in the telemetry.
+    :param operation: Callable sending the request
+    :param query: Description of the query (e.g. search URL), recorded if the query fails permanently
+    :param query_type: Query type for the telemetry, taken from the query URL if not given
+    :param retryable: Decides whether a failed attempt is sent again, is_retryable if not given
+    :return: Result of operation
+    """
+    query_type = query_type or query_type_of(query)
+    for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+        circuit_breaker.wait()
+        acquire_request_slot()
+        started = time.monotonic()
+        try:
+            result = operation()
+        except Exception as exc:
+            release_request_slot(None, overloaded=is_overload(exc))
+            telemetry.record_request(query_type, time.monotonic() - started, ok=False)
+            circuit_breaker.record(False)
+            if attempt == RETRY_MAX_ATTEMPTS or not retryable(exc):
+                record_failed_query(query, exc)
+                raise RetryExhaustedError(f"{query} failed after {attempt} attempts: {exc}") from exc
+            delay = retry_delay(attempt, exc)
+            telemetry.record_retry(query_type)
+            print(f"Generated an exception: {exc}, retrying in {delay:.1f}s ({attempt}/{RETRY_MAX_ATTEMPTS}).\n")
+            time.sleep(delay)
+        else:
+            seconds = time.monotonic() - started
+            release_request_slot(seconds)
+            telemetry.record_request(query_type, seconds)
+            circuit_breaker.record(True)
+            return result
+
+
+async def async_call_with_retry(operation, query, query_type=None):
+    """
+    Async counterpart of call_with_retry.
+    :param operation: Coroutine function sending the request
+    :param query: Description of the query (e.g. search URL), recorded if the query fails permanently
+    :param query_type: Query type for the telemetry, taken from the query URL if not given
+    """
+    query_type = query_type or query_type_of(query)
+    for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+        await asyncio.sleep(circuit_breaker.remaining_pause())
+        # The asyncio engine limits its requests in flight with ASYNC_MAX_CONCURRENCY, only the rate cap applies
+        if rate_limiter is not None:
+            await asyncio.sleep(rate_limiter.reserve())
+        started = time.monotonic()
+        try:
+            result = await operation()
+        except Exception as exc:
+            telemetry.record_request(query_type, time.monotonic() - started, ok=False)
+            circuit_breaker.record(False)
+            if attempt == RETRY_MAX_ATTEMPTS or not is_retryable(exc):
+                record_failed_query(query, exc)
+                raise RetryExhaustedError(f"{query} failed after {attempt} attempts: {exc}") from exc
+            delay = retry_delay(attempt, exc)
+            telemetry.record_retry(query_type)
+            print(f"Generated an exception: {exc}, retrying in {delay:.1f}s ({attempt}/{RETRY_MAX_ATTEMPTS}).\n")
+            await asyncio.sleep(delay)
+        else:
+            telemetry.record_request(query_type, time.monotonic() - started)
+            circuit_breaker.record(True)
+            return result
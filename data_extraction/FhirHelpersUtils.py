@@ -1,58 +1,240 @@
-import time
+import threading
+from urllib.parse import quote, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
 from fhirclient import client
-from Constants import USER_NAME, USER_PASSWORD, SERVER_NAME
+from Constants import USER_NAME, USER_PASSWORD, SERVER_NAME, MAX_URL_LENGTH, MAX_WORKERS, DISCOVERY_MAX_PARALLEL, \
+    RESPONSE_CACHE, FULL_RESOURCES
+from FhirHelpersRetry import call_with_retry
+from ResponseCache import ResponseCache, CachingAdapter
+from Telemetry import telemetry, query_type_of
+
+# Elements of each searched resource type which are read by the analysis, requested with "_elements". Searches
+# are read as raw JSON, so elements required by the fhirclient models are not needed.
+PROJECTED_ELEMENTS = {
+    'Condition': ('subject', 'code'),
+    'Encounter': ('subject', 'diagnosis'),
+    'Observation': ('subject', 'code'),
+    'Medication': ('code',),
+    'MedicationAdministration': ('subject', 'medication'),
+    'MedicationRequest': ('subject', 'medication'),
+    'MedicationStatement': ('subject', 'medication'),
+}
+
+_connection_lock = threading.RLock()
+_session = None
+_smart = None
+_elements_supported = None
+
+def get_session(user=USER_NAME, pw=USER_PASSWORD):
+    """
+    Process-wide pooled HTTP session shared by all search, paging and read calls. Connections are kept alive
+    and reused, the pool holds one connection per worker. With RESPONSE_CACHE, responses are answered from the
+    response cache of ResponseCache.
+    :param user: Username for connection to server
+    :param pw: Password for connection to server
+    """
+    global _session
+    with _connection_lock:
+        if _session is None:
+            session = requests.Session()
+            pool_maxsize = max(MAX_WORKERS, DISCOVERY_MAX_PARALLEL)
+            if RESPONSE_CACHE == "off":
+                adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+            else:
+                adapter = CachingAdapter(ResponseCache(), pool_maxsize=pool_maxsize)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.auth = (user, pw)  # Basic auth header instead of credentials in the URL
+            session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+            session.hooks['response'].append(telemetry.response_hook)
+            _session = session
+        return _session
+
 
 def connect_to_server(user, pw):
     """
-    Creates the FhirClient object for requests later.
+    Creates the FhirClient object for requests later. The client is created once per process and
+    sends all its requests through the shared session of get_session.
     :param user: Username for connection to server
     :param pw: Password for connection to server
     """
-    settings = {
-        "app_id": "some_app_id",
-        "api_base": f"https://{user}:{pw}@{SERVER_NAME}"}
+    global _smart
+    with _connection_lock:
+        if _smart is None:
+            settings = {
+                "app_id": "some_app_id",
+                "api_base": server_base_url()}
+
+            smart = client.FHIRClient(settings=settings)
+            smart.server.session = get_session(user, pw)
+            _smart = smart
+        return _smart
+
+
+def elements_supported():
+    """
+    Checks once per process whether the server accepts "_elements". Servers ignoring it return complete resources,
+    which works as well; servers rejecting it with 400 are searched without it.
+    """
+    global _elements_supported
+    with _connection_lock:
+        if _elements_supported is None:
+            try:
+                response = get_session().get(f"{server_base_url()}/Patient", params={'_count': '1', '_elements': 'id'},
+                                             headers={'Accept': 'application/fhir+json'})
+                _elements_supported = response.status_code != 400
+            except requests.exceptions.RequestException:
+                _elements_supported = True  # No evidence against it, failing searches are retried as usual
+            if not _elements_supported:
+                print("The server does not support _elements, complete resources are fetched.\n")
+        return _elements_supported
 
-    smart = client.FHIRClient(settings=settings)
-    return smart
 
+def projected(resource_type, struct):
+    """
+    Adds "_elements" with the elements read by the analysis to the search parameters, unless FULL_RESOURCES is
+    set or the server rejects it.
+    """
+    if FULL_RESOURCES or resource_type not in PROJECTED_ELEMENTS or '_elements' in struct or not elements_supported():
+        return struct
+    return dict(struct, _elements=','.join(PROJECTED_ELEMENTS[resource_type]))
 
-def fetch_bundle_for_code(smart, bundle):
+
+def search(smart, resource_type, struct):
     """
-    Send query request to the Fhir server via Smart,
-    return the result in a bundle. If the result bundle is too big (at most 1K entries),
-    it returns them in pages separately.
+    Sends the search query and returns the entries of all its pages.
     :param smart: Fhir Server Connector
-    :param bundle: Fhir Search Query
-    :return: All results in Bundle
+    :param resource_type: Searched resource type, e.g. "Condition"
+    :param struct: Search parameters, values as str or bytes
+    :return: Entries of all pages, as dictionaries
+    """
+    return list(iter_search(smart, resource_type, struct))
+
+
+def iter_search(smart, resource_type, struct):
+    """
+    Generator version of search: yields the entries page by page, so only the current page is held in memory.
+    """
+    for entries, next_url in iter_search_pages(smart, resource_type, struct):
+        yield from entries
+
+
+def iter_search_pages(smart, resource_type, struct):
+    """
+    Yields (entries, URL of the next page or None) for every page of the search query. The search URL is built
+    from the search parameters and, like the following pages, requested as raw JSON without parsing it into
+    fhirclient models.
+    """
+    return iter_bundle_pages(smart, search_url(resource_type, struct))
+
+
+def iter_bundle_pages(smart, url):
+    """
+    Yields (entries, URL of the next page or None) for every page of a search, starting at the search URL or
+    at the page URL of an interrupted search. All requests go through the retry policy of FhirHelpersRetry.
+    :param smart: Fhir Server Connector
+    :param url: Search or page URL
     """
     print(f"Start processing new query...\n")
-    result_bundle = []
-
-    url = f"https://{USER_NAME}:{USER_PASSWORD}@" + bundle.link[0].url[8:]
-    while True:
-        try:
-            bundle = smart.server.request_json(url)
-            break
-        except Exception as exc:
-            print(f"generated an exception: {exc} but continue to trying. \n")
-            time.sleep(3)
-
-    if 'entry' in bundle:
-        result_bundle.extend(bundle['entry'])
-
-    while page := [page for page in bundle["link"] if "next" in page["relation"]]:
-        url = f"https://{USER_NAME}:{USER_PASSWORD}@" + page[0]["url"][8:]
-        while True:
-            try:
-                page = smart.server.request_json(url)
-                break
-            except Exception as exc:
-                print(f"Generated an exception: {exc} but continue to trying.\n")
-                smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
-                time.sleep(3)
-
-        bundle = page
-        result_bundle.extend(bundle['entry'])
-
-    print(f"Current query return {len(result_bundle)} result!\n")
-    return result_bundle
+    count = 0
+    pages = 0
+
+    query_type = query_type_of(url)  # Next page URLs do not always name the resource type
+    while url:
+        bundle = call_with_retry(lambda: smart.server.request_json(url), url, query_type)
+        entries = bundle.get('entry', [])
+        count += len(entries)
+        pages += 1
+        url = next((page["url"] for page in bundle.get("link", []) if "next" in page["relation"]), None)
+        yield entries, url
+
+    telemetry.record_search(query_type, pages)
+    print(f"Current query return {count} result!\n")
+
+
+def server_base_url():
+    """
+    Base URL of the FHIR server, without credentials. SERVER_NAME without scheme is reached via https.
+    """
+    if "://" in SERVER_NAME:
+        return SERVER_NAME.rstrip('/')
+    return f"https://{SERVER_NAME}".rstrip('/')
+
+
+def search_url(resource_type, struct):
+    """
+    Builds the search URL of a query from its search parameters, with the "_elements" projection. The separators
+    of "system|code" values and of comma-joined alternatives are sent unescaped, as allowed in a query string.
+    :param resource_type: Searched resource type, e.g. "Condition"
+    :param struct: Search parameters, values as str or bytes
+    """
+    params = {key: value.decode() if isinstance(value, bytes) else value
+              for key, value in projected(resource_type, struct).items()}
+    return f"{server_base_url()}/{resource_type}?{urlencode(params, safe=',|')}"
+
+
+def plan_code_chunks(resource_type, struct, system, codes, param_name='code'):
+    """
+    Groups the codes into chunks for comma-joined "system|code" search values. Chunk size is derived from
+    MAX_URL_LENGTH, so that every search URL stays below the URL length limit of the server.
+    :param resource_type: Searched resource type, e.g. "Condition"
+    :param struct: Remaining search parameters of the query (without the code parameter)
+    :param system: Code system of the codes
+    :param codes: Ordered list of codes
+    :param param_name: Name of the code search parameter
+    :return: List of code lists
+    """
+    return plan_value_chunks(resource_type, struct, codes, param_name, prefix=system + '|')
+
+
+def plan_value_chunks(resource_type, struct, values, param_name, prefix='', max_values=None):
+    """
+    Groups the values of a comma-joined search parameter (e.g. "_id") into chunks, so that every search URL
+    stays below MAX_URL_LENGTH.
+    :param resource_type: Searched resource type, e.g. "Medication"
+    :param struct: Remaining search parameters of the query
+    :param values: Ordered list of values
+    :param param_name: Name of the search parameter
+    :param prefix: Prefix sent with every value, e.g. "system|"
+    :param max_values: Maximum number of values per chunk, no limit if not given
+    :return: List of value lists
+    """
+    budget = MAX_URL_LENGTH - len(search_url(resource_type, struct)) - len(f"&{quote(param_name)}=")
+    separator_length = len(',')  # Not escaped by search_url
+
+    chunks = []
+    current_chunk, current_length = [], 0
+    for value in values:
+        token_length = len(quote(prefix + value, safe='|'))
+        if current_chunk and (current_length + separator_length + token_length > budget
+                              or len(current_chunk) == max_values):
+            chunks.append(current_chunk)
+            current_chunk, current_length = [], 0
+        current_length += token_length + (separator_length if current_chunk else 0)
+        current_chunk.append(value)
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
+
+
+def code_search_value(system, codes):
+    """
+    Joins the codes to a single comma-joined "system|code" search value.
+    """
+    return ','.join(system + '|' + code for code in codes)
+
+
+def unique_entries(entries, seen=None):
+    """
+    Drops entries returned more than once, e.g. a resource matching the codes of two chunked queries.
+    Lazy, only the ids seen so far are kept.
+    :param seen: (resourceType, id) of entries already returned before, e.g. ahead of a resumed search
+    """
+    seen = set() if seen is None else seen
+    for entry in entries:
+        key = (entry['resource']['resourceType'], entry['resource']['id'])
+        if key not in seen:
+            seen.add(key)
+            yield entry
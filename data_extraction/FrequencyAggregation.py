@@ -0,0 +1,73 @@
+import threading
+
+"""
+Code frequencies counted while the resources are fetched, so the metadata does not need a second pass over the
+results. Each entry is tallied for its patient as it is written, the tally is added to the totals once the
+patient is finished, so a failed or retried patient is never counted twice.
+"""
+
+
+class FrequencyAggregator:
+    """
+    Thread-safe frequencies of the listed codes of one resource type, or of the referenced Medications of a
+    Medication* resource type.
+    """
+
+    def __init__(self, resource_type, system=None, code_list=None, exclude_ids=frozenset()):
+        """
+        :param system: Code system of the counted codings, None to count Medication references instead
+        :param code_list: Codes to count, e.g. a CodeList
+        :param exclude_ids: Ids of resources not to count, e.g. the main diagnoses
+        """
+        self.resource_type = resource_type
+        self.system = system
+        self.code_list = code_list
+        self.exclude_ids = exclude_ids
+        self.counts = {}  # Code (or Medication reference) -> frequency, in order of first occurrence
+        self.patients = set()  # Patients with at least one counted code
+        self.patient_count = 0  # Patients with results, set by the extraction
+        self.complete = True
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _keys(self, resource):
+        if self.system is None:
+            reference = resource.get('medicationReference', {}).get('reference')
+            return [reference] if reference else []
+        if resource['id'] in self.exclude_ids:
+            return []
+        return [coding['code'] for coding in resource.get('code', {}).get('coding', [])
+                if coding.get('system') == self.system and coding.get('code') in self.code_list]
+
+    def count(self, patient, entry):
+        """
+        Tallies a fetched entry of the patient.
+        """
+        keys = self._keys(entry['resource'])
+        with self._lock:
+            tally = self._pending.setdefault(patient, {})
+            for key in keys:
+                tally[key] = tally.get(key, 0) + 1
+
+    def finish_patient(self, patient):
+        """
+        Adds the tally of a patient whose results were stored to the totals.
+        """
+        with self._lock:
+            tally = self._pending.pop(patient, {})
+            for key, count in tally.items():
+                self.counts[key] = self.counts.get(key, 0) + count
+            if tally:
+                self.patients.add(patient)
+
+    def discard_patient(self, patient):
+        with self._lock:
+            self._pending.pop(patient, None)
+
+    def mark_incomplete(self, reason):
+        """
+        The run did not see all stored resources, e.g. it resumed an interrupted run, so the frequencies have
+        to be computed from the result store instead.
+        """
+        self.complete = False
+        print(f"{self.resource_type} frequencies are recomputed after the run: {reason}.\n")
@@ -0,0 +1,62 @@
+import argparse
+import json
+import logging
+import os
+
+from Metadata import merge_metadata
+from Sharding import SHARD_METADATA_NAME, parse_shard
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+"""
+This script combines the partial metadata.json of the shards of a sharded run (--shard i/N) into the metadata of
+the whole cohort. The shards are checked for completeness, every shard 1 to N has to be given exactly once.
+"""
+
+
+def metadata_file(path):
+    """
+    metadata.json given directly or in the fhir_results folder of a shard's working directory.
+    """
+    for candidate in (path, os.path.join(path, "metadata.json"), os.path.join(path, "fhir_results", "metadata.json")):
+        if os.path.isfile(candidate):
+            return candidate
+    raise FileNotFoundError(f"No metadata.json found at {path}")
+
+
+def main(paths, output, allow_partial=False):
+    shard_metadata = []
+    shards = set()
+    count = None
+    for path in paths:
+        with open(metadata_file(path), 'r') as file:
+            metadata = json.load(file)
+        if SHARD_METADATA_NAME not in metadata:
+            raise ValueError(f"{path} is not the metadata of a shard")
+        index, shard_count = parse_shard(metadata[SHARD_METADATA_NAME])
+        if count is not None and shard_count != count:
+            raise ValueError(f"{path} is shard {index}/{shard_count}, the other shards are of {count}")
+        if index in shards:
+            raise ValueError(f"Shard {index}/{shard_count} is given twice")
+        count = shard_count
+        shards.add(index)
+        shard_metadata.append(metadata)
+
+    missing = sorted(set(range(1, count + 1)) - shards)
+    if missing and not allow_partial:
+        raise ValueError(f"Shards {missing} of {count} are missing")
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(merge_metadata(shard_metadata), file, indent=4)
+    logging.info(f"Metadata of {len(shards)} shards has been saved to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merges the metadata.json of the shards of a run.")
+    parser.add_argument("paths", nargs="+",
+                        help="metadata.json of each shard, or the shard's working directory or fhir_results folder")
+    parser.add_argument("--output", default="fhir_results/metadata.json")
+    parser.add_argument("--allow-partial", action="store_true", help="Merge even if shards are missing")
+    args = parser.parse_args()
+    main(args.paths, args.output, args.allow_partial)
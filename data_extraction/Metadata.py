@@ -3,43 +3,95 @@ import os
 from collections import defaultdict
 from datetime import datetime
 
+from Sharding import SHARD_METADATA_NAME
+
 os.makedirs('fhir_results', exist_ok=True)
 
 def gather_metadata(source, count):
+    update_metadata({source: count})
+
+def new_metadata():
+    """
+    Content of a new metadata.json, before any value is stored.
+    """
+    now = datetime.now()
+    return {
+        "execution_date": now.strftime("%Y-%m-%d"),
+        "execution_time": now.strftime("%H:%M:%S"),
+        "asthma_and_copd_patient_count": 0,
+        "asthma_and_copd_patients_with_chief_complaint": 0,
+        "patient_count_with_secondary_conditions": 0,
+        "patient_count_with_observations": 0,
+        "patient_count_with_medicationRequests": 0,
+        "patient_count_with_medicationAdministrations": 0,
+        "patient_count_with_medicationStatements": 0,
+        "main_diagnosis_count": 0, # Not same as asthma_and_copd_patients_with_chief_complaint. (might higher)
+        #When same patient main diagnosed at different times at different encounter (even for different code) etc.
+        "main_diagnosis_counts": defaultdict(int),
+        "secondary_conditions_counts": defaultdict(int),
+        "observations_counts": defaultdict(int),
+        "medicationAdministrations_counts": defaultdict(int),
+        "medicationRequests_counts": defaultdict(int),
+        "medicationStatements_counts": defaultdict(int)
+    }
+
 
+def update_metadata(values):
+    """
+    Stores several metadata values with a single write of metadata.json.
+    :param values: Dictionary metadata name -> value
+    """
     if os.path.exists('fhir_results/metadata.json'):
         with open('fhir_results/metadata.json', 'r') as metadata_file:
             metadata = json.load(metadata_file)
     else:
-        metadata = {
-            "execution_date": datetime.now().strftime("%Y-%m-%d"),
-            "execution_time": datetime.now().strftime("%H:%M:%S"),
-            "asthma_and_copd_patient_count": 0,
-            "asthma_and_copd_patients_with_chief_complaint": 0,
-            "patient_count_with_secondary_conditions": 0,
-            "patient_count_with_observations": 0,
-            "patient_count_with_medicationRequests": 0,
-            "patient_count_with_medicationAdministrations": 0,
-            "patient_count_with_medicationStatements": 0,
-            "main_diagnosis_count": 0, # Not same as asthma_and_copd_patients_with_chief_complaint. (might higher)
-            #When same patient main diagnosed at different times at different encounter (even for different code) etc.
-            "main_diagnosis_counts": defaultdict(int),
-            "secondary_conditions_counts": defaultdict(int),
-            "observations_counts": defaultdict(int),
-            "medicationAdministrations_counts": defaultdict(int),
-            "medicationRequests_counts": defaultdict(int),
-            "medicationStatements_counts": defaultdict(int)
-        }
+        metadata = new_metadata()
 
     metadata["execution_date"] = datetime.now().strftime("%Y-%m-%d")
     metadata["execution_time"] = datetime.now().strftime("%H:%M:%S")
 
-    if source in metadata:
-        metadata[source] = count
-    else:
-        print(f"Source {source}, not defined with Metadata.json file.")
+    for source, count in values.items():
+        if source in metadata or source == SHARD_METADATA_NAME:
+            metadata[source] = count
+        else:
+            print(f"Source {source}, not defined with Metadata.json file.")
 
     with open('fhir_results/metadata.json', 'w') as metadata_file:
         json.dump(metadata, metadata_file, indent=4)
 
     print("Metadata has been saved")
+
+def merge_counts(first, second):
+    """
+    Sum of two metadata values: numbers are added, code frequency dictionaries and the "details_count" lists of
+    the medication counts are added per code, keeping the order of first occurrence.
+    """
+    if isinstance(first, dict) and isinstance(second, dict):
+        merged = dict(first)
+        for key, value in second.items():
+            merged[key] = merge_counts(merged[key], value) if key in merged else value
+        return merged
+    if isinstance(first, list) and isinstance(second, list):
+        # [{code: count}, ...] of the medication counts
+        merged = merge_counts({code: count for item in first for code, count in item.items()},
+                              {code: count for item in second for code, count in item.items()})
+        return [{code: count} for code, count in merged.items()]
+    if isinstance(first, (int, float)) and isinstance(second, (int, float)):
+        return first + second
+    return first if first is not None else second
+
+def merge_metadata(shard_metadata):
+    """
+    Combines the metadata.json of the shards of a run. The shards have disjoint patients, so all patient counts
+    and frequencies are sums.
+    :param shard_metadata: List of the metadata dictionaries of the shards
+    :return: Metadata of the whole cohort
+    """
+    merged = {}
+    for metadata in shard_metadata:
+        for name, value in metadata.items():
+            if name in ("execution_date", "execution_time", SHARD_METADATA_NAME):
+                continue
+            merged[name] = merge_counts(merged[name], value) if name in merged else value
+    return dict({"execution_date": datetime.now().strftime("%Y-%m-%d"),
+                 "execution_time": datetime.now().strftime("%H:%M:%S")}, **merged)
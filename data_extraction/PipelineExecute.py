@@ -0,0 +1,43 @@
+import logging
+
+from Constants import USER_NAME, USER_PASSWORD
+from ExtractResourcesForCohortExecute import EXTRACTION_PLAN, post_process
+from FhirHelpersPipeline import execute_pipeline
+from FhirHelpersResourceExtraction import frequency_aggregator
+from FhirHelpersUtils import connect_to_server
+from Metadata import gather_metadata
+from Sharding import SHARD_METADATA_NAME, format_shard, shard_argument_parser
+from Telemetry import telemetry
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+"""
+This script runs CohortPatientsExecute and ExtractResourcesForCohortExecute as one pipeline: the resources of a
+cohort patient are fetched as soon as its main diagnosis is confirmed, while the other patients are still being
+discovered and checked. The result files, the intermediate files and metadata.json are the same as of running
+both scripts one after another.
+"""
+
+def main(shard=None):
+    """
+    :param shard: (i, N) to process only shard i of N of the cohort, see Sharding
+    """
+    logging.info("Start...")
+    smart = connect_to_server(user=USER_NAME, pw=USER_PASSWORD)
+    if shard is not None:
+        gather_metadata(SHARD_METADATA_NAME, format_shard(shard))
+
+    # The main diagnoses are only known at the end of the pipeline, which the secondary condition counts exclude,
+    # so these are counted from the result store afterwards
+    aggregators = [(code_file, source, code_type,
+                    None if code_type == "ICD" else frequency_aggregator(code_file, source, code_type))
+                   for code_file, source, code_type in EXTRACTION_PLAN]
+    execute_pipeline(smart, aggregators, shard)
+    post_process(aggregators)
+
+if __name__ == "__main__":
+    args = shard_argument_parser("Creates the list of cohort patients and extracts their resources.").parse_args()
+    try:
+        main(args.shard)
+    finally:
+        telemetry.write_profile("PipelineExecute")
@@ -0,0 +1,107 @@
+import os
+from functools import partial
+
+from CodeRegistry import load_code_list
+from Constants import ICD_SYSTEM_NAME, LOINC_SYSTEM_NAME
+from FrequencyAggregation import FrequencyAggregator
+from ResultFiles import RESULT_EXTENSIONS, MEDICATION_RESULT_NAMES, iter_result_file
+
+"""
+Offline re-analysis of the per-patient result files of a fhir_results folder, e.g. of an archived run with updated
+code lists. The result files are split into tasks for a process pool (map): each worker counts the codes and the
+patients of its files with a FrequencyAggregator, as the extraction does. The partial counts and patient sets are
+then added up in the order of the tasks (reduce), so the result does not depend on the number of workers.
+"""
+
+TASK_FILES = 200  # Result files per task
+
+# Result folder of each resource type, relative to the fhir_results folder
+RESULT_FOLDERS = {
+    'Observation': "LOINC",
+    'Condition': "ICD",
+    **{resource_type: os.path.join("ATC", folder) for resource_type, (folder, _) in MEDICATION_RESULT_NAMES.items()},
+}
+
+
+class Frequencies:
+    """
+    Merged counts of one resource type.
+    """
+
+    def __init__(self):
+        self.counts = {}  # Code (or Medication reference) -> frequency, in order of first occurrence
+        self.patients = set()  # Patients with at least one counted code
+        self.patients_with_results = set()
+
+    def merge(self, counts, patients, patients_with_results):
+        for key, count in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.patients |= patients
+        self.patients_with_results |= patients_with_results
+
+
+def result_tasks(results_folder):
+    """
+    Splits the result files of the folder into tasks of at most TASK_FILES files of one resource type.
+    :return: List of (resource type, list of result file paths)
+    """
+    tasks = []
+    for resource_type, folder in RESULT_FOLDERS.items():
+        folder_path = os.path.join(results_folder, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        paths = [os.path.join(folder_path, filename) for filename in sorted(os.listdir(folder_path))
+                 if filename.endswith(RESULT_EXTENSIONS)]
+        tasks.extend((resource_type, paths[i:i + TASK_FILES]) for i in range(0, len(paths), TASK_FILES))
+    return tasks
+
+
+def patient_of_file(path):
+    """
+    Patient of a result file, the prefix of its file name, see patient_file_name.
+    """
+    return os.path.basename(path).split("_patient_", 1)[0]
+
+
+def count_result_files(task, loinc_code_file, icd_code_file, main_diagnoses_ids):
+    """
+    Map step, runs in a worker process.
+    :param task: (resource type, list of result file paths)
+    :param main_diagnoses_ids: Ids of the main diagnosis Conditions, which are not counted as secondary conditions
+    :return: resource type, counts, patients with a counted code, patients with results
+    """
+    resource_type, paths = task
+    if resource_type == 'Observation':
+        aggregator = FrequencyAggregator(resource_type, LOINC_SYSTEM_NAME, load_code_list(loinc_code_file))
+    elif resource_type == 'Condition':
+        aggregator = FrequencyAggregator(resource_type, ICD_SYSTEM_NAME, load_code_list(icd_code_file),
+                                         main_diagnoses_ids)
+    else:
+        aggregator = FrequencyAggregator(resource_type)
+
+    patients_with_results = set()
+    for path in paths:
+        patient = patient_of_file(path)
+        for entry in iter_result_file(path):
+            aggregator.count(patient, entry)
+            patients_with_results.add(patient)
+        aggregator.finish_patient(patient)
+    return resource_type, aggregator.counts, aggregator.patients, patients_with_results
+
+
+def reanalyze_results(results_folder, loinc_code_file, icd_code_file, main_diagnoses_ids, executor):
+    """
+    Counts the codes of all result files of the folder.
+    :param executor: ProcessPoolExecutor the tasks run in
+    :return: Dictionary resource type -> Frequencies, for every resource type of RESULT_FOLDERS
+    """
+    tasks = result_tasks(results_folder)
+    print(f"Re-analysing {sum(len(paths) for _, paths in tasks)} result files of {results_folder} "
+          f"in {len(tasks)} tasks.\n")
+    frequencies = {resource_type: Frequencies() for resource_type in RESULT_FOLDERS}
+    count_task = partial(count_result_files, loinc_code_file=loinc_code_file, icd_code_file=icd_code_file,
+                         main_diagnoses_ids=frozenset(main_diagnoses_ids))
+    # map yields in the order of the tasks, so the codes keep the order of their first occurrence
+    for resource_type, counts, patients, patients_with_results in executor.map(count_task, tasks):
+        frequencies[resource_type].merge(counts, patients, patients_with_results)
+    return frequencies
@@ -0,0 +1,141 @@
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from CodeRegistry import load_code_list
+from Constants import LOINC_CODE_FILE, ICD_CODE_FILE, ATC_CODE_FILE, MEDICATION_CACHE_FILE
+from FhirHelpersMedicationResolution import medication_id
+from FhirHelpersResourceExtraction import MEDICATION_METADATA_NAMES, medication_code_counts
+from Metadata import new_metadata
+from Reanalysis import reanalyze_results, result_tasks
+from ResultFiles import MEDICATION_RESULT_NAMES
+from Sharding import SHARD_METADATA_NAME
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+"""
+This script recomputes the metadata.json of a finished run from its per-patient result files (not written with
+KEEP_RESULT_FILES=false), without contacting the FHIR server, e.g. to re-analyse archived runs with updated code lists.
+The result files are counted in parallel worker processes, see Reanalysis. Medication references are resolved with
+the Medication cache of the run, references missing in it are counted as unresolved. If more than
+MAX_UNRESOLVED_SHARE of the Medication* resources are unresolved, e.g. without the cache, the run is refused unless
+--allow-unresolved is given. The cohort counts are taken over from the metadata.json of the run.
+"""
+
+COHORT_METADATA_NAMES = ["asthma_and_copd_patient_count", "asthma_and_copd_patients_with_chief_complaint",
+                         "main_diagnosis_count", "main_diagnosis_counts", SHARD_METADATA_NAME]
+MAX_UNRESOLVED_SHARE = 0.5  # Share of referencing Medication* resources left unresolved above which a run is refused
+
+
+def results_folder(path):
+    """
+    fhir_results folder given directly or in a run's working directory.
+    """
+    for candidate in (os.path.join(path, "fhir_results"), path):
+        if result_tasks(candidate):
+            return candidate
+    raise FileNotFoundError(f"No result files found at {path}, the run may have kept its results only in the result "
+                            f"store (KEEP_RESULT_FILES=false), write them with ExportResultFilesExecute first")
+
+
+def read_json(path, description, consequence):
+    if not os.path.isfile(path):
+        logging.warning(f"No {description} found at {path}, {consequence}")
+        return None
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def reanalyzed_metadata(folder, frequencies, run_metadata, atc_codes_by_id, atc_code_file, allow_unresolved=False):
+    """
+    :param frequencies: Dictionary resource type -> Frequencies of the result files
+    :param run_metadata: metadata.json of the run or None
+    :param atc_codes_by_id: Medication cache of the run, Medication id -> ATC codes
+    :param allow_unresolved: Count the Medications even if more than MAX_UNRESOLVED_SHARE are unresolved
+    """
+    metadata = new_metadata()
+    for name in COHORT_METADATA_NAMES:
+        if run_metadata is not None and name in run_metadata:
+            metadata[name] = run_metadata[name]
+
+    metadata["observations_counts"] = frequencies['Observation'].counts
+    metadata["patient_count_with_observations"] = len(frequencies['Observation'].patients_with_results)
+    metadata["secondary_conditions_counts"] = frequencies['Condition'].counts
+    metadata["patient_count_with_secondary_conditions"] = len(frequencies['Condition'].patients)
+
+    references_count = sum(count for resource_type in MEDICATION_METADATA_NAMES
+                           for count in frequencies[resource_type].counts.values())
+    unresolved_count = sum(count for resource_type in MEDICATION_METADATA_NAMES
+                           for reference, count in frequencies[resource_type].counts.items()
+                           if medication_id(reference) not in atc_codes_by_id)
+    if references_count and unresolved_count / references_count > MAX_UNRESOLVED_SHARE and not allow_unresolved:
+        raise ValueError(f"The Medications referenced by {unresolved_count} of {references_count} Medication* "
+                         f"resources of {folder} are not in the Medication cache, pass its path with "
+                         f"--medication-cache or count them as unresolved with --allow-unresolved")
+
+    atc_code_list = load_code_list(atc_code_file)
+    for resource_type, metadata_name in MEDICATION_METADATA_NAMES.items():
+        _, file_name = MEDICATION_RESULT_NAMES[resource_type]
+        references = frequencies[resource_type].counts
+        unresolved = [reference for reference in references if medication_id(reference) not in atc_codes_by_id]
+        if unresolved:
+            logging.warning(f"{len(unresolved)} Medications referenced by {resource_type}s of {folder} are not in "
+                            f"the Medication cache, they are counted as unresolved")
+        metadata["patient_count_with_" + file_name] = len(frequencies[resource_type].patients_with_results)
+        metadata[metadata_name] = medication_code_counts(resource_type, references, atc_code_list, atc_codes_by_id)
+    return metadata
+
+
+def main(paths, output=None, cohort_file=None, medication_cache=None, loinc_code_file=LOINC_CODE_FILE,
+         icd_code_file=ICD_CODE_FILE, atc_code_file=ATC_CODE_FILE, max_workers=None, allow_unresolved=False):
+    """
+    :param paths: fhir_results folders of the runs, or the runs' working directories
+    :param output: metadata.json to write, "<fhir_results>/reanalysis/metadata.json" if not given
+    :param cohort_file: patients_main_diagnosed_asthma_copd.json of the run, next to fhir_results if not given
+    :param medication_cache: Medication cache of the run, in fhir_results if not given
+    :param allow_unresolved: Write the metadata even if most Medications are not in the Medication cache
+    """
+    if output is not None and len(paths) > 1:
+        raise ValueError("--output can only be given for a single run")
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for path in paths:
+            folder = results_folder(path)
+            working_directory = os.path.dirname(os.path.abspath(folder))
+
+            cohort_path = cohort_file or os.path.join(working_directory, "patients_main_diagnosed_asthma_copd.json")
+            cohort = read_json(cohort_path, "cohort file", "main diagnoses are counted as secondary conditions")
+            main_diagnoses_ids = {condition['id'] for conditions in (cohort or {}).values() for condition in conditions}
+            cache_path = medication_cache or os.path.join(folder, os.path.basename(MEDICATION_CACHE_FILE))
+            atc_codes_by_id = read_json(cache_path, "Medication cache", "Medications are counted as unresolved") or {}
+            run_metadata = read_json(os.path.join(folder, "metadata.json"), "metadata.json", "the cohort counts are 0")
+
+            frequencies = reanalyze_results(folder, loinc_code_file, icd_code_file, main_diagnoses_ids, executor)
+            metadata = reanalyzed_metadata(folder, frequencies, run_metadata, atc_codes_by_id, atc_code_file,
+                                           allow_unresolved)
+
+            output_file = output or os.path.join(folder, "reanalysis", "metadata.json")
+            os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+            with open(output_file, 'w') as file:
+                json.dump(metadata, file, indent=4)
+            logging.info(f"Metadata of {folder} has been saved to {output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recomputes the metadata.json of runs from their result files.")
+    parser.add_argument("paths", nargs="+", help="fhir_results folder of each run, or the run's working directory")
+    parser.add_argument("--output", help="metadata.json to write, default <fhir_results>/reanalysis/metadata.json")
+    parser.add_argument("--cohort-file", help="patients_main_diagnosed_asthma_copd.json of the run, "
+                                              "default next to fhir_results")
+    parser.add_argument("--medication-cache", help="Medication cache of the run, default in fhir_results")
+    parser.add_argument("--loinc-codes", default=LOINC_CODE_FILE)
+    parser.add_argument("--icd-codes", default=ICD_CODE_FILE)
+    parser.add_argument("--atc-codes", default=ATC_CODE_FILE)
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, default the number of CPUs")
+    parser.add_argument("--allow-unresolved", action="store_true",
+                        help="Count Medications missing in the Medication cache as unresolved, even for most of them")
+    args = parser.parse_args()
+    main(args.paths, args.output, args.cohort_file, args.medication_cache, args.loinc_codes, args.icd_codes,
+         args.atc_codes, args.workers, args.allow_unresolved)
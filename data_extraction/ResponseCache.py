@@ -0,0 +1,197 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from Constants import RESPONSE_CACHE, RESPONSE_CACHE_FILE, RESPONSE_CACHE_MAX_MB
+
+"""
+Opt-in on-disk cache of the responses of the FHIR server, mounted as transport adapter of the shared session, so
+every search, page and read request goes through it. Responses are stored by normalized URL with their ETag and
+Last-Modified, follow-up pages of a search by the key of the search and their page index instead, as the paging
+tokens of the server (e.g. "_getpages" ids) change between runs. With RESPONSE_CACHE=revalidate a cached response
+is revalidated with If-None-Match/If-Modified-Since and replayed on "304 Not Modified", pages linking a next page
+are always transferred so the link holds a current paging token. With RESPONSE_CACHE=offline cached responses are
+replayed without contacting the server at all. The least recently used responses are evicted beyond
+RESPONSE_CACHE_MAX_MB.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, status INTEGER, headers TEXT, body BLOB, etag TEXT,
+                                      last_modified TEXT, size INTEGER, accessed REAL);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+# Headers describing the transfer of the original response, not the stored (decoded) body
+TRANSFER_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive'}
+# Announced next pages remembered at most, the oldest ones belong to searches whose paging was abandoned
+MAX_ANNOUNCED_PAGES = 10000
+
+
+class OfflineCacheMissError(requests.exceptions.RequestException):
+    """The request is not in the response cache and RESPONSE_CACHE=offline forbids sending it."""
+
+
+def normalize_url(url):
+    """
+    Cache key of a request URL: scheme and host in lower case, query parameters and their comma-separated values
+    (alternatives of a FHIR search) sorted.
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted((name, ','.join(sorted(value.split(','))))
+                             for name, value in parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+
+def next_link(body):
+    """
+    URL of the next page of a Bundle response body, None if there is none.
+    """
+    if b'"next"' not in body:
+        return None
+    try:
+        links = json.loads(body).get('link', [])
+    except (ValueError, AttributeError):
+        return None
+    return next((link.get('url') for link in links if link.get('relation') == 'next'), None)
+
+
+class ResponseCache:
+    """
+    Thread-safe, size-bounded LRU store of responses in SQLite.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_FILE, max_bytes=RESPONSE_CACHE_MAX_MB * 1024 * 1024):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, url):
+        """
+        :return: (status, headers, body, etag, last modified) of the cached response, None if there is none
+        """
+        with self._lock:
+            row = self._db.execute("SELECT status, headers, body, etag, last_modified FROM responses WHERE url = ?",
+                                   (url,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE url = ?", (time.time(), url))
+        return row[0], json.loads(row[1]), row[2], row[3], row[4]
+
+    def put(self, url, status, headers, body):
+        with self._lock:
+            previous = self._db.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (url, status, json.dumps(headers), body, headers.get('ETag'),
+                              headers.get('Last-Modified'), len(body), time.time()))
+            self._size += len(body) - (previous[0] if previous else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used responses until the cache is below 90% of its size limit.
+        """
+        target = self.max_bytes * 0.9
+        self._db.execute("BEGIN")
+        for url, size in self._db.execute("SELECT url, size FROM responses ORDER BY accessed").fetchall():
+            if self._size <= target:
+                break
+            self._db.execute("DELETE FROM responses WHERE url = ?", (url,))
+            self._size -= size
+        self._db.execute("COMMIT")
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    Transport adapter answering GET requests from the response cache. Streamed downloads (Bulk Data files) and
+    other methods are passed through.
+    """
+
+    def __init__(self, cache, mode=RESPONSE_CACHE, **kwargs):
+        """
+        :param cache: ResponseCache
+        :param mode: "revalidate" or "offline"
+        """
+        super().__init__(**kwargs)
+        self.cache = cache
+        self.mode = mode
+        self._pages = OrderedDict()  # Normalized URL of a next page -> (key of the search, page index)
+        self._pages_lock = threading.Lock()
+
+    def _key(self, url):
+        """
+        Cache key and page position of a request: follow-up pages announced by an earlier response are keyed by
+        their search and page index, other requests by their normalized URL.
+        """
+        url = normalize_url(url)
+        with self._pages_lock:
+            search, index = self._pages.pop(url, (url, 0))
+        return (search if index == 0 else f"{search}#page={index}"), search, index
+
+    def _announce_next_page(self, body, search, index):
+        url = next_link(body)
+        if url is not None:
+            with self._pages_lock:
+                self._pages[normalize_url(url)] = (search, index + 1)
+                if len(self._pages) > MAX_ANNOUNCED_PAGES:
+                    self._pages.popitem(last=False)
+
+    def send(self, request, stream=False, **kwargs):
+        if request.method != 'GET' or stream:
+            return super().send(request, stream=stream, **kwargs)
+
+        key, search, index = self._key(request.url)
+        cached = self.cache.get(key)
+        if self.mode == "offline":
+            if cached is None:
+                raise OfflineCacheMissError(f"{request.url} is not in the response cache", request=request)
+            self._announce_next_page(cached[2], search, index)
+            return self._replay(request, cached, "replayed")
+
+        if cached is not None and next_link(cached[2]) is None:
+            # A page linking a next page is always transferred, a replayed one would link an expired paging token
+            etag, last_modified = cached[3], cached[4]
+            if etag:
+                request.headers['If-None-Match'] = etag
+            if last_modified:
+                request.headers['If-Modified-Since'] = last_modified
+
+        response = super().send(request, stream=stream, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            response.close()
+            self._announce_next_page(cached[2], search, index)
+            return self._replay(request, cached, "revalidated")
+        if response.status_code == 200:
+            self._announce_next_page(response.content, search, index)
+            if 'no-store' not in response.headers.get('Cache-Control', ''):
+                headers = {name: value for name, value in response.headers.items() if name.lower() not in TRANSFER_HEADERS}
+                self.cache.put(key, response.status_code, headers, response.content)
+        return response
+
+    def _replay(self, request, cached, cache_status):
+        status, headers, body, _, _ = cached
+        response = requests.Response()
+        response.status_code = status
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(headers)
+        response.headers['Content-Length'] = str(len(body))
+        response._content = body
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.cache_status = cache_status  # Read by the telemetry, no bytes were transferred
+        return response
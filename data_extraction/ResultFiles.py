@@ -0,0 +1,137 @@
+import gzip
+import json
+import os
+import re
+
+from Constants import RESULT_FORMAT
+
+"""
+Per-patient result files. Entries are streamed into the files one by one and read back lazily, so a patient's
+history never has to be held in memory completely. "json" files look exactly like json.dump(entries, indent=4),
+"ndjson" files hold one entry per line, "ndjson.gz" is the gzip compressed variant.
+"""
+
+RESULT_EXTENSIONS = (".json", ".ndjson", ".ndjson.gz")
+
+# Output folder and file name of each medication profile
+MEDICATION_RESULT_NAMES = {
+    'MedicationAdministration': ("Administrations", "medicationAdministrations"),
+    'MedicationRequest': ("Requests", "medicationRequests"),
+    'MedicationStatement': ("Statements", "medicationStatements"),
+}
+
+
+def patient_file_name(patient):
+    """
+    File name prefix of the results of a patient: the id of its reference, e.g. "123" for "Patient/123". The name
+    does not depend on the order the patients finish in, so the result files of shards and reruns match.
+    """
+    return re.sub(r'[^A-Za-z0-9.\-]', '_', patient.rstrip('/').rsplit('/', 1)[-1])
+
+
+def result_path(code_type, source, file_name, result_format=RESULT_FORMAT):
+    """
+    Path of the result file of a patient.
+    :param code_type: "LOINC", "ICD" or "ATC"
+    :param source: Fhir resource model of the fetched resources
+    :param file_name: Prefix of the file name, see patient_file_name
+    """
+    if code_type == "LOINC":
+        whole_path = "fhir_results/LOINC/" + file_name + "_patient_observations"
+    elif code_type == "ICD":
+        whole_path = "fhir_results/ICD/" + file_name + "_patient_conditions"
+    elif code_type == "ATC":
+        folder, name = MEDICATION_RESULT_NAMES[source.resource_type]
+        whole_path = f"fhir_results/ATC/{folder}/" + file_name + f"_patient_{name}"
+    return whole_path + "." + result_format
+
+
+class ResultWriter:
+    """
+    Streams entries into a result file, format taken from the file extension.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the result file
+        """
+        self.path = path
+        self.count = 0
+        self._json_array = path.endswith(".json")
+        if path.endswith(".gz"):
+            self._file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self._file = open(path, 'w')
+
+    def write(self, entry):
+        if self._json_array:
+            # Same layout as json.dump(entries, file, indent=4)
+            entry_json = json.dumps(entry, indent=4).replace("\n", "\n    ")
+            self._file.write(("[\n    " if self.count == 0 else ",\n    ") + entry_json)
+        else:
+            self._file.write(json.dumps(entry) + "\n")
+        self.count += 1
+
+    def close(self):
+        if self._json_array:
+            self._file.write("[]" if self.count == 0 else "\n]")
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _iter_json_array(file, chunk_size=1 << 16):
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError(f"{file.name} is not a JSON array")
+    buffer = buffer[1:]
+    eof = False
+    while True:
+        buffer = buffer.lstrip().lstrip(',').lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            entry, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+        yield entry
+        buffer = buffer[end:]
+
+
+def iter_result_file(path):
+    """
+    Yields the entries of a result file one by one.
+    """
+    if path.endswith(".ndjson.gz"):
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    elif path.endswith(".ndjson"):
+        with open(path, 'r') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, 'r') as file:
+            yield from _iter_json_array(file)
+
+
+def iter_result_folder(folder_path):
+    """
+    Yields (filename, lazy entry iterator) for all result files of the folder.
+    """
+    for filename in sorted(os.listdir(folder_path)):
+        if filename.endswith(RESULT_EXTENSIONS):
+            yield filename, iter_result_file(os.path.join(folder_path, filename))
+
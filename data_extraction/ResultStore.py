@@ -0,0 +1,240 @@
+import json
+import os
+import sqlite3
+import threading
+
+from Constants import RESULT_STORE_FILE
+from ResultFiles import ResultWriter, result_path, patient_file_name
+
+"""
+Local store of the extracted resources in SQLite, indexed by resource type, patient, code system and code, and
+by the referenced Medication of Medication* resources. The frequencies and patient counts of the metadata are
+aggregate queries on it instead of parsing every result file. The fetched entries are inserted as they arrive,
+the per-patient result files are written alongside unless KEEP_RESULT_FILES is turned off, or afterwards by
+export_result_files.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (resource_type TEXT, patient TEXT, code_type TEXT, counter INTEGER,
+                                     PRIMARY KEY (resource_type, patient));
+CREATE TABLE IF NOT EXISTS resources (resource_type TEXT, id TEXT, patient TEXT, medication_reference TEXT,
+                                      entry TEXT, PRIMARY KEY (resource_type, id));
+CREATE TABLE IF NOT EXISTS codes (resource_type TEXT, id TEXT, patient TEXT, system TEXT, code TEXT);
+CREATE INDEX IF NOT EXISTS resources_patient ON resources (resource_type, patient);
+CREATE INDEX IF NOT EXISTS resources_medication ON resources (resource_type, medication_reference);
+CREATE INDEX IF NOT EXISTS codes_code ON codes (resource_type, system, code);
+CREATE INDEX IF NOT EXISTS codes_patient ON codes (resource_type, patient);
+CREATE INDEX IF NOT EXISTS codes_id ON codes (resource_type, id);
+"""
+
+FLUSH_ENTRIES = 1000  # Entries of a patient buffered by PatientResults before they are inserted
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class ResultStore:
+    """
+    Thread-safe access to the result store database.
+    """
+
+    def __init__(self, path=RESULT_STORE_FILE):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def clear(self, resource_type):
+        """
+        Drops the results of a resource type, before a full extraction run.
+        """
+        with self._lock:
+            self._db.execute("BEGIN")
+            for table in ("patients", "resources", "codes"):
+                self._db.execute(f"DELETE FROM {table} WHERE resource_type = ?", (resource_type,))
+            self._db.execute("COMMIT")
+
+    def add_patient(self, code_type, resource_type, patient, entries, update=False):
+        """
+        Stores the resources of a patient.
+        :param entries: Bundle entries of the patient
+        :param update: Only insert or replace the given resources (incremental refresh), otherwise the earlier
+        resources of the patient are replaced
+        :return: Number of entries stored
+        """
+        rows, code_rows = [], []
+        for entry in entries:
+            resource = entry['resource']
+            rows.append((resource_type, resource['id'], patient,
+                         resource.get('medicationReference', {}).get('reference'), json.dumps(entry)))
+            concept = resource.get('code') or resource.get('medicationCodeableConcept') or {}
+            code_rows.extend((resource_type, resource['id'], patient, coding.get('system'), coding.get('code'))
+                             for coding in concept.get('coding', []))
+
+        with self._lock:
+            self._db.execute("BEGIN")
+            if update:
+                self._db.executemany("DELETE FROM codes WHERE resource_type = ? AND id = ?",
+                                     [(row[0], row[1]) for row in rows])
+            else:
+                self._db.execute("DELETE FROM resources WHERE resource_type = ? AND patient = ?", (resource_type, patient))
+                self._db.execute("DELETE FROM codes WHERE resource_type = ? AND patient = ?", (resource_type, patient))
+            # An updated resource keeps its position, so exports keep the order of the first extraction
+            self._db.executemany("INSERT INTO resources VALUES (?, ?, ?, ?, ?) ON CONFLICT (resource_type, id) "
+                                 "DO UPDATE SET patient = excluded.patient, entry = excluded.entry, "
+                                 "medication_reference = excluded.medication_reference", rows)
+            self._db.executemany("INSERT INTO codes VALUES (?, ?, ?, ?, ?)", code_rows)
+            if not rows and not update:
+                self._db.execute("DELETE FROM patients WHERE resource_type = ? AND patient = ?", (resource_type, patient))
+            elif rows:
+                self._db.execute("INSERT OR IGNORE INTO patients SELECT ?, ?, ?, COALESCE(MAX(counter), 0) + 1 "
+                                 "FROM patients WHERE resource_type = ?", (resource_type, patient, code_type, resource_type))
+            self._db.execute("COMMIT")
+        return len(rows)
+
+    def remove_patient(self, resource_type, patient):
+        """
+        Drops the resources of a patient, e.g. after its fetch failed half way.
+        """
+        with self._lock:
+            self._db.execute("BEGIN")
+            for table in ("patients", "resources", "codes"):
+                self._db.execute(f"DELETE FROM {table} WHERE resource_type = ? AND patient = ?",
+                                 (resource_type, patient))
+            self._db.execute("COMMIT")
+
+    def patient_ids(self, resource_type, patient):
+        """
+        (resourceType, id) of the stored resources of the patient.
+        """
+        return {(resource_type, row[0]) for row in self._execute(
+            "SELECT id FROM resources WHERE resource_type = ? AND patient = ?", (resource_type, patient))}
+
+    def patient_count(self, resource_type):
+        """
+        Number of patients with at least one resource of the type.
+        """
+        return self._execute("SELECT COUNT(DISTINCT patient) FROM resources WHERE resource_type = ?",
+                             (resource_type,))[0][0]
+
+    def code_counts(self, resource_type, system, code_list, exclude_ids=()):
+        """
+        Frequency of each listed code among the codings of the resources, in order of first extraction.
+        :param code_list: Codes to count, e.g. a CodeList
+        :param exclude_ids: Ids of resources not to count
+        :return: Dictionary code -> frequency, number of distinct patients with a counted code
+        """
+        with self._lock:
+            self._db.execute("CREATE TEMP TABLE IF NOT EXISTS listed_codes (code TEXT PRIMARY KEY)")
+            self._db.execute("CREATE TEMP TABLE IF NOT EXISTS excluded_ids (id TEXT PRIMARY KEY)")
+            self._db.execute("DELETE FROM listed_codes")
+            self._db.execute("DELETE FROM excluded_ids")
+            self._db.executemany("INSERT OR IGNORE INTO listed_codes VALUES (?)", ((code,) for code in code_list))
+            self._db.executemany("INSERT OR IGNORE INTO excluded_ids VALUES (?)",
+                                 ((resource_id,) for resource_id in exclude_ids))
+            selection = ("FROM codes c JOIN resources r ON r.resource_type = c.resource_type AND r.id = c.id "
+                         "WHERE c.resource_type = ? AND c.system = ? AND c.code IN (SELECT code FROM listed_codes) "
+                         "AND c.id NOT IN (SELECT id FROM excluded_ids)")
+            counts = self._db.execute(f"SELECT c.code, COUNT(*) {selection} GROUP BY c.code ORDER BY MIN(r.rowid)",
+                                      (resource_type, system)).fetchall()
+            patient_count = self._db.execute(f"SELECT COUNT(DISTINCT c.patient) {selection}",
+                                             (resource_type, system)).fetchone()[0]
+        return dict(counts), patient_count
+
+    def medication_reference_counts(self, resource_type):
+        """
+        Number of resources referencing each Medication, in order of first extraction.
+        """
+        return dict(self._execute("SELECT medication_reference, COUNT(*) FROM resources WHERE resource_type = ? "
+                                  "AND medication_reference IS NOT NULL GROUP BY medication_reference "
+                                  "ORDER BY MIN(rowid)", (resource_type,)))
+
+    def iter_patients(self):
+        """
+        Yields (resource type, code type, patient, counter) of all patients with results.
+        """
+        yield from self._execute("SELECT resource_type, code_type, patient, counter FROM patients "
+                                 "ORDER BY resource_type, counter")
+
+    def iter_entries(self, resource_type, patient):
+        for row in self._execute("SELECT entry FROM resources WHERE resource_type = ? AND patient = ? ORDER BY rowid",
+                                 (resource_type, patient)):
+            yield json.loads(row[0])
+
+
+def result_store():
+    """
+    The result store shared by all threads of the process.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ResultStore()
+        return _store
+
+
+class PatientResults:
+    """
+    Inserts the entries of one patient into the result store while they are fetched, in batches of FLUSH_ENTRIES,
+    so memory is bounded without a temporary file. Entries stored before with the same id are replaced in place.
+    """
+
+    def __init__(self, code_type, resource_type, patient):
+        self.code_type = code_type
+        self.resource_type = resource_type
+        self.patient = patient
+        self.count = 0
+        self._pending = []
+
+    def write(self, entry):
+        self._pending.append(entry)
+        self.count += 1
+        if len(self._pending) >= FLUSH_ENTRIES:
+            self.flush()
+
+    def flush(self):
+        """
+        Inserts the buffered entries, e.g. before the page they belong to is recorded as done.
+        """
+        if self._pending:
+            result_store().add_patient(self.code_type, self.resource_type, self.patient, self._pending, update=True)
+            self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+def write_result_file(code_type, source, patient, path=None):
+    """
+    Writes the stored resources of a patient to its per-patient result file.
+    :param path: Result file to write, the patient's file in RESULT_FORMAT if not given
+    :return: Path of the file
+    """
+    path = path or result_path(code_type, source, patient_file_name(patient))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with ResultWriter(path) as writer:
+        for entry in result_store().iter_entries(source.resource_type, patient):
+            writer.write(entry)
+    return path
+
+
+def export_result_files(sources):
+    """
+    Writes the stored results in the per-patient result file layout of fhir_results, named by patient.
+    :param sources: Dictionary resource type -> Fhir resource model
+    :return: Number of files written
+    """
+    count = 0
+    for resource_type, code_type, patient, counter in result_store().iter_patients():
+        write_result_file(code_type, sources[resource_type], patient)
+        count += 1
+    return count
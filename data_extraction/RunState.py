@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+from Constants import RUN_STATE_FILE
+
+"""
+Persistent state of extraction runs in SQLite. An extraction run covers the passes of all resource types of a run
+and stays open until every one of them has completed, so a restarted run skips the resource types completed before
+it was interrupted. Per resource type it records the patients already finished, the searches (code chunks)
+finished per patient and the page cursor of the search in flight, together with the number of entries stored in
+the result store up to that cursor. A restarted pass skips finished work and continues interrupted searches at
+their last page. The start of the last completed pass is kept for incremental refreshes with "_lastUpdated", and
+the result file of each patient for rewriting it with the refreshed resources.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS extraction_runs (run_id TEXT PRIMARY KEY, resource_types TEXT, started TEXT, completed TEXT);
+CREATE TABLE IF NOT EXISTS runs (resource_type TEXT PRIMARY KEY, started TEXT, completed TEXT, since TEXT,
+                                 run_id TEXT);
+CREATE TABLE IF NOT EXISTS units (resource_type TEXT, patient TEXT, status TEXT, entry_count INTEGER,
+                                  PRIMARY KEY (resource_type, patient));
+CREATE TABLE IF NOT EXISTS chunks (resource_type TEXT, patient TEXT, chunk_key TEXT, status TEXT, cursor TEXT,
+                                   PRIMARY KEY (resource_type, patient, chunk_key));
+CREATE TABLE IF NOT EXISTS result_files (resource_type TEXT, patient TEXT, path TEXT, counter INTEGER,
+                                         PRIMARY KEY (resource_type, patient));
+"""
+
+
+class RunState:
+    """
+    Thread-safe access to the run state database.
+    """
+
+    def __init__(self, path=RUN_STATE_FILE):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        if 'run_id' not in {row[1] for row in self._db.execute("PRAGMA table_info(runs)")}:
+            # Run state of a version without extraction runs
+            self._db.execute("ALTER TABLE runs ADD COLUMN run_id TEXT")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def begin_extraction(self, resource_types):
+        """
+        Resumes the unfinished extraction run or starts a new one.
+        :param resource_types: Resource types the run fetches, it is completed once all of them are
+        :return: Id of the extraction run
+        """
+        row = self._execute("SELECT run_id, resource_types, started FROM extraction_runs WHERE completed IS NULL")
+        if row:
+            run_id, run_types, started = row[0]
+            print(f"Resuming unfinished extraction run started {started}.\n")
+            resource_types = list(dict.fromkeys(json.loads(run_types) + list(resource_types)))
+            self._execute("UPDATE extraction_runs SET resource_types = ? WHERE run_id = ?",
+                          (json.dumps(resource_types), run_id))
+            return run_id
+
+        run_id = uuid.uuid4().hex
+        self._execute("INSERT INTO extraction_runs VALUES (?, ?, ?, NULL)",
+                      (run_id, json.dumps(list(resource_types)),
+                       datetime.now(timezone.utc).isoformat(timespec='seconds')))
+        return run_id
+
+    def finish_extraction(self, run_id):
+        """
+        Completes the extraction run if the passes of all its resource types have completed.
+        :return: True if the run is completed
+        """
+        resource_types = json.loads(self._execute("SELECT resource_types FROM extraction_runs WHERE run_id = ?",
+                                                  (run_id,))[0][0])
+        if not all(self.run_completed(resource_type, run_id) for resource_type in resource_types):
+            return False
+        self._execute("UPDATE extraction_runs SET completed = ? WHERE run_id = ?",
+                      (datetime.now(timezone.utc).isoformat(timespec='seconds'), run_id))
+        return True
+
+    def run_completed(self, resource_type, run_id):
+        """
+        Whether the pass of the resource type has completed within the extraction run.
+        """
+        return bool(self._execute("SELECT 1 FROM runs WHERE resource_type = ? AND run_id = ? AND completed IS NOT NULL",
+                                  (resource_type, run_id)))
+
+    def begin_run(self, resource_type, incremental, run_id):
+        """
+        Resumes the unfinished pass of the resource type or starts a new one.
+        :param incremental: Only fetch resources updated since the last completed pass
+        :param run_id: Extraction run the pass belongs to
+        :return: Start of the last completed pass for "_lastUpdated", None for a full pass
+        """
+        row = self._execute("SELECT started, completed, since FROM runs WHERE resource_type = ?", (resource_type,))
+        if row and row[0][1] is None:
+            print(f"Resuming unfinished {resource_type} run started {row[0][0]}.\n")
+            self._execute("UPDATE runs SET run_id = ? WHERE resource_type = ?", (run_id, resource_type))
+            return row[0][2]
+
+        since = row[0][0] if incremental and row else None
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.execute("DELETE FROM units WHERE resource_type = ?", (resource_type,))
+            self._db.execute("DELETE FROM chunks WHERE resource_type = ?", (resource_type,))
+            if since is None:
+                self._db.execute("DELETE FROM result_files WHERE resource_type = ?", (resource_type,))
+            self._db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, NULL, ?, ?)",
+                             (resource_type, datetime.now(timezone.utc).isoformat(timespec='seconds'), since, run_id))
+            self._db.execute("COMMIT")
+        return since
+
+    def run_unfinished(self, resource_type):
+        row = self._execute("SELECT completed FROM runs WHERE resource_type = ?", (resource_type,))
+        return bool(row) and row[0][0] is None
+
+    def complete_run(self, resource_type):
+        self._execute("UPDATE runs SET completed = ? WHERE resource_type = ?",
+                      (datetime.now(timezone.utc).isoformat(timespec='seconds'), resource_type))
+
+    def finished_patients(self, resource_type):
+        return {row[0] for row in self._execute(
+            "SELECT patient FROM units WHERE resource_type = ? AND status = 'done'", (resource_type,))}
+
+    def finish_patient(self, resource_type, patient, entry_count):
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.execute("INSERT OR REPLACE INTO units (resource_type, patient, status, entry_count) "
+                             "VALUES (?, ?, 'done', ?)",
+                             (resource_type, patient, entry_count))
+            self._db.execute("DELETE FROM chunks WHERE resource_type = ? AND patient = ?", (resource_type, patient))
+            self._db.execute("COMMIT")
+
+    def stored_count(self, resource_type, patient):
+        """
+        Number of entries stored for an unfinished patient up to the last recorded page, None if nothing was
+        recorded yet.
+        """
+        row = self._execute("SELECT entry_count FROM units WHERE resource_type = ? AND patient = ? "
+                            "AND status = 'running'", (resource_type, patient))
+        return row[0][0] if row else None
+
+    def result_file(self, resource_type, patient):
+        row = self._execute("SELECT path FROM result_files WHERE resource_type = ? AND patient = ?",
+                            (resource_type, patient))
+        return row[0][0] if row else None
+
+    def set_result_file(self, resource_type, patient, path, counter):
+        self._execute("INSERT OR REPLACE INTO result_files VALUES (?, ?, ?, ?)", (resource_type, patient, path, counter))
+
+    def known_patients(self, resource_type):
+        """
+        Patients fetched completely in an earlier run, with or without result file.
+        """
+        return {row[0] for row in self._execute("SELECT patient FROM result_files WHERE resource_type = ?",
+                                                (resource_type,))}
+
+    def max_counter(self, resource_type):
+        return self._execute("SELECT COALESCE(MAX(counter), 0) FROM result_files WHERE resource_type = ?",
+                             (resource_type,))[0][0]
+
+    def checkpoint(self, resource_type, patient, since):
+        return PatientCheckpoint(self, resource_type, patient, since)
+
+
+class PatientCheckpoint:
+    """
+    Checkpoint of one patient and resource type, handed to the fetch generators.
+    """
+
+    def __init__(self, run_state, resource_type, patient, since):
+        self.run_state = run_state
+        self.resource_type = resource_type
+        self.patient = patient
+        self.since = since
+        self.writer = None  # PatientResults the entries are stored with, set by the caller
+        self.seen = set()  # (resourceType, id) of the entries written, for deduplication across searches
+
+    @staticmethod
+    def chunk_key(struct):
+        params = {key: value.decode() if isinstance(value, bytes) else value for key, value in sorted(struct.items())}
+        return hashlib.sha1(urlencode(params).encode()).hexdigest()
+
+    def chunk_done(self, chunk_key):
+        return bool(self.run_state._execute(
+            "SELECT 1 FROM chunks WHERE resource_type = ? AND patient = ? AND chunk_key = ? AND status = 'done'",
+            (self.resource_type, self.patient, chunk_key)))
+
+    def cursor(self, chunk_key):
+        row = self.run_state._execute(
+            "SELECT cursor FROM chunks WHERE resource_type = ? AND patient = ? AND chunk_key = ? AND status = 'running'",
+            (self.resource_type, self.patient, chunk_key))
+        return row[0][0] if row else None
+
+    def page_done(self, chunk_key, next_url):
+        """
+        Stores the entries of the page and records the page cursor. A search without next page is finished.
+        """
+        self.writer.flush()
+        with self.run_state._lock:
+            db = self.run_state._db
+            db.execute("BEGIN")
+            db.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)",
+                       (self.resource_type, self.patient, chunk_key, 'running' if next_url else 'done', next_url))
+            db.execute("INSERT OR REPLACE INTO units (resource_type, patient, status, entry_count) "
+                       "VALUES (?, ?, 'running', ?)", (self.resource_type, self.patient, self.writer.count))
+            db.execute("COMMIT")
+
@@ -0,0 +1,53 @@
+import argparse
+import hashlib
+
+"""
+Partitioning of the cohort into shards, so the extraction can run as several processes or on several machines.
+A patient belongs to a shard by a stable hash of its reference, every shard of every run gets the same patients
+without coordination. Each shard writes its own fhir_results, MergeShardsExecute combines their metadata.
+"""
+
+SHARD_METADATA_NAME = "shard"
+
+
+def parse_shard(value):
+    """
+    Parses "i/N", shard i (1 to N) of N shards.
+    :return: (i, N)
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard '{value}' is not of the form i/N")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"Shard '{value}' is not between 1/{count} and {count}/{count}")
+    return index, count
+
+
+def format_shard(shard):
+    return f"{shard[0]}/{shard[1]}"
+
+
+def shard_of(patient, count):
+    """
+    Shard (1 to count) of a patient reference, independent of the process and the Python hash seed.
+    """
+    digest = hashlib.sha1(patient.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1
+
+
+def in_shard(patient, shard):
+    """
+    :param shard: (i, N) of parse_shard, None for an unsharded run
+    """
+    return shard is None or shard_of(patient, shard[1]) == shard[0]
+
+
+def shard_argument_parser(description):
+    """
+    Command line of the entry scripts, "--shard i/N" to process only one shard of the cohort.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="i/N",
+                        help="Only process shard i of N of the cohort, e.g. 1/4")
+    return parser
@@ -0,0 +1,239 @@
+import json
+import os
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlparse
+
+from Constants import RUN_PROFILE_FILE, SHOW_PROGRESS, PROGRESS_INTERVAL
+
+"""
+Request telemetry of a run: latency, errors, retries and bytes per query type (the resource type of the query),
+pages per search and the utilization of the worker pools. The numbers are written as a run profile next to
+metadata.json, to tune MAX_WORKERS and to size the server.
+"""
+
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+def query_type_of(url):
+    """
+    Query type of a request URL: the resource type or operation in its path, e.g. "Observation" for a search,
+    "Medication" for a read or "$export".
+    """
+    for segment in reversed([segment for segment in urlparse(url).path.split('/') if segment]):
+        if segment.startswith('$') or segment[:1].isupper():
+            return segment
+    return "other"
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))], 1)
+
+
+class QueryStats:
+    def __init__(self):
+        self.latencies = array('d')  # Seconds per request, compact also for millions of requests
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.cache_hits = 0
+        self.searches = 0
+        self.pages = 0
+        self.max_pages = 0
+
+    def profile(self):
+        latencies_ms = sorted(latency * 1000 for latency in self.latencies)
+        histogram = {f"<={bound}": 0 for bound in LATENCY_BUCKETS_MS}
+        histogram["more"] = 0
+        for latency in latencies_ms:
+            bound = next((bound for bound in LATENCY_BUCKETS_MS if latency <= bound), None)
+            histogram[f"<={bound}" if bound is not None else "more"] += 1
+        return {
+            "requests": len(latencies_ms),
+            "errors": self.errors,
+            "retries": self.retries,
+            "bytes": self.bytes,
+            "cache_hits": self.cache_hits,
+            "latency_ms": {
+                "mean": round(sum(latencies_ms) / len(latencies_ms), 1) if latencies_ms else None,
+                "p50": percentile(latencies_ms, 0.5),
+                "p90": percentile(latencies_ms, 0.9),
+                "p99": percentile(latencies_ms, 0.99),
+                "max": round(latencies_ms[-1], 1) if latencies_ms else None,
+                "histogram": histogram,
+            },
+            "searches": self.searches,
+            "pages_per_search": {
+                "mean": round(self.pages / self.searches, 2) if self.searches else None,
+                "max": self.max_pages,
+            },
+        }
+
+
+class Phase:
+    """
+    A pool of workers running one task per patient or query, e.g. the Observation fetch.
+    """
+
+    def __init__(self, name, workers, total):
+        self.name = name
+        self.workers = workers
+        self.total = total
+        self.done = 0
+        self.busy = 0.0
+        self.started = time.monotonic()
+        self.finished = None
+        self._last_progress = self.started
+        self._lock = threading.Lock()
+
+    def track(self, function):
+        """
+        Wraps the task function of the workers to measure their busy time.
+        """
+        def tracked(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.busy += time.monotonic() - started
+        return tracked
+
+    def task_done(self):
+        with self._lock:
+            self.done += 1
+            now = time.monotonic()
+            if not SHOW_PROGRESS or (now - self._last_progress < PROGRESS_INTERVAL and self.done < self.total):
+                return
+            self._last_progress = now
+        rate = self.done / max(now - self.started, 1e-9)
+        eta = time.strftime('%H:%M:%S', time.gmtime((self.total - self.done) / rate)) if rate else "?"
+        print(f"[{self.name}] {self.done}/{self.total} done, {rate:.2f}/s, ETA {eta}\n")
+
+    def profile(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return {
+            "tasks": self.done,
+            "workers": self.workers,
+            "elapsed_seconds": round(elapsed, 3),
+            "busy_seconds": round(self.busy, 3),
+            "utilization": round(self.busy / (elapsed * self.workers), 3) if self.workers and elapsed else None,
+        }
+
+
+class Telemetry:
+    """
+    Thread-safe collector of the request telemetry of the process.
+    """
+
+    def __init__(self):
+        self.started = datetime.now()
+        self._queries = {}
+        self._phases = []
+        self._concurrency = None
+        self._lock = threading.Lock()
+
+    def _stats(self, query_type):
+        stats = self._queries.get(query_type)
+        if stats is None:
+            stats = self._queries[query_type] = QueryStats()
+        return stats
+
+    def record_request(self, query_type, seconds, ok=True):
+        with self._lock:
+            stats = self._stats(query_type)
+            stats.latencies.append(seconds)
+            if not ok:
+                stats.errors += 1
+
+    def record_retry(self, query_type):
+        with self._lock:
+            self._stats(query_type).retries += 1
+
+    def record_bytes(self, query_type, count):
+        with self._lock:
+            self._stats(query_type).bytes += count
+
+    def record_cache_hit(self, query_type):
+        with self._lock:
+            self._stats(query_type).cache_hits += 1
+
+    def record_search(self, query_type, pages):
+        with self._lock:
+            stats = self._stats(query_type)
+            stats.searches += 1
+            stats.pages += pages
+            stats.max_pages = max(stats.max_pages, pages)
+
+    def record_concurrency_limit(self, limit, decreased=False):
+        """
+        Records a change of the limit of concurrent requests of ADAPTIVE_CONCURRENCY.
+        """
+        with self._lock:
+            if self._concurrency is None:
+                self._concurrency = {"limit": limit, "min_limit": limit, "max_limit": limit, "decreases": 0}
+            concurrency = self._concurrency
+            concurrency["limit"] = limit
+            concurrency["min_limit"] = min(concurrency["min_limit"], limit)
+            concurrency["max_limit"] = max(concurrency["max_limit"], limit)
+            concurrency["decreases"] += int(decreased)
+
+    def response_hook(self, response, stream=False, **kwargs):
+        """
+        requests response hook recording the bytes received (compressed size where the server sends it).
+        Responses of the response cache are counted as cache hits instead.
+        """
+        if getattr(response, 'cache_status', None):
+            self.record_cache_hit(query_type_of(response.url))
+            return response
+        length = response.headers.get('Content-Length')
+        if length is None and not stream:
+            length = len(response.content)
+        if length is not None:
+            self.record_bytes(query_type_of(response.url), int(length))
+        return response
+
+    @contextmanager
+    def phase(self, name, workers, total):
+        """
+        Measures a worker pool, see Phase. Prints a progress line with ETA with SHOW_PROGRESS.
+        """
+        phase = Phase(name, workers, total)
+        with self._lock:
+            self._phases.append(phase)
+        try:
+            yield phase
+        finally:
+            phase.finished = time.monotonic()
+
+    def profile(self):
+        with self._lock:
+            return {
+                "started": self.started.isoformat(timespec='seconds'),
+                "duration_seconds": round((datetime.now() - self.started).total_seconds(), 3),
+                "queries": {query_type: stats.profile() for query_type, stats in sorted(self._queries.items())},
+                "phases": [dict(name=phase.name, **phase.profile()) for phase in self._phases],
+                "concurrency": dict(self._concurrency) if self._concurrency else None,
+            }
+
+    def write_profile(self, name, path=RUN_PROFILE_FILE):
+        """
+        Stores the profile of the run under its name (e.g. the script) in the run profile file.
+        """
+        profiles = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                profiles = json.load(file)
+        profiles[name] = self.profile()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(profiles, file, indent=4)
+        print(f"Run profile has been saved to {path}")
+
+
+telemetry = Telemetry()